@@ -5,11 +5,11 @@
 import geopandas as gpd
 import logging
 import numpy as np
+from datetime import timedelta
 from os.path import join
 
 from geo_py_utils.census_open_data.open_data import download_qc_city_neighborhoods
 from geo_py_utils.etl.download_zip import download_zip_shp
-from geo_py_utils.geo_general.crs import get_crs_str
 from geo_py_utils.misc.cache import Cache_wrapper
 from geo_py_utils.misc.constants import DATA_DIR
 
@@ -22,7 +22,7 @@ FSA_2016_URL = "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-li
 
 
 
-@Cache_wrapper(path_cache = join(DATA_DIR, "cache", "canada_water.parquet"))
+@Cache_wrapper(cache_root=join(DATA_DIR, "cache"))
 def download_water(year = 2011, new_crs = None):
     
     # Download lakes and riers
@@ -40,6 +40,7 @@ def download_water(year = 2011, new_crs = None):
     
 
 
+@Cache_wrapper(cache_root_arg='path_cache_root', exclude_args=('data_download_path',))
 def download_ca_cmas(year : int = 2016,
                     pr_code:str = '24',             
                     path_cache_root: str = join(DATA_DIR, "cache"),
@@ -47,70 +48,58 @@ def download_ca_cmas(year : int = 2016,
                     data_download_path  :str = DATA_DIR,
                     new_crs = None,
                     force_spatial_join: bool = False)  -> gpd.GeoDataFrame:
+    """ Read in the 2016 CAs + CMAs (DAs) for Province of Quebec (only available for 2016 as of this witing)
 
+    Cached in path_cache_root based on the other arguments (except data_download_path)
+    Only the CAs + CMAs intersecting the province are read from the Canada-wide file (mask pushed down to the reader)
 
-    @Cache_wrapper(path_cache = join(path_cache_root, f"ca_cmas_{year}_{pr_code}_carto_{use_cartographic}_crs_{get_crs_str(new_crs)}_join_{force_spatial_join}.parquet"))
-    def download_ca_cmas_wrappee(year,
-                                pr_code,
-                                use_cartographic,
-                                data_download_path ,
-                                new_crs,
-                                force_spatial_join)  :
-        """ Read in the 2016 CAs + CMAs (DAs) for Province of Quebec (only available for 2016 as of this witing)
+    Args:
+        use_cartographic (bool): _description_
 
-        Args:
-            use_cartographic (bool): _description_
+    Returns:
+        gpd.GeoDataFrame: _description_
+    """
 
-        Returns:
-            gpd.GeoDataFrame: _description_
-        """
+    logger.info(f"Saving data to {data_download_path}")
 
-        logger.info(f"Saving data to {data_download_path}")
+    if year == 2016:
+        zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lcma000b16a_e.zip"\
+        if use_cartographic \
+        else "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lcma000a16a_e.zip"  
+    else:
+        raise ValueError(f"Fatal error - inputed {year}, but only 2016 implemented")
 
-        if year == 2016:
-            zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lcma000b16a_e.zip"\
-            if use_cartographic \
-            else "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lcma000a16a_e.zip"  
-        else:
-            raise ValueError(f"Fatal error - inputed {year}, but only 2016 implemented")
 
+    # Get the province - use 2021 - shouldnt change. Keep the crs of the StatCan files (Statistics Canada Lambert) to use it as a mask
+    shp_prov = download_prov_boundary(year= 2021,
+                                    pr_code = pr_code,
+                                    use_cartographic = use_cartographic,
+                                    data_download_path = data_download_path)
 
-        shp_ca_cmas_all = download_zip_shp(zip_download_url, data_download_path)
+    # CAs + CMAs straddling the province are also read, then filtered below
+    shp_ca_cmas_all = download_zip_shp(zip_download_url, data_download_path, mask=shp_prov.geometry.iloc[0])
 
-        # Transform (do this before the spatial join)
-        if new_crs is not None:
-            shp_ca_cmas_all = shp_ca_cmas_all.to_crs(new_crs)
+    num_qc_ca_cmas = np.sum(shp_ca_cmas_all.CMAPUID.str[:2] == str(pr_code))
+    shp_cas_cmas_prov = shp_ca_cmas_all[shp_ca_cmas_all.within(shp_prov.geometry.iloc[0])]
 
-        # Get the province (with the correct crs) - use 2021 - shouldnt change
-        shp_prov = download_prov_boundary(year= 2021,
-                                        pr_code = pr_code,
-                                        use_cartographic = use_cartographic,
-                                        data_download_path = data_download_path,
-                                        new_crs = shp_ca_cmas_all.crs)
- 
-        
-        num_qc_ca_cmas = np.sum(shp_ca_cmas_all.CMAPUID.str[:2] == str(pr_code))
-        shp_cas_cmas_prov = gpd.sjoin(shp_ca_cmas_all, shp_prov[['geometry']], how="inner", op="within" )
+    # Some CAs+CMAs straddle multiple provinces
+    if num_qc_ca_cmas != shp_cas_cmas_prov.shape[0] :
+        logger.warning(f"Warning, there are {shp_cas_cmas_prov.shape[0]} CA+CMAS found by spatial join but {num_qc_ca_cmas} based on CMAPUID filtering")
 
-        # Some CAs+CMAs straddle multiple provinces
-        if num_qc_ca_cmas != shp_cas_cmas_prov.shape[0] :
-            logger.warning(f"Warning, there are {shp_cas_cmas_prov.shape[0]} CA+CMAS found by spatial join but {num_qc_ca_cmas} based on CMAPUID filtering")
+    # Conservative: take largest
+    if num_qc_ca_cmas > shp_cas_cmas_prov.shape[0] and not force_spatial_join:
+        shp_cas_cmas_prov = shp_ca_cmas_all[shp_ca_cmas_all.CMAPUID.str[:2] == str(pr_code)]
 
-        # Conservative: take largest
-        if num_qc_ca_cmas > shp_cas_cmas_prov.shape[0] and not force_spatial_join:
-            shp_cas_cmas_prov = shp_ca_cmas_all[shp_ca_cmas_all.CMAPUID.str[:2] == str(pr_code)]
+    # Transform
+    if new_crs is not None:
+        shp_cas_cmas_prov = shp_cas_cmas_prov.to_crs(new_crs)
 
-        logger.info(f"There are {shp_cas_cmas_prov.shape[0]} features/cas+cmas in {pr_code} for the {year} census")
+    logger.info(f"There are {shp_cas_cmas_prov.shape[0]} features/cas+cmas in {pr_code} for the {year} census")
 
-        return shp_cas_cmas_prov
+    return shp_cas_cmas_prov
 
-    return download_ca_cmas_wrappee(year,
-                                pr_code,
-                                use_cartographic,
-                                data_download_path ,
-                                new_crs,
-                                force_spatial_join)
 
+@Cache_wrapper(cache_root_arg='path_cache_root', exclude_args=('data_download_path',))
 def download_das(year : int = 2021,
                     pr_code:str = '24',             
                     path_cache_root: str = join(DATA_DIR, "cache"),
@@ -118,126 +107,92 @@ def download_das(year : int = 2021,
                     data_download_path  :str = DATA_DIR,
                     new_crs = None,
                     force_spatial_join: bool = False)  -> gpd.GeoDataFrame:
-    
- 
+    """
+    download_das Read in the 2021 dissemination areas (DAs) for a iven province
 
-    @Cache_wrapper(path_cache = join(path_cache_root, f"das_{year}_{pr_code}_carto_{use_cartographic}_crs_{get_crs_str(new_crs)}_join_{force_spatial_join}.parquet"))
-    def download_das_wrappee(year,
-                                pr_code,
-                                use_cartographic,
-                                data_download_path ,
-                                new_crs,
-                                force_spatial_join)  :
-        """
-        download_das Read in the 2021 dissemination areas (DAs) for a iven province
-
-        Args:
-            use_cartographic (bool): _description_
-
-        Returns:
-            gpd.GeoDataFrame: _description_
-        """
-
-        logger.info(f"Saving data to {data_download_path}")
-
-        if year == 2021:
-            zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lda_000b21a_e.zip" \
-            if use_cartographic \
-            else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lda_000a21a_e.zip"
-        else:
-            raise ValueError(f"Fatal error - inputed {year}, but only 2021 implemented")
-
-        # Get all DAs
-        shp_das_all = download_zip_shp(zip_download_url, data_download_path)
-        
-        # Transform (do this before the spatial join)
-        if new_crs is not None:
-            shp_das_all = shp_das_all.to_crs(new_crs)
-
-        # Get the province (with the correct crs) - use 2021 - doesnt chage
+    Cached in path_cache_root based on the other arguments (except data_download_path)
+    Only the DAs of the province are read from the Canada-wide file: DAUID prefix filter (or the province boundary with force_spatial_join) pushed down to the reader
+
+    Args:
+        use_cartographic (bool): _description_
+
+    Returns:
+        gpd.GeoDataFrame: _description_
+    """
+
+    logger.info(f"Saving data to {data_download_path}")
+
+    if year == 2021:
+        zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lda_000b21a_e.zip" \
+        if use_cartographic \
+        else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lda_000a21a_e.zip"
+    else:
+        raise ValueError(f"Fatal error - inputed {year}, but only 2021 implemented")
+
+    if force_spatial_join:
+        # Get the province - use 2021 - doesnt chage. Keep the crs of the StatCan files (Statistics Canada Lambert) to use it as a mask
         shp_prov = download_prov_boundary(year= 2021,
                                         pr_code = pr_code,
                                         use_cartographic = use_cartographic, 
-                                        data_download_path = data_download_path,
-                                        new_crs = shp_das_all.crs)
-
-        num_das= np.sum(shp_das_all.DAUID.str[:2] == str(pr_code))
-        shp_das_prov = gpd.sjoin(shp_das_all, shp_prov[['geometry']], how="inner", op="within" )
+                                        data_download_path = data_download_path)
 
         # Some DAs in sask + alberta might overlap 2 provinces? not sure
-        if num_das != shp_das_prov.shape[0]:
-            logger.warning( f"Warning, there are {shp_das_prov.shape[0]} DAs found by spatial join but {num_das} based on DAUID filtering")
-        
-        # Conservative: take largest
-        if num_das > shp_das_all.shape[0] and not force_spatial_join:
-            shp_das_prov = shp_das_all[shp_das_all.DAUID.str[:2] == str(pr_code)]
+        shp_das_prov = download_zip_shp(zip_download_url, data_download_path, mask=shp_prov.geometry.iloc[0])
+        shp_das_prov = shp_das_prov[shp_das_prov.within(shp_prov.geometry.iloc[0])]
+    else:
+        # The first 2 digits of the DAUID are the province code
+        shp_das_prov = download_zip_shp(zip_download_url, data_download_path, where=f"DAUID LIKE '{pr_code}%'")
 
-        logger.info(f"There are {shp_das_prov.shape[0]} features/das in {pr_code} for the {year} census")
+    # Transform
+    if new_crs is not None:
+        shp_das_prov = shp_das_prov.to_crs(new_crs)
 
+    logger.info(f"There are {shp_das_prov.shape[0]} features/das in {pr_code} for the {year} census")
 
-        return shp_das_prov
 
-    return download_das_wrappee(year,
-                                pr_code,
-                                use_cartographic,
-                                data_download_path ,
-                                new_crs,
-                                force_spatial_join)
+    return shp_das_prov
 
 
+@Cache_wrapper(cache_root_arg='path_cache_root', exclude_args=('data_download_path',))
 def download_fsas(year : int = 2016,
                     pr_code : str = "24",
                     path_cache_root: str = join(DATA_DIR, "cache"),
                     use_cartographic:bool = USE_CARTOGRAPHIC,
                     data_download_path = DATA_DIR,
                     new_crs=None)  -> gpd.GeoDataFrame:
- 
+    """
+    download_qc_boundary Read the 2016 FSAs for the province of Quebec
+
+    Cached in path_cache_root based on the other arguments (except data_download_path)
+    Only the FSAs of the province are read from the Canada-wide file (PRUID filter pushed down to the reader)
+
+    Args:
+        use_cartographic (bool): _description_
 
-    @Cache_wrapper(path_cache = join(path_cache_root,f"fsa_{year}_{pr_code}_carto_{use_cartographic}_crs_{get_crs_str(new_crs)}.parquet"))
-    def download_fsas_wrappee(year, 
-                            pr_code,
-                            use_cartographic,
-                            data_download_path,
-                            new_crs  ) -> gpd.GeoDataFrame:
-        """
-        download_qc_boundary Read the 2016 FSAs for the province of Quebec
-
-        Args:
-            use_cartographic (bool): _description_
-
-        Returns:
-            _type_: _description_
-        """
-        if year == 2016:
-            zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lfsa000b16a_e.zip"  \
-            if use_cartographic \
-            else "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lfsa000a16a_e.zip"
-        elif year == 2021:
-            zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lfsa000b21a_e.zip"  \
-            if use_cartographic \
-            else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lfsa000a21a_e.zip"
-        else:
-            raise ValueError(f"Fatal error - inputed {year}, but only 2016 and 2021 implemented")
-
-        # Download zip + unzip  look for shp file    
-        shp_fsa_all = download_zip_shp(zip_download_url, data_download_path, extension='.shp')
-   
-        # Filter by province
-        shp_fsa_all_filtered = shp_fsa_all.loc[shp_fsa_all.PRUID.astype('str') == str(pr_code), ]
-            
-        logger.info(f"There are {shp_fsa_all_filtered.shape[0]} FSAs in {pr_code} for the 2016 census")
-
-        # Transform
-        if new_crs is not None:
-            shp_fsa_all_filtered = shp_fsa_all_filtered.to_crs(new_crs)
-
-        return shp_fsa_all_filtered
-
-    return download_fsas_wrappee(year, 
-                                pr_code,
-                                 use_cartographic,
-                                 data_download_path,
-                                 new_crs  ) 
+    Returns:
+        _type_: _description_
+    """
+    if year == 2016:
+        zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lfsa000b16a_e.zip"  \
+        if use_cartographic \
+        else "https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lfsa000a16a_e.zip"
+    elif year == 2021:
+        zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lfsa000b21a_e.zip"  \
+        if use_cartographic \
+        else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lfsa000a21a_e.zip"
+    else:
+        raise ValueError(f"Fatal error - inputed {year}, but only 2016 and 2021 implemented")
+
+    # Download zip + read the FSAs of the province from the shp file
+    shp_fsa_all_filtered = download_zip_shp(zip_download_url, data_download_path, extension='.shp', where=f"PRUID = '{pr_code}'")
+
+    logger.info(f"There are {shp_fsa_all_filtered.shape[0]} FSAs in {pr_code} for the 2016 census")
+
+    # Transform
+    if new_crs is not None:
+        shp_fsa_all_filtered = shp_fsa_all_filtered.to_crs(new_crs)
+
+    return shp_fsa_all_filtered
 
 
  
@@ -270,7 +225,7 @@ def download_qc_city_fsa_2016(buffer_degrees=0.1, **fsa_fun_kwargs) -> gpd.GeoDa
  
 
 
- 
+@Cache_wrapper(cache_root_arg='path_cache_root', exclude_args=('data_download_path',), max_age=timedelta(days=90))
 def download_prov_boundary(year: int = 2021,
                         pr_code: int = 24,
                         path_cache_root: str = join(DATA_DIR, "cache"),
@@ -280,6 +235,9 @@ def download_prov_boundary(year: int = 2021,
     """
     download_prov_boundary Read the 2021 Province boundary files 
 
+    Cached in path_cache_root based on the other arguments (except data_download_path)
+    After 90 days, the cached result is refreshed in the background: the zip kept in the download store of data_download_path is only downloaded again if it changed
+
     Args:
         pr_code (int) : province code
         use_cartographic (bool): cartographic (high resolution) or digital 
@@ -290,39 +248,23 @@ def download_prov_boundary(year: int = 2021,
         gpd.GeoDataFrame: _description_
     """
 
- 
-    @Cache_wrapper(path_cache = join(path_cache_root,f"province_{year}_{pr_code}_carto_{use_cartographic}_crs_{get_crs_str(new_crs)}.parquet"))
-    def download_prov_boundary_wrappee(year, 
-                                pr_code,
-                                 use_cartographic,
-                                 data_download_path,
-                                 new_crs  ) -> gpd.GeoDataFrame:
-
-        if year != 2021:
-            raise ValueError(f"Fatal error - inputed {year}, but only 2016 implemented")
-                                    
-        zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lpr_000b21a_e.zip" \
-        if use_cartographic \
-        else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lpr_000a21a_e.zip"
-
-        shp_prov = download_zip_shp(zip_download_url, data_download_path)
-
-        ## Get select province
-        shp_prov_select = shp_prov[ shp_prov.PRUID.astype('str') == str(pr_code)]
-        
-        # Transform
-        if new_crs is not None:
-            shp_prov_select = shp_prov_select.to_crs(new_crs)
+    if year != 2021:
+        raise ValueError(f"Fatal error - inputed {year}, but only 2016 implemented")
+                                
+    zip_download_url = "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lpr_000b21a_e.zip" \
+    if use_cartographic \
+    else "https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lpr_000a21a_e.zip"
 
-        assert shp_prov_select.shape[0] == 1
+    ## Get select province
+    shp_prov_select = download_zip_shp(zip_download_url, data_download_path, where=f"PRUID = '{pr_code}'")
+    
+    # Transform
+    if new_crs is not None:
+        shp_prov_select = shp_prov_select.to_crs(new_crs)
 
-        return shp_prov_select
+    assert shp_prov_select.shape[0] == 1
 
-    return download_prov_boundary_wrappee(year, 
-                                pr_code,
-                                 use_cartographic,
-                                 data_download_path,
-                                 new_crs  ) 
+    return shp_prov_select
 
 
 if __name__ == "__main__":
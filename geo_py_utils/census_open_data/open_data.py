@@ -1,29 +1,44 @@
 
 import pandas as pd
 import geopandas as gpd
-from os.path import join, exists
+from datetime import timedelta
+from os.path import join
+from os import makedirs
 import logging 
 
-from geo_py_utils.etl.download_zip import download_zip_shp
+from geo_py_utils.etl.download_store import DownloadStore
+from geo_py_utils.etl.download_zip import download_zip_shp, DOWNLOAD_STORE_DIR
+from geo_py_utils.etl.geo_io import read_geo_file
 from geo_py_utils.misc.cache import Cache_wrapper
 from geo_py_utils.misc.constants import DATA_DIR
 
 
 DEFAULT_QC_CITY_NEIGH_URL = "https://www.donneesquebec.ca/recherche/dataset/5b1ae6f2-6719-46df-bd2f-e57a7034c917/resource/436c85aa-88d9-4e57-9095-b72b776a71a0/download/vdq-quartier.geojson"
 
+# Cached open data older than this is served right away and refreshed in the background (only downloaded again if the source changed)
+OPEN_DATA_MAX_AGE = timedelta(days=30)
+
 logger = logging.getLogger(__file__)
 
-@Cache_wrapper(path_cache=join(DATA_DIR, "cache", "qc_neighborhoods.parquet"))
-def download_qc_city_neighborhoods(url_qc_city = DEFAULT_QC_CITY_NEIGH_URL) -> gpd.GeoDataFrame:
+@Cache_wrapper(cache_root=join(DATA_DIR, "cache"), exclude_args=('data_download_path',), max_age=OPEN_DATA_MAX_AGE)
+def download_qc_city_neighborhoods(url_qc_city = DEFAULT_QC_CITY_NEIGH_URL,
+                                   data_download_path = DATA_DIR) -> gpd.GeoDataFrame:
 
     """ Download the neighborhood polygons for Qc City (city proper only - corresponds to census sub division) 
+
+    The geojson is kept in the download store of data_download_path and only downloaded again if it changed (ETag/Last-Modified)
+
     Args: 
         url_qc_city (str, optional): url to qc open data
+        data_download_path (str, optional): where to keep the downloaded file
     Returns:
        shp_qc:  gpd.GeoDataFrame 
     """
-    
-    shp_qc_city = gpd.read_file(url_qc_city).to_crs(4326)        
+
+    # Only called on cache misses and refreshes: always check the source
+    path_download = DownloadStore(join(data_download_path, DOWNLOAD_STORE_DIR)).get(url_qc_city, max_age=0)
+
+    shp_qc_city = read_geo_file(path_download).to_crs(4326)        
 
     return shp_qc_city
 
@@ -61,9 +76,12 @@ class DownloadQcAdmBoundaries:
     - Communauté urbaine: "comet_s": DownloadQcAdmBoundaries.QC_PROV_ADM_BOUND_METRO 
     - Arrondissements: "arron_s": DownloadQcAdmBoundaries.QC_PROV_ADM_BOUND_ARROND
 
+    The zip is kept in the download store of data_download_path: after max_age, it is checked against the source (ETag/Last-Modified) and only downloaded again if it changed
+
     Attributes:
         geo_level (_type_, optional): _description_. Defaults to QC_PROV_ADM_BOUND_MRC.
         data_download_path (_type_, optional): _description_. Defaults to join(DATA_DIR, 'qc_adm_regions').
+        max_age (timedelta, optional): how long the downloaded files are used without checking the source. Defaults to OPEN_DATA_MAX_AGE.
     """
     QC_PROV_ADM_BOUND_URL = "https://diffusion.mern.gouv.qc.ca/Diffusion/RGQ/Vectoriel/Theme/Local/SDA_20k/SHP/SHP.zip"
 
@@ -74,42 +92,31 @@ class DownloadQcAdmBoundaries:
 
     def __init__(self,
                 geo_level=QC_PROV_ADM_BOUND_MRC,
-                data_download_path=join(DATA_DIR, 'qc_adm_regions')
+                data_download_path=join(DATA_DIR, 'qc_adm_regions'),
+                max_age=OPEN_DATA_MAX_AGE
                 ) :
 
         
         self.geo_level = geo_level
         self.data_download_path = data_download_path
+        self.max_age = max_age
  
 
-    def _download_qc_administrative_boundaries(self):
-
-        """Download the administrative qc polygons & unzip to disk
-        """
-
-        # Unzip the entire directory of shp files - but dont try to read it in 
-        download_zip_shp(
-                url=DownloadQcAdmBoundaries.QC_PROV_ADM_BOUND_URL,
-                data_download_path=self.data_download_path,
-                return_shp_file=False
-            )
-
- 
     def get_qc_administrative_boundaries(self) -> gpd.GeoDataFrame :
         """ Get the administrative qc polygons 
-        """
 
-        # point to data path of unzipped folder
-        path_shp = join(DATA_DIR, 'qc_adm_regions', 'SHP','Sda', 'version_courante','SHP', f'{self.geo_level}.shp')
-
-        # Unzip if required
-        if not exists(path_shp):
-            self._download_qc_administrative_boundaries()
+        Read directly from the stored zip - downloaded once and only downloaded again if it changed (checked after max_age)
+        """
 
-        assert exists(path_shp)
+        makedirs(self.data_download_path, exist_ok=True)
 
         # Read in the desired polygons
-        shp_boundary = gpd.read_file(path_shp)
+        shp_boundary = download_zip_shp(
+                url=DownloadQcAdmBoundaries.QC_PROV_ADM_BOUND_URL,
+                data_download_path=self.data_download_path,
+                member=f'Sda/version_courante/SHP/{self.geo_level}.shp',
+                max_age=self.max_age
+            )
 
         return shp_boundary
 
@@ -189,6 +196,7 @@ class DownloadQcDissolvedMunicipalities(DownloadQcAdmBoundaries):
 
         self.filter_out_unknown_muni = filter_out_unknown_muni
         self.path_cache = join(DATA_DIR, "cache", f"qc_adm_regions_MUNI_DISSOLVED_{filter_out_unknown_muni}.parquet")
+        self._get_cached_boundaries = Cache_wrapper(path_cache=self.path_cache, max_age=OPEN_DATA_MAX_AGE)(self.get_qc_administrative_boundaries_wrappee)
 
     def get_raw_data(self) -> gpd.GeoDataFrame:
         """Convenience method/synctacic sugar for subclasses.
@@ -201,8 +209,7 @@ class DownloadQcDissolvedMunicipalities(DownloadQcAdmBoundaries):
         return super().get_qc_administrative_boundaries()
 
     def get_qc_administrative_boundaries(self) -> gpd.GeoDataFrame: 
-        fun = Cache_wrapper(path_cache=self.path_cache)(self.get_qc_administrative_boundaries_wrappee)
-        return fun()
+        return self._get_cached_boundaries()
   
     def get_qc_administrative_boundaries_wrappee(self) -> gpd.GeoDataFrame:
         
@@ -289,7 +296,7 @@ class DownloadQcDissolvedAdmReg(DownloadQcAdmBoundaries):
 
             return df_mapping
 
-    @Cache_wrapper(path_cache=PATH_CACHE)
+    @Cache_wrapper(path_cache=PATH_CACHE, max_age=OPEN_DATA_MAX_AGE)
     def get_qc_administrative_boundaries(self) -> gpd.GeoDataFrame:
         """Take the ADM_REG polygons and dissolve them into the large regions we want (based on `MRS_NM_REG`)
 
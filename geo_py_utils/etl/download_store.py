@@ -0,0 +1,199 @@
+
+#Content-addressed store of raw downloads (e.g. zipped shp files from StatCan)
+#
+#   <root>/objects/<sha256 of the content><extension>   the archives, shared by all urls with the same content
+#   <root>/by_url/<sha256 of the url>.json               url -> object + http validators (ETag, Last-Modified) + last check
+
+
+import json
+import logging
+import os
+import requests
+import time
+from datetime import timedelta
+from glob import glob
+from os.path import join, isfile, splitext, basename
+from os import makedirs, remove, replace
+from typing import Union
+from urllib.parse import urlparse
+import hashlib
+
+from geo_py_utils.etl.http_download import DEFAULT_TIMEOUT, get_conditional_headers, download_file
+from geo_py_utils.misc.cache import _cache_file_lock, _is_lock_stale
+from geo_py_utils.misc.constants import DATA_DIR
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_STORE_ROOT = join(DATA_DIR, 'download_store')
+
+# Stored downloads are used without contacting the server for this long, then revalidated (ETag/Last-Modified)
+DEFAULT_STORE_MAX_AGE = timedelta(days=30)
+
+# Locks of downloads older than this (seconds) are broken
+LOCK_STALE_AFTER = 7200
+
+
+class DownloadStore:
+
+    """Content-addressed store of downloaded files
+
+    Downloads are streamed to disk and resumed after network errors (or in a later call).
+    Each url is downloaded once and kept: the next calls return the stored file and only revalidate it against the server
+    (conditional GET) after max_age. Identical contents downloaded from different urls are stored once
+
+    ```
+    store = DownloadStore()
+    path_zip = store.get('https://www12.statcan.gc.ca/.../lpr_000b21a_e.zip')
+    ```
+
+    Attributes:
+        root (str), Default[DATA_DIR/download_store]
+            Directory of the store
+        timeout (float), Default[DEFAULT_TIMEOUT]
+            Seconds to wait for the server
+        n_connections (int), Default[1]
+            Number of parallel range requests for large files (see http_download.download_file)
+    """
+
+    def __init__(self, root: str = DEFAULT_STORE_ROOT, timeout: float = DEFAULT_TIMEOUT, n_connections: int = 1):
+        self.root = root
+        self.timeout = timeout
+        self.n_connections = n_connections
+
+
+    def _get_index_path(self, url: str) -> str:
+        return join(self.root, 'by_url', f'{hashlib.sha256(url.encode()).hexdigest()}.json')
+
+
+    def _get_object_path(self, object_name: str) -> str:
+        return join(self.root, 'objects', object_name)
+
+
+    def _read_index(self, url: str) -> dict:
+        """Index entry of the url - None if it was never downloaded or its object is missing"""
+
+        try:
+            with open(self._get_index_path(url)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if index.get('url') != url or not isfile(self._get_object_path(index['object'])):
+            return None
+
+        return index
+
+
+    def _write_index(self, url: str, index: dict):
+        path_index = self._get_index_path(url)
+        makedirs(join(self.root, 'by_url'), exist_ok=True)
+        path_tmp = f'{path_index}.{os.getpid()}.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(index, f)
+        replace(path_tmp, path_index)
+
+
+    def _get_tmp_path(self, url: str) -> str:
+        """Temp object of a download in progress: same name for a url so that it can be resumed"""
+        extension = splitext(basename(urlparse(url).path))[1]
+        return join(self.root, 'objects', f'.{hashlib.sha256(url.encode()).hexdigest()}{extension}')
+
+
+    def _download(self, url: str, index: dict = None) -> dict:
+        """(Conditional) GET of the url - returns the updated index entry. Must hold the lock of the temp object"""
+
+        headers = get_conditional_headers(index) if index is not None else {}
+
+        # Unknown hash before the end of the download: download to a temp object and rename
+        extension = splitext(basename(urlparse(url).path))[1]
+        path_tmp = self._get_tmp_path(url)
+        result = download_file(url, path_tmp, headers, self.timeout, n_connections=self.n_connections)
+
+        if not result.is_modified:
+            logger.info(f'{url} not modified - using {index["object"]}')
+            return {**index, 'checked': time.time()}
+
+        object_name = f'{result.sha256}{extension}'
+        path_object = self._get_object_path(object_name)
+        replace(path_tmp, path_object)
+
+        logger.info(f'Downloaded {url} to {path_object}')
+
+        return {'url': url,
+                'object': object_name,
+                'sha256': result.sha256,
+                'size': result.size,
+                'downloaded': time.time(),
+                'checked': time.time(),
+                **result.validators}
+
+
+    def get(self, url: str, max_age: Union[float, timedelta] = DEFAULT_STORE_MAX_AGE) -> str:
+        """Path of the stored download of a url - downloaded first if required
+
+        Args:
+            url (str): url to download
+            max_age (Union[float, timedelta], optional): seconds after which the stored file is revalidated against the server
+                - 0 to always revalidate, None to never revalidate. Defaults to DEFAULT_STORE_MAX_AGE.
+
+        Returns:
+            str: path of the stored file - with the extension of the url
+        """
+
+        if isinstance(max_age, timedelta):
+            max_age = max_age.total_seconds()
+
+        def is_fresh(index: dict) -> bool:
+            return index is not None and (max_age is None or time.time() - index['checked'] <= max_age)
+
+        index = self._read_index(url)
+        if is_fresh(index):
+            return self._get_object_path(index['object'])
+
+        # Single download per url across threads and processes: they would all append to the same part file
+        makedirs(join(self.root, 'objects'), exist_ok=True)
+        with _cache_file_lock(self._get_tmp_path(url), LOCK_STALE_AFTER):
+
+            # Downloaded by another process while waiting
+            index = self._read_index(url)
+            if is_fresh(index):
+                return self._get_object_path(index['object'])
+
+            try:
+                index = self._download(url, index)
+            except requests.exceptions.RequestException as e:
+                if index is None:
+                    raise
+                logger.warning(f'Could not revalidate {url} - using the stored {index["object"]}: {e}')
+                return self._get_object_path(index['object'])
+
+            self._write_index(url, index)
+
+        return self._get_object_path(index['object'])
+
+
+    def gc(self) -> list:
+        """Remove the objects that are no longer referenced by any url (e.g. old versions) and interrupted downloads (older than 1 hour)
+
+        Returns:
+            list: paths of the removed files
+        """
+
+        set_referenced = set()
+        for path_index in glob(join(self.root, 'by_url', '*.json')):
+            try:
+                with open(path_index) as f:
+                    set_referenced.add(self._get_object_path(json.load(f)['object']))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        list_removed = []
+        list_in_progress = [p for p in glob(join(self.root, 'objects', '.*')) if time.time() - os.path.getmtime(p) < 3600]
+        # Lock of a download in progress (the lock file is not updated while downloading)
+        list_in_progress += [p for p in glob(join(self.root, 'objects', '.*.lock')) if not _is_lock_stale(p, LOCK_STALE_AFTER)]
+        for path_object in glob(join(self.root, 'objects', '*')) + glob(join(self.root, 'objects', '.*')):
+            if path_object not in set_referenced and path_object not in list_in_progress:
+                remove(path_object)
+                list_removed.append(path_object)
+
+        return list_removed
@@ -1,34 +1,106 @@
 
 import geopandas as gpd
 import logging
-from os.path import join, isdir, isfile, dirname
-from os import makedirs, remove
+import re
+from datetime import timedelta
+from os.path import join, isdir
+from os import rename, getpid
 from pathlib import Path
-import requests
 from shutil import rmtree
 from typing import Union
 import zipfile
 
+from geo_py_utils.etl.download_store import DownloadStore, DEFAULT_STORE_MAX_AGE
+from geo_py_utils.etl.geo_io import read_geo_file
 from geo_py_utils.misc.constants import DATA_DIR
 
 logger = logging.getLogger(__file__)
 
 DEFAULT_DATA_DOWNLOAD_PATH = DATA_DIR
+DOWNLOAD_STORE_DIR = 'download_store'
+
+
+def _extract_zip(path_zip: str, path_unzipped: str):
+    """Extract to a temp dir then swap it with the existing dir: readers never see a partially extracted dir"""
+
+    path_tmp = f'{path_unzipped}.{getpid()}.tmp'
+    with zipfile.ZipFile(path_zip, 'r') as zip_ref:
+        zip_ref.extractall(path_tmp)
+
+    if isdir(path_unzipped):
+        path_old = f'{path_unzipped}.{getpid()}.old'
+        rename(path_unzipped, path_old)
+        rename(path_tmp, path_unzipped)
+        rmtree(path_old, ignore_errors=True)
+    else:
+        rename(path_tmp, path_unzipped)
+
+
+def get_zip_member(path_zip: str, extension: str = ".shp", member: str = None) -> str:
+    """Name of the geo file to read in a zip
+
+    Args:
+        path_zip (str): path of the zip file
+        extension (str, optional): extension of the geo file. Defaults to ".shp".
+        member (str, optional): name (or end of the path) of the file in the zip - useful when there are many files with the extension. Defaults to None.
+
+    Raises:
+        RuntimeError: if there is not exactly one matching file
+
+    Returns:
+        str: path of the file in the zip
+    """
+
+    with zipfile.ZipFile(path_zip, 'r') as zip_ref:
+        list_names = zip_ref.namelist()
+
+    if member is not None:
+        list_potential_files = [n for n in list_names if n == member or n.endswith(f'/{member}')]
+    else:
+        list_potential_files = [n for n in list_names if n.lower().endswith(extension.lower())]
+
+    if len(list_potential_files) == 0 : raise RuntimeError(f'No {member or extension} file in {path_zip}!')
+    if len(list_potential_files) > 1 : raise RuntimeError(f'More than one {member or extension} in {path_zip}: cannot determine which to read!')
+
+    return list_potential_files[0]
 
 
 def download_zip_shp(url: str,
                      data_download_path: str = DEFAULT_DATA_DOWNLOAD_PATH,
                      return_shp_file: bool = True,
-                     extension: str = ".shp") -> Union[gpd.GeoDataFrame, None]:
+                     extension: str = ".shp",
+                     member: str = None,
+                     max_age: Union[float, timedelta] = DEFAULT_STORE_MAX_AGE,
+                     n_connections: int = 1,
+                     columns: list = None,
+                     where: str = None,
+                     bbox: tuple = None,
+                     mask = None) -> Union[gpd.GeoDataFrame, None]:
     """ Download a zipped shp file from a url + save results.
 
     Only meant to work with zipped shp files, for geojson just read in using .read_file()
 
+    The zip is kept in a content-addressed store (data_download_path/download_store, see DownloadStore) and read directly with GDAL /vsizip/ without extracting it.
+    Next calls only download it again if it changed (ETag/Last-Modified checked after max_age)
+
+    columns, where, bbox and mask are pushed down to the reader (pyogrio, with arrow if available - see geo_io): the other fields and features are never decoded.
+    Much faster than reading the Canada-wide StatCan files and filtering afterwards, e.g.
+    ```
+    shp_das_qc = download_zip_shp(url_das, where="PRUID = '24'", columns=['DAUID'])
+    ```
+
     Args:
         url (str): url 
         data_download_path (str, optional): path to save the zipped file. Defaults to DEFAULT_DATA_DOWNLOAD_PATH.
-        return_shp_file (bool, optional): if false, only downloads the zip file to disk
+        return_shp_file (bool, optional): if false, only unzips the file to data_download_path/<zip name>
         extension (str, optional): extension of geo file to look for. Should be readable by `geopandas.read_file()`  
+        member (str, optional): name (or end of the path) of the geo file in the zip when there are many. Defaults to None.
+        max_age (Union[float, timedelta], optional): seconds after which the stored zip is revalidated against the server. Defaults to DEFAULT_STORE_MAX_AGE.
+        n_connections (int, optional): number of parallel range requests for large zips. Defaults to 1.
+        columns (list, optional): fields to read (the geometry is always read). Defaults to None (all).
+        where (str, optional): OGR SQL attribute filter e.g. "PRUID = '24'" or "DAUID LIKE '24%'". Defaults to None.
+        bbox (tuple, optional): (xmin, ymin, xmax, ymax) in the crs of the file - only the intersecting features are read. Defaults to None.
+        mask (optional): shapely geometry in the crs of the file - only the intersecting features are read. Defaults to None.
     Returns:
         gpd.GeoDataFrame: geopandas df
     """
@@ -42,41 +114,26 @@ def download_zip_shp(url: str,
     if extension is None or len(extension) < 2 or '.' not in extension: raise ValueError('Error with extension!')
     if len(file_download) == 0 : raise ValueError('Error with url!')
 
-    # Download and unzip as required 
-    ## Set the download path 
-    path_data_dir_unzipped = join(data_download_path, file_download)  # path after unzipping 
-    path_data_dir_zip = path_data_dir_unzipped + ".zip" # path of zipped file e.g. ../data/lpr_000a21a_e.zip
-
-    if not isdir(path_data_dir_unzipped):
-        response= requests.get(url)
-        makedirs(dirname(path_data_dir_unzipped), exist_ok=True)
-
-        with open(path_data_dir_zip, "wb") as f:
-            f.write(response.content)
-
-        with zipfile.ZipFile(path_data_dir_zip, 'r') as zip_ref:
-            zip_ref.extractall(path_data_dir_unzipped)
+    # Download (or reuse) the zip
+    path_zip = DownloadStore(join(data_download_path, DOWNLOAD_STORE_DIR), n_connections=n_connections).get(url, max_age=max_age)
 
     # Only unzip
     if not return_shp_file:
+        path_data_dir_unzipped = join(data_download_path, file_download)  # path after unzipping 
         logger.warning(f"Only unzipping file to {path_data_dir_unzipped}")
+        _extract_zip(path_zip, path_data_dir_unzipped)
         return None
 
-    # Look for geo file 
-    try:
+    # GDAL ignores the fields that are not read when evaluating where (no feature matches): also read the names used in the filter - unknown names are skipped by the reader
+    columns_read = columns
+    if columns is not None and where is not None:
+        columns_read = list(columns) + [n for n in re.findall(r'[A-Za-z_]\w*', re.sub(r"'[^']*'", '', where)) if n not in columns]
 
-        # Automatically look for geo files with the desired extension in the unzipped dir
-        list_potential_files = list(Path(path_data_dir_unzipped).glob(f'**/*{extension}'))
-        if len(list_potential_files) == 0 : raise RuntimeError('No files in unzipped dir!')
-        if len(list_potential_files) > 1 : raise RuntimeError(f'More than one {extension} in dir: cannot determine which to read!')
+    # Read the unique geo file directly from the zip - only pass the filters that are used (bbox and mask are exclusive)
+    kwargs_filters = {k: v for k, v in {'columns': columns_read, 'where': where, 'bbox': bbox, 'mask': mask}.items() if v is not None}
+    shp = read_geo_file(f'/vsizip/{path_zip}/{get_zip_member(path_zip, extension, member)}', **kwargs_filters)
 
-        # Read the unique geo file
-        shp = gpd.read_file( list_potential_files[0])
-
-    finally:
-        if isfile(path_data_dir_zip): remove(path_data_dir_zip)
-        if isdir(path_data_dir_unzipped): rmtree(path_data_dir_unzipped)
+    if columns is not None:
+        shp = shp[[c for c in columns if c in shp.columns] + [shp.geometry.name]]
 
     return shp
-
-
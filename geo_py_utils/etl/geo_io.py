@@ -0,0 +1,143 @@
+""" Read and write vector files (shp, gpkg, geojson, ...) with the fastest engine available
+
+pyogrio with arrow (GDAL >= 3.6 to read, >= 3.8 to write + pyarrow) avoids building python objects per feature.
+Falls back on pyogrio without arrow, then on the default engine of geopandas (e.g. fiona)
+
+    python -m geo_py_utils.etl.geo_io  # benchmark of the drivers
+"""
+
+import geopandas as gpd
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+import tempfile
+import time
+from glob import glob, escape
+from os.path import join, getsize, splitext
+from shutil import rmtree
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+logger = logging.getLogger(__file__)
+
+GDAL_VERSION = pyogrio.__gdal_version__ if pyogrio is not None else None
+CAN_READ_ARROW = pyogrio is not None and pyarrow is not None and GDAL_VERSION >= (3, 6, 0)
+CAN_WRITE_ARROW = CAN_READ_ARROW and GDAL_VERSION >= (3, 8, 0)
+
+BENCHMARK_DRIVERS = {'ESRI Shapefile': '.shp', 'GPKG': '.gpkg', 'GeoJSON': '.geojson'}
+
+
+def _get_engine_kwargs(use_arrow: bool, can_use_arrow: bool) -> dict:
+    """Engine arguments of gpd.read_file/to_file - use_arrow None means arrow if available"""
+
+    if pyogrio is None:
+        if use_arrow:
+            raise ImportError('pyogrio is required to use arrow')
+        return {}
+
+    if use_arrow and not can_use_arrow:
+        raise ImportError(f'Arrow I/O requires pyarrow and a more recent GDAL (found {GDAL_VERSION})')
+
+    return {'engine': 'pyogrio', 'use_arrow': can_use_arrow if use_arrow is None else use_arrow}
+
+
+def read_geo_file(path: str, use_arrow: bool = None, **kwargs) -> gpd.GeoDataFrame:
+    """Read a vector file (any path readable by GDAL e.g. /vsizip/bla.zip/bla.shp or a url)
+
+    Args:
+        path (str): file to read
+        use_arrow (bool, optional): read through arrow - None to use it if available. Defaults to None.
+        kwargs: see gpd.read_file e.g. columns, where, bbox, mask, layer
+
+    Returns:
+        gpd.GeoDataFrame: content of the file
+    """
+
+    return gpd.read_file(path, **_get_engine_kwargs(use_arrow, CAN_READ_ARROW), **kwargs)
+
+
+def write_geo_file(shp: gpd.GeoDataFrame, path: str, driver: str = None, use_arrow: bool = None, **kwargs):
+    """Write a GeoDataFrame to a vector file
+
+    Args:
+        shp (gpd.GeoDataFrame): data to write
+        path (str): destination - the driver is inferred from the extension if None
+        driver (str, optional): GDAL driver e.g. 'GPKG'. Defaults to None.
+        use_arrow (bool, optional): write through arrow - None to use it if available. Defaults to None.
+        kwargs: see gpd.GeoDataFrame.to_file e.g. layer, mode
+    """
+
+    shp.to_file(path, driver=driver, **_get_engine_kwargs(use_arrow, CAN_WRITE_ARROW), **kwargs)
+
+
+def _get_size(path: str) -> int:
+    """Size of a file with its sidecars (shp, dbf, shx, ...)"""
+    return sum(getsize(p) for p in glob(escape(splitext(path)[0]) + '.*'))
+
+
+def benchmark_geo_io(num_features: int = 100000,
+                     drivers: dict = BENCHMARK_DRIVERS,
+                     seed: int = 1) -> pd.DataFrame:
+    """Throughput of read_geo_file and write_geo_file with and without arrow for each driver
+
+    Random polygons (octagons) with a string, an int and a float column
+
+    Args:
+        num_features (int, optional): number of features written and read. Defaults to 100000.
+        drivers (dict, optional): GDAL driver -> extension. Defaults to BENCHMARK_DRIVERS (shp, gpkg and geojson).
+        seed (int, optional): random seed. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: driver, direction (read/write), use_arrow, seconds, features_per_s, mb_per_s (size of the file)
+    """
+
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(0, 1e6, (2, num_features))
+    shp = gpd.GeoDataFrame({'id': np.arange(num_features),
+                            'name': [f'feature_{i}' for i in range(num_features)],
+                            'value': rng.random(num_features)},
+                           geometry=shapely.buffer(shapely.points(x, y), 50, quad_segs=2),
+                           crs=3347)
+
+    list_use_arrow = ([False, True] if CAN_READ_ARROW else [False]) if pyogrio is not None else [None]
+
+    list_results = []
+    dir_tmp = tempfile.mkdtemp()
+    try:
+        for driver, extension in drivers.items():
+            for use_arrow in list_use_arrow:
+                path = join(dir_tmp, f'{driver.replace(" ", "_")}_{use_arrow}{extension}')
+
+                # Arrow writes might not be supported (older GDAL): read the file written without arrow
+                use_arrow_write = use_arrow and CAN_WRITE_ARROW
+                start = time.perf_counter()
+                write_geo_file(shp, path, driver, use_arrow_write)
+                list_results.append({'driver': driver, 'direction': 'write', 'use_arrow': use_arrow_write, 'seconds': time.perf_counter() - start})
+
+                start = time.perf_counter()
+                shp_read = read_geo_file(path, use_arrow)
+                list_results.append({'driver': driver, 'direction': 'read', 'use_arrow': use_arrow, 'seconds': time.perf_counter() - start})
+                assert shp_read.shape[0] == num_features
+
+                size = _get_size(path)
+                for result in list_results[-2:]:
+                    result['features_per_s'] = num_features / result['seconds']
+                    result['mb_per_s'] = size / 1e6 / result['seconds']
+    finally:
+        rmtree(dir_tmp, ignore_errors=True)
+
+    return pd.DataFrame(list_results)
+
+
+if __name__ == '__main__':
+    print(benchmark_geo_io().to_string())
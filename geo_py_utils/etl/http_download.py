@@ -0,0 +1,299 @@
+
+import hashlib
+import json
+import logging
+import os
+import requests
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob, escape
+from os.path import dirname, isfile, getsize
+from os import makedirs
+from shutil import copyfileobj
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_TIMEOUT = 60
+PART_EXT = '.part'
+# Bytes of an interrupted chunk are lost: small enough to resume close to the failure
+CHUNK_SIZE = 2**16
+
+# Network errors after which a download is resumed
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout)
+
+DownloadResult = namedtuple('DownloadResult', ['is_modified', 'validators', 'sha256', 'size'])
+
+
+class ResourceChangedError(RuntimeError):
+    """A range request was not answered with 206: the resource changed (If-Range) or ranges are not supported"""
+
+
+def get_validators(response: requests.Response) -> dict:
+    """ETag and Last-Modified headers of a response"""
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def get_conditional_headers(validators: dict) -> dict:
+    """If-None-Match / If-Modified-Since headers from the validators of a previous response (see get_validators)"""
+
+    headers = {}
+    if validators.get('etag') is not None:
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified') is not None:
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    return headers
+
+
+def _get_if_range(validators: dict) -> str:
+    """Validator sent with If-Range: ranges are only served if the resource did not change - None if resuming is unsafe"""
+
+    # Weak etags cannot be used with If-Range
+    if validators.get('etag') is not None and not validators['etag'].startswith('W/'):
+        return validators['etag']
+    return validators.get('last_modified')
+
+
+
+class _Progress:
+
+    """Thread safe progress/throughput logging of a download - at most every interval seconds"""
+
+    def __init__(self, url: str, total: int = None, done: int = 0, interval: float = 10):
+        self.url = url
+        self.total = total
+        self.done = done
+        self.done_start = done
+        self.interval = interval
+        self.start = self.last_log = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, n: int):
+        with self.lock:
+            self.done += n
+            if time.time() - self.last_log >= self.interval:
+                self.last_log = time.time()
+                logger.info(self.message())
+
+    def message(self) -> str:
+        throughput = (self.done - self.done_start) / max(time.time() - self.start, 1e-9) / 1e6
+        total = f'/{self.total / 1e6:.1f} MB ({100 * self.done / max(self.total, 1):.0f}%)' if self.total is not None else ' MB'
+        return f'{self.url}: {self.done / 1e6:.1f}{total} - {throughput:.1f} MB/s'
+
+
+
+def _download_range(url: str,
+                    path_part: str,
+                    start: int,
+                    end: int,
+                    if_range: str,
+                    progress: _Progress,
+                    session: requests.Session,
+                    timeout: float,
+                    max_retries: int,
+                    retry_wait: float):
+    """Download bytes start-end (inclusive) of a url to path_part, resuming from the size of path_part after network errors"""
+
+    for attempt in range(max_retries + 1):
+        offset = start + (getsize(path_part) if isfile(path_part) else 0)
+        if offset > end:
+            return
+
+        try:
+            headers = {'Range': f'bytes={offset}-{end}', 'If-Range': if_range}
+            with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code != 206:
+                    raise ResourceChangedError(f'Range request of {url} answered with {response.status_code} - the resource changed or ranges are not supported')
+                with open(path_part, 'ab') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        progress.update(len(chunk))
+            return
+        except RETRY_EXCEPTIONS as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f'Download of {url} interrupted ({e}) - resuming ({attempt + 1}/{max_retries})')
+            time.sleep(retry_wait * 2**attempt)
+
+
+def _download_ranges(url: str,
+                     path_part: str,
+                     list_ranges: list,
+                     if_range: str,
+                     progress: _Progress,
+                     session: requests.Session,
+                     timeout: float,
+                     max_retries: int,
+                     retry_wait: float):
+    """Download the (start, end) ranges in parallel to <path_part>0..N (each resumed from its size), then concatenate them to path_part"""
+
+    list_parts = [f'{path_part}{k}' for k in range(len(list_ranges))]
+    with ThreadPoolExecutor(len(list_ranges)) as executor:
+        list_futures = [executor.submit(_download_range, url, path_range, start, end, if_range,
+                                        progress, session, timeout, max_retries, retry_wait)
+                        for path_range, (start, end) in zip(list_parts, list_ranges)]
+        for future in list_futures:
+            future.result()
+
+    with open(path_part, 'wb') as f:
+        for path in list_parts:
+            with open(path, 'rb') as f_range:
+                copyfileobj(f_range, f, CHUNK_SIZE)
+
+    for path in list_parts:
+        os.remove(path)
+
+
+def _remove_part_files(path_part: str):
+    for path in [path_part, path_part + '.json', *glob(escape(path_part) + '[0-9]*')]:
+        if isfile(path): os.remove(path)
+
+
+def download_file(url: str,
+                  path_download: str,
+                  headers: dict = None,
+                  timeout: float = DEFAULT_TIMEOUT,
+                  session: requests.Session = None,
+                  max_retries: int = 5,
+                  retry_wait: float = 1,
+                  n_connections: int = 1,
+                  min_size_parallel: int = 64 * 2**20,
+                  progress_interval: float = 10) -> DownloadResult:
+    """Stream a url to a file with bounded memory, resuming interrupted downloads
+
+    - chunks are written to <path_download>.part (validators of the response in <path_download>.part.json) and the file is renamed once complete
+    - after a network error, or in a later call if the process died, the download resumes from the size of the part file with a Range request.
+      If-Range makes sure the bytes come from the same version of the resource, otherwise it starts over
+    - with n_connections > 1, large files (min_size_parallel bytes) served with Accept-Ranges are downloaded as n_connections parallel ranges
+      (<path_download>.part0..N): each range is resumed the same way, also in a later call
+    - progress and throughput are logged every progress_interval seconds
+
+    Args:
+        url (str): url to download
+        path_download (str): destination file
+        headers (dict, optional): additional headers e.g. conditional headers (see get_conditional_headers). Defaults to None.
+        timeout (float, optional): seconds to wait for the server. Defaults to DEFAULT_TIMEOUT.
+        session (requests.Session, optional): session to reuse connections. Defaults to None.
+        max_retries (int, optional): number of resumes after network errors (per range). Defaults to 5.
+        retry_wait (float, optional): seconds before the first resume - doubled after each one. Defaults to 1.
+        n_connections (int, optional): number of parallel range requests for large files. Defaults to 1.
+        min_size_parallel (int, optional): min size in bytes to use parallel range requests. Defaults to 64MB.
+        progress_interval (float, optional): seconds between progress logs. Defaults to 10.
+
+    Returns:
+        DownloadResult: is_modified (False if the server answered 304 to conditional headers), validators (etag, last_modified), sha256 and size of the file
+    """
+
+    session = session or requests.Session()
+    makedirs(dirname(path_download) or '.', exist_ok=True)
+
+    path_part = path_download + PART_EXT
+    path_part_info = path_part + '.json'
+
+    # Validators of the response that started the part file(s): required to resume safely
+    try:
+        with open(path_part_info) as f:
+            part_info = json.load(f)
+        if part_info['url'] != url or _get_if_range(part_info) is None or not (isfile(path_part) or 'ranges' in part_info):
+            raise ValueError(f'Cannot resume {path_part}')
+    except (OSError, ValueError, KeyError):
+        part_info = None
+        _remove_part_files(path_part)
+
+    # Interrupted parallel download: resume each range
+    if part_info is not None and 'ranges' in part_info:
+        total = part_info['total']
+        done = sum(getsize(f'{path_part}{k}') for k in range(len(part_info['ranges'])) if isfile(f'{path_part}{k}'))
+        logger.info(f'Resuming the parallel download of {url} from {done} bytes')
+        progress = _Progress(url, total, done, progress_interval)
+        try:
+            _download_ranges(url, path_part, part_info['ranges'], _get_if_range(part_info), progress, session, timeout, max_retries, retry_wait)
+        except ResourceChangedError:
+            logger.info(f'{url} changed since the interrupted download - starting over')
+            _remove_part_files(path_part)
+            return download_file(url, path_download, headers, timeout, session, max_retries, retry_wait, n_connections, min_size_parallel, progress_interval)
+        return _complete_download(url, path_download, path_part, {k: part_info.get(k) for k in ['etag', 'last_modified']}, total, progress)
+
+    headers_request = dict(headers or {})
+    offset = getsize(path_part) if part_info is not None else 0
+    if offset > 0:
+        headers_request.update({'Range': f'bytes={offset}-', 'If-Range': _get_if_range(part_info)})
+
+    with session.get(url, headers=headers_request, timeout=timeout, stream=True) as response:
+
+        if response.status_code == 304:
+            return DownloadResult(False, get_validators(response), None, None)
+
+        if response.status_code == 416:
+            # Part file as large as the resource: start over
+            _remove_part_files(path_part)
+            return download_file(url, path_download, headers, timeout, session, max_retries, retry_wait, n_connections, min_size_parallel, progress_interval)
+
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            validators = {k: part_info.get(k) for k in ['etag', 'last_modified']}
+            content_range = response.headers.get('Content-Range', '')
+            total = int(content_range.split('/')[-1]) if content_range.split('/')[-1].isdigit() else None
+            logger.info(f'Resuming the download of {url} from byte {offset}')
+        else:
+            # Full content (new download or the resource changed): new part file
+            _remove_part_files(path_part)
+            offset = 0
+            validators = get_validators(response)
+            total = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+            with open(path_part_info, 'w') as f:
+                json.dump({'url': url, **validators}, f)
+
+        progress = _Progress(url, total, offset, progress_interval)
+        if_range = _get_if_range(validators)
+
+        is_parallel = n_connections > 1 and offset == 0 and total is not None and total >= min_size_parallel \
+            and response.headers.get('Accept-Ranges') == 'bytes' and if_range is not None
+
+        if is_parallel:
+            # Ranges saved with the validators so that a later call can resume them
+            bounds = [total * k // n_connections for k in range(n_connections + 1)]
+            list_ranges = [(bounds[k], bounds[k + 1] - 1) for k in range(n_connections)]
+            with open(path_part_info, 'w') as f:
+                json.dump({'url': url, **validators, 'ranges': list_ranges, 'total': total}, f)
+        else:
+            try:
+                with open(path_part, 'ab') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        progress.update(len(chunk))
+            except RETRY_EXCEPTIONS as e:
+                if max_retries == 0 or if_range is None or total is None:
+                    raise
+                logger.warning(f'Download of {url} interrupted ({e}) - resuming')
+                time.sleep(retry_wait)
+                _download_range(url, path_part, 0, total - 1, if_range, progress, session, timeout, max_retries - 1, retry_wait)
+
+    if is_parallel:
+        _download_ranges(url, path_part, list_ranges, if_range, progress, session, timeout, max_retries, retry_wait)
+
+    return _complete_download(url, path_download, path_part, validators, total, progress)
+
+
+def _complete_download(url: str, path_download: str, path_part: str, validators: dict, total: int, progress: _Progress) -> DownloadResult:
+    """Check the size of the part file, hash it and move it to path_download"""
+
+    size = getsize(path_part)
+    if total is not None and size != total:
+        raise RuntimeError(f'Incomplete download of {url}: {size} bytes instead of {total}')
+
+    # Hash of the complete file since the download might have been resumed
+    sha256 = hashlib.sha256()
+    with open(path_part, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    os.replace(path_part, path_download)
+    os.remove(path_part + '.json')
+
+    logger.info(progress.message())
+
+    return DownloadResult(True, validators, sha256.hexdigest(), size)
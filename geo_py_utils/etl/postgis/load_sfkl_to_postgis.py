@@ -5,6 +5,7 @@ import geopandas as gpd
  
 from geo_py_utils.misc.constants import DATA_DIR
 from geo_py_utils.etl.db_etl import Url_to_postgis
+from geo_py_utils.etl.geo_io import write_geo_file
 from geo_py_utils.etl.snowflake.snowflake_connect import connnect_snowflake_ext_browser
 from geo_py_utils.etl.snowflake.snowflake_read import sfkl_to_gpd
  
@@ -107,7 +108,7 @@ class LoadSfklPostgis:
             shp_role_cleaned = self._extract_from_sfkl()
 
             # Write to disk
-            shp_role_cleaned.to_file(path_shp_file)
+            write_geo_file(shp_role_cleaned, path_shp_file)
 
         # Call ogr2ogr
         postgis_etl =  Url_to_postgis(
@@ -13,6 +13,7 @@ from geo_py_utils.etl.spatialite.db_utils import  get_table_rows, get_table_crs
 from geo_py_utils.etl.spatialite.gdf_load import spatialite_db_to_gdf
 from geo_py_utils.geo_general.geohash_utils import  recursively_partition_geohash_cells
 from geo_py_utils.etl.db_etl import Url_to_spatialite
+from geo_py_utils.etl.geo_io import write_geo_file
 from geo_py_utils.misc.constants import DATA_DIR
 
 
@@ -378,7 +379,7 @@ class ParallelSpatialJoin:
         dir_dict = join(DATA_DIR, self.tbl_new_name)
         if not exists(dir_dict): makedirs(dir_dict)
         path_shp_file = join(dir_dict, f"{self.tbl_new_name}.shp")
-        shp_results[[self.left_geo_id,self.right_geo_id, 'GEOMETRY']].to_file(path_shp_file, mode='w')  #overwrite each time
+        write_geo_file(shp_results[[self.left_geo_id,self.right_geo_id, 'GEOMETRY']], path_shp_file, mode='w')  #overwrite each time
 
         # Upload to Db
         with Url_to_spatialite(
@@ -1,48 +1,80 @@
 from warnings import warn
 import numpy as np
 import geopandas as gpd
-import pandas as pd
+from pyproj import Transformer
+import shapely
 
 
 
-def add_centroid(shp: gpd.GeoDataFrame, col_names:list =['lng','lat']) ->  gpd.GeoDataFrame:
+def add_centroid(shp: gpd.GeoDataFrame,
+                 col_names:list =['lng','lat'],
+                 inplace: bool = False,
+                 centroid_crs = None,
+                 method: str = 'centroid') ->  gpd.GeoDataFrame:
 
     """Add the centroid for each of the features in a geodataframe
 
+    Centroid coordinates are computed with vectorized shapely functions and assigned as 2 float columns: the index is preserved
+
+    Centroids computed in degrees (e.g. 4326) are slightly off: use `centroid_crs` to compute them in a projected crs instead.
+    Only the geometry is reprojected and the centroids are transformed back to the crs of shp, so the columns are still lng/lat for a geographic shp.
+
     Args:
-        list_coordinates (geoseries): geoseries - eg. shp['geometry]
+        shp (gpd.GeoDataFrame): geodataframe
+        col_names (list): names of the x and y columns. Defaults to ['lng','lat'].
+        inplace (bool): add the columns to shp directly rather than to a shallow copy. Defaults to False.
+        centroid_crs (optional): crs used to compute the centroids (e.g. 3857 or 32198). Defaults to None (use the crs of shp).
+        method (str): 'centroid' or 'representative_point' - a point guaranteed to lie within each polygon,
+            insensitive to the crs so it does not require centroid_crs. Defaults to 'centroid'.
 
     Returns:
-        np.array: array with number of vertices per feature/row/polygon
+        gpd.GeoDataFrame: geodataframe with the 2 new centroid columns
     """
 
-    assert col_names is not None and len(col_names) > 0
+    assert col_names is not None and len(col_names) == 2
+    assert method in ['centroid', 'representative_point'], \
+        f'Fatal error in add_centroid! method should be centroid or representative_point, not {method}'
 
-    if np.isin(['lat', 'lng'],shp.columns).all() :
+    if all(c in shp.columns for c in col_names):
         col_names_str = ",".join(col_names)
         warn(f'Warning in add_centroid" {col_names_str} columns already exist')
         return shp
 
-    df_centroids = pd.DataFrame( [ (p.x,p.y) for p in shp.geometry.centroid])
-    df_centroids.rename(columns= {0: col_names[0], 1: col_names[1]}, inplace=True)
+    geometries = shp.geometry
+    if centroid_crs is not None:
+        geometries = geometries.to_crs(centroid_crs)
+    geometries = np.asarray(geometries.values)
+
+    # Points are their own centroid
+    if not np.all(shapely.get_type_id(geometries) == 0):
+        geometries = shapely.centroid(geometries) if method == 'centroid' else shapely.point_on_surface(geometries)
+
+    x, y = shapely.get_x(geometries), shapely.get_y(geometries)
+
+    # Back to the initial crs: only 2 float arrays to transform
+    if centroid_crs is not None:
+        transformer = Transformer.from_crs(centroid_crs, shp.crs, always_xy=True)
+        x, y = transformer.transform(x, y)
 
-    # Watch out with the indexing - can create some weird bugs
-    shp = pd.concat([shp.reset_index(), df_centroids.reset_index(drop=True)],axis=1) 
+    # Shallow copy: only the 2 new columns are allocated
+    if not inplace:
+        shp = shp.copy(deep=False)
 
-    # Remove duplicate columns - might be cause by the concat
-    shp = shp.loc[:, ~shp.columns.duplicated() ].copy()
+    shp[col_names[0]] = x
+    shp[col_names[1]] = y
 
     return shp
 
 
 
 
-def get_centroid_gpd(shp: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+def get_centroid_gpd(shp: gpd.GeoDataFrame, **centroid_kwargs) -> gpd.GeoDataFrame:
     """From a geodataframe replace the e.g. Polygon geometry with Point geometry representing the centroid of each simple feature 
 
  
     Args:
         shp (gpd.GeoDataFrame): geodataframe to use 
+        centroid_kwargs: passed to add_centroid - e.g. centroid_crs or method
 
     Returns:
         gpd.GeoDataFrame: geodataframe with POINT geometry
@@ -52,14 +84,15 @@ def get_centroid_gpd(shp: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         warn('Warning! the geodfs geometry is already point: not oing anything')
         return shp
 
-    df_with_lat_lng = add_centroid(shp)
+    df_with_lat_lng = add_centroid(shp, **centroid_kwargs)
 
     if 'geometry' in df_with_lat_lng.columns:
         df_with_lat_lng.drop(columns='geometry',inplace=True)
 
     shp_centroid = gpd.GeoDataFrame( 
         df_with_lat_lng,
-        geometry = gpd.points_from_xy(df_with_lat_lng.lng, df_with_lat_lng.lat)
+        geometry = gpd.points_from_xy(df_with_lat_lng.lng, df_with_lat_lng.lat),
+        crs = shp.crs
     )
 
     return shp_centroid
\ No newline at end of file
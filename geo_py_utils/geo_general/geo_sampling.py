@@ -1,21 +1,25 @@
 from scipy.stats.qmc import Sobol
+from multiprocessing import Pool
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from math import ceil
+import shapely
+from pyproj import Transformer
+from math import ceil, sqrt
+from typing import Callable, Union
 
 def generate_random_points_over_extent(shp: gpd.GeoDataFrame,
                                        num_points_to_gen: int ,
                                        method: str ='grid',
                                        **kwargs) -> gpd.GeoDataFrame:
-    """Generate random points from a geodataframe extent 
+    """Generate random points from a geodataframe extent
 
     Dispatch based on method choose from ['sobol','grid']
 
     Args:
         method (str): method to use for sampling
         Depending on method, see
-         generate_random_points_over_extent_sobolo or 
+         generate_random_points_over_extent_sobolo or
          generate_random_points_over_extent_grid method definition
 
     Returns:
@@ -31,113 +35,285 @@ def generate_random_points_over_extent(shp: gpd.GeoDataFrame,
     return shp
 
 
-def generate_random_points_over_extent_grid(shp: gpd.GeoDataFrame, num_points_to_gen, crs=None) -> gpd.GeoDataFrame:
-    """Generate random points from a geodataframe extent in a grid-lie fashion
+def _generate_random_points(shp: gpd.GeoDataFrame,
+                            num_points_to_gen: int,
+                            sample_0_1: Callable[[int, np.ndarray], np.ndarray],
+                            crs=None,
+                            within_geometry: bool = False,
+                            batch_size: int = 1000000) -> gpd.GeoDataFrame:
+    """Map points sampled in [0,1)^2 to the projected bounding box and optionally only keep those inside the geometries
 
-    Samples point according to the shape of the boundinx box (proportional to each side's length)
+    Rejection sampling: batches of candidates are drawn until there are enough points within the geometries.
+    The batch size is based on the ratio of the geometries' area to the bounding box area
 
     Args:
         shp (gpd.GeoDataFrame): _description_
-        num_points_to_gen (_type_): _description_
-        crs (_type_, optional): _description_. Defaults to None.
+        num_points_to_gen (int): _description_
+        sample_0_1 (Callable[[int, np.ndarray], np.ndarray]): function of (n, bbox width and height) returning a (n, 2) array of points in [0,1)^2
+        crs (_type_, optional): projected crs used for sampling. Defaults to None (3857).
+        within_geometry (bool, optional): only keep points within the (multi)polygons of shp, not just the bounding box. Defaults to False.
+        batch_size (int, optional): max number of candidates drawn at once - bounds the memory. Defaults to 1000000.
 
     Returns:
-        gpd.GeoDataFrame: _description_
+        gpd.GeoDataFrame: sampled POINT geodataframe with the projected x, y coordinates
     """
     crs_init = shp.crs
-    crs_used = 3857 if crs is None else crs_init
+    crs_used = 3857 if crs is None else crs
     shp_proj = shp.to_crs(crs_used)
 
     # Project and get bounding box
     west, south, east, north = shp_proj.total_bounds
+    origin = np.array([west, south])
+    size = np.array([east - west, north - south])
 
-    max_side = max((north - south), (east - west))
-    min_side = min((north - south), (east - west))
-
-    if (north - south) > (east - west):
-        ratio_north_south = max_side / (max_side + min_side)
-        ratio_east_west = 1 - ratio_north_south
+    if not within_geometry:
+        mat_pos = origin + sample_0_1(num_points_to_gen, size) * size
     else:
-        ratio_north_south = 1 - (max_side / (max_side + min_side))
-        ratio_east_west = 1 - ratio_north_south
+        geometries = np.asarray(shp_proj.geometry.values)
+
+        # Upper bound of the union area: only used to pick the number of candidates
+        area = min(shapely.area(geometries).sum(), size.prod())
+        if area <= 0:
+            raise ValueError('Fatal error! cannot sample within geometries with no area - use polygons or within_geometry=False')
+
+        # Bounding box query with the tree + contains on the prepared geometries is faster than query(..., predicate='within')
+        shapely.prepare(geometries)
+        tree = shapely.STRtree(geometries)
+        acceptance_rate = area / size.prod()
+
+        list_pos = []
+        num_accepted = 0
+        while num_accepted < num_points_to_gen:
+            num_candidates = min(batch_size, ceil(1.1 * (num_points_to_gen - num_accepted) / acceptance_rate))
+            mat_candidates = origin + sample_0_1(num_candidates, size) * size
+            candidates = shapely.points(mat_candidates)
+
+            idx_candidates, idx_geometries = tree.query(candidates)
+            is_within = shapely.contains(geometries[idx_geometries], candidates[idx_candidates])
 
-    # Generate random points over grid
-    # We will multiply these and we can get more than num_points_to_gen because of ceil
-    # Truncate at the end
-    num_north_south = ceil(num_points_to_gen * ratio_north_south)
-    num_east_west = ceil(num_points_to_gen * ratio_east_west)
+            # Points within at least one geometry - keep the sampling order
+            is_candidate_within = np.zeros(num_candidates, dtype=bool)
+            is_candidate_within[idx_candidates[is_within]] = True
 
-    northing_rand_pos = south + \
-        np.random.uniform(size=(num_north_south)) * (north-south)
-    easting_rand_pos = west + \
-        np.random.uniform(size=(num_east_west)) * (east-west)
+            list_pos.append(mat_candidates[is_candidate_within])
+            num_accepted += list_pos[-1].shape[0]
 
-    # Full join to recover grid
-    df_pos_north = pd.DataFrame(
-        {"y": northing_rand_pos, "dummy": np.ones_like(northing_rand_pos)})
-    df_pos_east = pd.DataFrame(
-        {"x": easting_rand_pos, "dummy": np.ones_like(easting_rand_pos)})
+        mat_pos = np.concatenate(list_pos)[:num_points_to_gen]
 
-    df_pos = pd.merge(df_pos_east, df_pos_north, on='dummy', how='outer')
+    # Transform the coordinates back to the initial crs before creating the points: cheaper than to_crs on the points
+    transformer = Transformer.from_crs(crs_used, crs_init, always_xy=True)
+    x, y = transformer.transform(mat_pos[:, 0], mat_pos[:, 1])
 
     # Convert to geodaframe and return
     shp_pos = gpd.GeoDataFrame(
-        df_pos,
-        geometry=gpd.points_from_xy(
-            x=df_pos.x, y=df_pos.y),
-        crs=crs_used).\
-        to_crs(crs_init)
+        pd.DataFrame(mat_pos, columns=['x', 'y']),
+        geometry=gpd.points_from_xy(x=x, y=y),
+        crs=crs_init)
 
-    return(shp_pos.iloc[:num_points_to_gen])
+    return shp_pos
 
 
-def generate_random_points_over_extent_sobol(shp: gpd.GeoDataFrame, num_points_to_gen, crs=None) -> gpd.GeoDataFrame:
+def generate_random_points_over_extent_grid(shp: gpd.GeoDataFrame,
+                                            num_points_to_gen,
+                                            crs=None,
+                                            within_geometry: bool = False,
+                                            seed: Union[int, np.random.Generator] = None,
+                                            batch_size: int = 1000000) -> gpd.GeoDataFrame:
     """Generate random points from a geodataframe extent in a grid-lie fashion
 
-    Samples point according to the shape of the bounding box (proportional to each side's length)
+    Samples num_x random eastings and num_y random northings and takes all the combinations
+    num_x * num_y ~ num_points_to_gen and num_x / num_y ~ width / height of the boundinx box
 
     Args:
         shp (gpd.GeoDataFrame): _description_
         num_points_to_gen (_type_): _description_
-        crs (_type_, optional): _description_. Defaults to None.
+        crs (_type_, optional): projected crs used for sampling. Defaults to None (3857).
+        within_geometry (bool, optional): only keep points within the geometries (rejection sampling). Defaults to False.
+        seed (Union[int, np.random.Generator], optional): seed or generator for reproducibility. Defaults to None.
+        batch_size (int, optional): max number of candidates drawn at once with within_geometry. Defaults to 1000000.
 
     Returns:
         gpd.GeoDataFrame: _description_
     """
-    crs_init = shp.crs
-    crs_used = 3857 if crs is None else crs_init
-    shp_proj = shp.to_crs(crs_used)
+    rng = np.random.default_rng(seed)
 
-    # Project and get bounding box
-    west, south, east, north = shp_proj.total_bounds
+    def sample_0_1(num_points: int, size: np.ndarray) -> np.ndarray:
+
+        # We can get more than num_points because of ceil: truncate at the end
+        if size[1] == 0:
+            # Degenerate extent (horizontal line or point): all the points along the x axis
+            num_east_west = num_points
+        elif size[0] == 0:
+            # Vertical line: all the points along the y axis
+            num_east_west = 1
+        else:
+            num_east_west = int(max(1, min(num_points, round(sqrt(num_points * size[0] / size[1])))))
+        num_north_south = ceil(num_points / num_east_west)
+
+        easting_rand_pos = rng.uniform(size=num_east_west)
+        northing_rand_pos = rng.uniform(size=num_north_south)
+
+        # Cross product to recover grid
+        mat_pos = np.column_stack([np.repeat(easting_rand_pos, num_north_south),
+                                   np.tile(northing_rand_pos, num_east_west)])
 
-    width = (east - west)
-    height = (north - south)
+        return mat_pos[:num_points]
+
+    return _generate_random_points(shp,
+                                   num_points_to_gen,
+                                   sample_0_1,
+                                   crs=crs,
+                                   within_geometry=within_geometry,
+                                   batch_size=batch_size)
+
+
+def generate_random_points_over_extent_sobol(shp: gpd.GeoDataFrame,
+                                             num_points_to_gen,
+                                             crs=None,
+                                             within_geometry: bool = False,
+                                             seed: Union[int, np.random.Generator] = None,
+                                             batch_size: int = 1000000) -> gpd.GeoDataFrame:
+    """Generate random points from a geodataframe extent using a scrambled Sobol sequence
+
+    Sobol points are spread more evenly over the bounding box than uniform random points
+    With within_geometry, successive batches continue the same sequence
+
+    Args:
+        shp (gpd.GeoDataFrame): _description_
+        num_points_to_gen (_type_): _description_
+        crs (_type_, optional): projected crs used for sampling. Defaults to None (3857).
+        within_geometry (bool, optional): only keep points within the geometries (rejection sampling). Defaults to False.
+        seed (Union[int, np.random.Generator], optional): seed or generator for reproducibility. Defaults to None.
+        batch_size (int, optional): max number of candidates drawn at once with within_geometry. Defaults to 1000000.
+
+    Returns:
+        gpd.GeoDataFrame: _description_
+    """
 
     # Generate random points according to sobol sequence
     # Sampled points are in [0,1)^2
-    sobol_sampler = Sobol(d=2, scramble=True)
-    sampled_0_1_points = sobol_sampler.random(n=num_points_to_gen)
+    sobol_sampler = Sobol(d=2, scramble=True, seed=np.random.default_rng(seed))
 
-    # Get the final coordinates with affine transform
-    # Starting from south east corner of bbox, using the width and height multiplied by an offset
-    # Multiply column by column
-    mat_offset = np.multiply(sampled_0_1_points,  np.array( [width, height]) ) 
+    return _generate_random_points(shp,
+                                   num_points_to_gen,
+                                   lambda num_points, size: sobol_sampler.random(num_points),
+                                   crs=crs,
+                                   within_geometry=within_geometry,
+                                   batch_size=batch_size)
 
-    # origin is the south west corner - replicated num_points_to_gen - once for each point
-    mat_origin = np.ndarray.repeat( np.array([west,south]).reshape(-1,1) , num_points_to_gen ,axis=1).T
 
-    mat_pos = mat_offset + mat_origin  
+def _sample_points_in_polygons(geometries: np.ndarray,
+                               num_points: np.ndarray,
+                               seed_seq: np.random.SeedSequence) -> np.ndarray:
+    """Sample uniformly num_points[k] points in each (multi)polygon geometries[k]
 
-    df_pos = pd.DataFrame(mat_pos, columns=['x', 'y'])
+    Triangulation based: a triangle is picked with a probability proportional to its area
+    and the point is sampled uniformly in that triangle by reflecting the points of the unit square that fall outside
 
-    # Convert to geodaframe and return
-    shp_pos = gpd.GeoDataFrame(
-        df_pos,
-        geometry=gpd.points_from_xy(
-            x=df_pos.x, y=df_pos.y),
-        crs=crs_used).\
-        to_crs(crs_init)
+    Returns:
+        np.ndarray: (num_points.sum(), 2) coordinates - grouped by geometry, in the same order
+    """
+
+    rng = np.random.default_rng(seed_seq)
+
+    # Triangles of each geometry as a collection: read the coordinates directly rather than creating each triangle
+    triangulations = shapely.constrained_delaunay_triangles(geometries)
+    idx_geometry = np.repeat(np.arange(geometries.shape[0]), shapely.get_num_geometries(triangulations))
+    vertices = shapely.get_coordinates(triangulations).reshape(-1, 4, 2)[:, :3, :]
+
+    a = vertices[:, 0, :]
+    ab = vertices[:, 1, :] - a
+    ac = vertices[:, 2, :] - a
+    areas = 0.5 * np.abs(ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0])
+
+    # Total area of the triangles before each geometry
+    cum_areas = np.cumsum(areas)
+    area_geometries = np.bincount(idx_geometry, weights=areas, minlength=geometries.shape[0])
+    offset_geometries = np.cumsum(area_geometries) - area_geometries
+
+    if np.any((area_geometries <= 0) & (num_points > 0)):
+        raise ValueError('Fatal error! cannot sample points in geometries with no area')
+
+    # Pick the triangles: uniform position along the cumulative area of each geometry
+    idx_point_geometry = np.repeat(np.arange(geometries.shape[0]), num_points)
+    u_area = offset_geometries[idx_point_geometry] + rng.uniform(size=idx_point_geometry.shape[0]) * area_geometries[idx_point_geometry]
+    idx_triangle = np.searchsorted(cum_areas, u_area, side='right')
+
+    # No floating point spill over to the triangles of the next geometry
+    idx_triangle = np.clip(idx_triangle,
+                           np.searchsorted(idx_geometry, idx_point_geometry, side='left'),
+                           np.searchsorted(idx_geometry, idx_point_geometry, side='right') - 1)
+
+    # Uniform in the triangle: reflect the points above the diagonal of the unit square
+    u = rng.uniform(size=(idx_triangle.shape[0], 2))
+    is_outside = u.sum(axis=1) > 1
+    u[is_outside] = 1 - u[is_outside]
+
+    return a[idx_triangle] + u[:, [0]] * ab[idx_triangle] + u[:, [1]] * ac[idx_triangle]
+
+
+def generate_random_points_per_feature(shp: gpd.GeoDataFrame,
+                                       num_points_per_feature: Union[int, str, np.ndarray],
+                                       crs=None,
+                                       seed: Union[int, np.random.Generator] = None,
+                                       n_jobs: int = 1,
+                                       chunk_size: int = 10000) -> gpd.GeoDataFrame:
+    """Generate uniform random points within each (multi)polygon of a geodataframe
+
+    Triangulates the geometries (no rejection): works for very thin or concave features like dissemination areas
 
-    return(shp_pos.iloc[:num_points_to_gen])
+    The features are processed by chunks of chunk_size and chunk k uses the k-th child of the seed:
+    the result only depends on the seed and chunk_size, not on n_jobs
+
+    Args:
+        shp (gpd.GeoDataFrame): (multi)polygons
+        num_points_per_feature (Union[int, str, np.ndarray]): number of points for each feature - int, column name or array
+        crs (_type_, optional): projected crs used for sampling. Defaults to None (3857).
+        seed (Union[int, np.random.Generator], optional): seed or generator for reproducibility. Defaults to None.
+        n_jobs (int, optional): number of processes used to sample the chunks. Defaults to 1.
+        chunk_size (int, optional): number of features per chunk. Defaults to 10000.
+
+    Returns:
+        gpd.GeoDataFrame: sampled POINT geodataframe indexed by the index of the feature, with the projected x, y coordinates
+    """
+
+    assert isinstance(shp, gpd.GeoDataFrame)
+
+    if isinstance(num_points_per_feature, str):
+        num_points_per_feature = shp[num_points_per_feature].values
+    num_points_per_feature = np.broadcast_to(np.asarray(num_points_per_feature, dtype=np.int64), (shp.shape[0],))
+    assert np.all(num_points_per_feature >= 0)
+
+    crs_init = shp.crs
+    crs_used = 3857 if crs is None else crs
+    geometries = np.asarray(shp.geometry.to_crs(crs_used).values)
+
+    if np.any(shapely.is_missing(geometries) | shapely.is_empty(geometries)):
+        raise ValueError('Fatal error in generate_random_points_per_feature! missing or empty geometries')
+
+    # Independent stream for each chunk
+    num_chunks = max(1, ceil(shp.shape[0] / chunk_size))
+    list_seed_seq = np.random.default_rng(seed).bit_generator.seed_seq.spawn(num_chunks)
+    list_args = [(geometries[k * chunk_size:(k + 1) * chunk_size],
+                  num_points_per_feature[k * chunk_size:(k + 1) * chunk_size],
+                  list_seed_seq[k])
+                 for k in range(num_chunks)]
+
+    if n_jobs > 1 and num_chunks > 1:
+        with Pool(n_jobs) as p:
+            list_pos = p.starmap(_sample_points_in_polygons, list_args)
+    else:
+        list_pos = [_sample_points_in_polygons(*args) for args in list_args]
+
+    mat_pos = np.concatenate(list_pos)
+
+    # Transform the coordinates back to the initial crs before creating the points
+    transformer = Transformer.from_crs(crs_used, crs_init, always_xy=True)
+    x, y = transformer.transform(mat_pos[:, 0], mat_pos[:, 1])
+
+    shp_pos = gpd.GeoDataFrame(
+        pd.DataFrame(mat_pos, columns=['x', 'y'], index=shp.index.repeat(num_points_per_feature)),
+        geometry=gpd.points_from_xy(x=x, y=y),
+        crs=crs_init)
 
+    return shp_pos
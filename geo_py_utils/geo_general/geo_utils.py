@@ -4,6 +4,7 @@
 import numpy as np
 import geopandas as gpd
 import pandas as pd
+import shapely
 from shapely.geometry import shape
 from typing import  Union
 
@@ -15,29 +16,53 @@ def flip_coord(list_points):
     return new_poly 
 
 
+def _get_polygon_parts(geometries: np.ndarray) -> tuple:
+    """Explode multipolygons into polygons + position of the original geometry for each part
+
+    Skip shapely.get_parts (which copies every geometry) when there are only simple geometries
+
+    Args:
+        geometries (np.ndarray): array of shapely geometries
+
+    Returns:
+        tuple: parts (np.ndarray), index of the original geometry of each part (np.ndarray)
+    """
+
+    if np.all(shapely.get_type_id(geometries) != 6):
+        return geometries, np.arange(geometries.shape[0])
+
+    return shapely.get_parts(geometries, return_index=True)
+
+
 def get_matrix_point_polygon(shp: gpd.GeoDataFrame) -> pd.DataFrame:
     """Get the polyon points from a Multipolygon or Polygon and return the result as a 2D dataframe with the polygon id (corresponding to the shp index)
 
+    Only the exterior ring of each polygon (or of each part of a MultiPolygon) is used.
+    Single vectorized pass with shapely 2 ragged array functions.
+
     Args:
         shp (gpd.GeoDataFrame): _description_
 
     Returns:
-        np.array: _description_
+        pd.DataFrame: columns 0 (x), 1 (y) and poly_id - the index restarts at 0 for each polygon
     """
 
     assert isinstance(shp, gpd.GeoDataFrame)
-    assert np.isin(shp.type.unique(), ['Multipolygon', 'Polygon']).all()
+    assert shp.geom_type.isin(['MultiPolygon', 'Polygon']).all()
 
-    dict_coords = {
-        k: row['geometry'].exterior.coords.xy for k, row in shp.iterrows()}
+    # Explode multipolygons: polygons are returned as is with their position in shp
+    parts, idx_part_to_poly = _get_polygon_parts(np.asarray(shp.geometry.values))
 
-    matrix_coords = {k: np.concatenate(
-        [np.array(dict_coords[k][0]).reshape(-1, 1),
-         np.array(dict_coords[k][1]).reshape(-1, 1)], axis=1) for k in dict_coords.keys()
-    }
+    coords, idx_coord_to_part = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+    idx_coord_to_poly = idx_part_to_poly[idx_coord_to_part]
 
-    df_coordinates_by_poly = pd.concat([pd.DataFrame(matrix_coords[k]).assign(poly_id=k)
-                                        for k in matrix_coords.keys()])
+    # Restart the index for each polygon - coordinates are sorted by polygon
+    num_coords_by_poly = np.bincount(idx_coord_to_poly, minlength=shp.shape[0])
+    idx_start_by_poly = np.cumsum(num_coords_by_poly) - num_coords_by_poly
+    idx_within_poly = np.arange(coords.shape[0]) - np.repeat(idx_start_by_poly, num_coords_by_poly)
+
+    df_coordinates_by_poly = pd.DataFrame(coords, index=idx_within_poly).\
+        assign(poly_id=shp.index.to_numpy()[idx_coord_to_poly])
 
     return df_coordinates_by_poly
 
@@ -45,27 +70,28 @@ def get_matrix_point_polygon(shp: gpd.GeoDataFrame) -> pd.DataFrame:
 def get_matrix_point_coordinates(shp: Union[gpd.GeoDataFrame, gpd.geoseries.GeoSeries]) -> np.array:
     """Convert geometry column to a 2 column matrix by taking centroids
 
+    Vectorized with shapely 2: centroids are only computed if some geometries are not points
+
     Args:
         shp (gpd.GeoDataFrame): _description_
 
     Returns:
-        np.array: _description_
+        np.array: (n, 2) array of x (lng), y (lat) in the same order as the rows of shp
     """
     assert isinstance(shp, gpd.GeoDataFrame) or isinstance(shp, gpd.geoseries.GeoSeries), \
         'Fatal error in get_matrix_point_coordinates! needs to be a geodf or geoseries'
 
-    if isinstance(shp, gpd.GeoDataFrame):
-        geo_array = np.array(
-            [np.array((shp['geometry'][k].centroid.xy[0][0],
-                       shp['geometry'][k].centroid.xy[1][0]))
-             for k in range(shp.shape[0])]
-        )
-    else:
-        geo_array = np.array(
-            [np.array((shp[k].centroid.xy[0][0],
-                       shp[k].centroid.xy[1][0]))
-             for k in range(shp.shape[0])]
-        )
+    geometries = np.asarray(shp.geometry.values) if isinstance(shp, gpd.GeoDataFrame) else np.asarray(shp.values)
+
+    # get_coordinates silently drops missing and empty geometries: the rows would no longer line up
+    if np.any(shapely.is_missing(geometries) | shapely.is_empty(geometries)):
+        raise ValueError('Fatal error in get_matrix_point_coordinates! missing or empty geometries')
+
+    # Short circuit: points are their own centroid
+    if not np.all(shapely.get_type_id(geometries) == 0):
+        geometries = shapely.centroid(geometries)
+
+    geo_array = shapely.get_coordinates(geometries)
 
     return geo_array
 
@@ -101,26 +127,23 @@ def get_geodataframe_from_list_coord(list_coordinates: list, crs):
 def get_num_points_in_geoseries(geoseries: gpd.GeoSeries):
     """Count the number of coordinates in each feature in a geoseries
 
+    Only counts the exterior ring of each polygon (summed over the parts of a MultiPolygon)
+
    Args:
         list_coordinates (geoseries): geoseries - eg. shp['geometry]
 
     Returns:
         np.array: array with number of vertices per feature/row/polygon
     """
-    n_vertices = []
-    for geo in geoseries:
 
-        if geo.type.startswith("Multi"):
-            n = 0
-            # iterate over all parts of multigeometry
-            for part in geo.geoms:
-                n += len(part.exterior.coords)
-        else:
-            n = len(geo.exterior.coords)
+    geometries = np.asarray(geoseries.values)
+    parts, idx_part_to_geo = _get_polygon_parts(geometries)
+    num_coords_by_part = shapely.get_num_coordinates(shapely.get_exterior_ring(parts))
 
-        n_vertices.append(n)
+    n_vertices = np.bincount(idx_part_to_geo, weights=num_coords_by_part, minlength=geometries.shape[0]).\
+        astype(int)
 
-    return np.array(n_vertices)
+    return n_vertices
 
  
  
\ No newline at end of file
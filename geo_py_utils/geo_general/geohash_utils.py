@@ -392,7 +392,12 @@ def get_subset_geohash_from_gdf(input:  Union[gpd.GeoDataFrame, gpd.geoseries.Ge
     return shp_geohash
 
 
-def add_geohash_index(shp_to_add, precision, new_col_name='geohash_index', keep_lat_lng=True):
+def add_geohash_index(shp_to_add,
+                      precision,
+                      new_col_name='geohash_index',
+                      keep_lat_lng=True,
+                      centroid_crs=None,
+                      centroid_method='centroid'):
     """Take a geodataframe and add the geohash index for each feature
 
     If the lat and lng does not exist, try to add it using each feature's centroid 
@@ -402,18 +407,20 @@ def add_geohash_index(shp_to_add, precision, new_col_name='geohash_index', keep_
         precision: int geohash precision e.g. 7
         new_col_name: name of the geohash index column
         keep_lat_lng: bool - keep the lat and lng column added when taking the centroid
+        centroid_crs: projected crs used to compute the centroids - see add_centroid. Defaults to None.
+        centroid_method: 'centroid' or 'representative_point' - see add_centroid. Defaults to 'centroid'.
     Returns:
         list[str]: list of geohash indices
     """
 
-    # Make a copy, dont want to carry over changes to the original geodf
-    shp = shp_to_add.copy()
+    # Shallow copy: new columns are not carried over to the original geodf, no need to copy the geometries
+    shp = shp_to_add.copy(deep=False)
 
     # Add lat and lng columns if absent
     if not np.isin(['lat', 'lng'], shp.columns).all():
         logger.debug(
             'Warning in add_geohash_index! No lat lng for geocode encoding: trying to add the centroid')
-        shp = add_centroid(shp)
+        shp = add_centroid(shp, inplace=True, centroid_crs=centroid_crs, method=centroid_method)
 
     if (shp[['lat', 'lng']].isna().sum() > 0).any():
         raise ValueError(
@@ -527,12 +534,10 @@ def recursively_partition_geohash_cells(shp_points,
             list_complete.append(shp_count_by_hash_suff_precise)
             dict_layers[p] = shp_count_by_hash_suff_precise
 
-            # Remove the observations
-            idx_remove = shp_points_with_hash.\
-                merge(
-                    shp_count_by_hash_suff_precise, 
-                    on='geohash_index')\
-                .index
+            # Remove the observations - add_geohash_index preserves the index of shp_points
+            idx_remove = shp_points_with_hash.index[
+                shp_points_with_hash.geohash_index.isin(shp_count_by_hash_suff_precise.geohash_index)
+                ]
 
             # These are the points to consider in the next iteration
             shp_points = shp_points.loc[
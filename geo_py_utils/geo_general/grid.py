@@ -1,76 +1,327 @@
-
-
 import numpy as np
-from shapely.geometry import Polygon
+import pandas as pd
+import shapely
 import geopandas as gpd
 from math import ceil
+from typing import Iterator, Union
+
+from geo_py_utils.geo_general.geo_utils import get_matrix_point_coordinates
+
+
+
+class GridSpec:
+    """Regular rectangular grid defined by its origin, cell size and number of cells in a projected crs.
+
+    Cells have a stable int64 id: cell_id = row * n_cols + col
+    where row counts the cells from the bottom (ymin) and col from the left (xmin)
+
+    Can be shared between get_grid_over_shp and iter_grid_over_shp to get the same cells (and ids)
+
+    Attributes:
+        xmin (float): x of the bottom left corner of the grid
+        ymin (float): y of the bottom left corner of the grid
+        width_x_m (float): width of each cell
+        height_y_m (float): height of each cell
+        n_cols (int): number of cells along x
+        n_rows (int): number of cells along y
+        crs: projected crs of the grid
+    """
+
+    def __init__(self, xmin, ymin, width_x_m, height_y_m, n_cols, n_rows, crs):
+
+        self.xmin = xmin
+        self.ymin = ymin
+        self.width_x_m = width_x_m
+        self.height_y_m = height_y_m
+        self.n_cols = int(n_cols)
+        self.n_rows = int(n_rows)
+        self.crs = crs
+
+    @classmethod
+    def from_shp(cls,
+                 shp: gpd.GeoDataFrame,
+                 height_y_m: float = None,
+                 width_x_m: float = None,
+                 cell_dim: tuple = None,
+                 crs=None) -> 'GridSpec':
+        """Grid covering the extent of a geodataframe
+
+        Args:
+            shp (gpd.GeoDataFrame): _description_
+            height_y_m: height/lenth of each cell in meters
+            width_x_m: width of each cell in meters
+            cell_dim: desired number of cells (along x, along y) - alternative to height_y_m and width_x_m
+            crs: crs used - to ensure we are working in meters and not degrees, Default = 3857
+
+        Returns:
+            GridSpec: grid definition
+        """
+
+        # ^ is xor
+        assert (cell_dim is not None) ^ (height_y_m is not None and width_x_m is not None), \
+            'Fatal error! use either the deired number of cells of set the cell width and height manually '
+
+        # Project + get the extent/bounding box
+        crs_used = 3857 if crs is None else crs
+        xmin, ymin, xmax, ymax = shp.to_crs(crs_used).total_bounds
+
+        # Get the cell dimensions based on parameters
+        if (height_y_m is not None and width_x_m is not None):
+
+            if width_x_m > (xmax - xmin):
+                raise ValueError(
+                    'Warning! cannot use such a large width, the total extent width is %f' % (xmax - xmin))
+
+            if height_y_m > (ymax - ymin):
+                raise ValueError(
+                    'Warning! cannot use such a large heigth, the total extent height is %f' % (ymax - ymin))
+
+        else:
+
+            assert len(cell_dim) == 2
+
+            width_x_m = ceil((xmax - xmin) / cell_dim[0])
+            height_y_m = ceil((ymax - ymin) / cell_dim[1])
+
+        # Number of bottom left corners in [min, max]
+        n_cols = np.arange(xmin, xmax + width_x_m, width_x_m).shape[0] - 1
+        n_rows = np.arange(ymin, ymax + height_y_m, height_y_m).shape[0] - 1
+
+        return cls(xmin, ymin, width_x_m, height_y_m, n_cols, n_rows, crs_used)
+
+    @property
+    def n_cells(self) -> int:
+        return self.n_cols * self.n_rows
+
+    def get_cell_id(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """(row, col) -> int64 cell id"""
+        return np.asarray(rows, dtype=np.int64) * self.n_cols + np.asarray(cols, dtype=np.int64)
+
+    def get_row_col(self, cell_ids: np.ndarray) -> tuple:
+        """int64 cell id -> (row, col)"""
+        return np.divmod(np.asarray(cell_ids, dtype=np.int64), self.n_cols)
+
+    def get_cell_bounds(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """(n, 4) array of xmin, ymin, xmax, ymax for each (row, col) in the grid crs"""
+
+        x_left = self.xmin + np.asarray(cols) * self.width_x_m
+        y_bottom = self.ymin + np.asarray(rows) * self.height_y_m
+
+        return np.column_stack([x_left, y_bottom, x_left + self.width_x_m, y_bottom + self.height_y_m])
+
+
+def _get_grid_cells(grid_spec: GridSpec,
+                    rows: np.ndarray,
+                    cols: np.ndarray,
+                    tree_shp: shapely.STRtree = None,
+                    return_bounds: bool = False,
+                    crs_init=None) -> Union[gpd.GeoDataFrame, np.ndarray]:
+    """Build the cells for the given rows/cols - optionally only those intersecting the geometries in tree_shp
+
+    Returns:
+        Union[gpd.GeoDataFrame, np.ndarray]: geodataframe with a cell_id column or (n, 4) array of bounds
+    """
+
+    bounds = grid_spec.get_cell_bounds(rows, cols)
+    cell_ids = grid_spec.get_cell_id(rows, cols)
+
+    # No shapely objects required
+    if return_bounds and tree_shp is None:
+        return bounds
+
+    # Create the polygons in a single call
+    polygons = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+
+    if tree_shp is not None:
+        idx_cells = np.unique(tree_shp.query(polygons, predicate='intersects')[0])
+        polygons, bounds, cell_ids = polygons[idx_cells], bounds[idx_cells], cell_ids[idx_cells]
+
+    if return_bounds:
+        return bounds
+
+    # Convert to geodataframe + reproject
+    shp_grid = gpd.GeoDataFrame({'cell_id': cell_ids, 'geometry': polygons}, crs=grid_spec.crs)
+    if crs_init is not None:
+        shp_grid = shp_grid.to_crs(crs_init)
 
+    return shp_grid
 
 
 def get_grid_over_shp(shp: gpd.GeoDataFrame,
                       height_y_m: float = None,
                       width_x_m: float = None,
                       cell_dim: tuple = None,
-                      crs=None) -> gpd.GeoDataFrame:
+                      crs=None,
+                      only_intersecting: bool = False,
+                      return_bounds: bool = False,
+                      grid_spec: GridSpec = None) -> Union[gpd.GeoDataFrame, np.ndarray]:
     """Generate a rectangular grid over a geodataframe extent 
 
     Based on https://gis.stackexchange.com/questions/269243/creating-polygon-grid-using-geopandas
+    Cells are built with vectorized numpy + shapely.box: no python loop over the cells
 
     Args:
         shp (gpd.GeoDataFrame): _description_
         height_y_m: height/lenth of each cell in meters
         width_x_m: width of each cell in meters
+        cell_dim: desired number of cells (along x, along y) - alternative to height_y_m and width_x_m
         crs: crs used - to ensure we are working in meters and not degrees, Default = 3857
+        only_intersecting: only keep the cells that intersect the geometries of shp (STRtree query). Defaults to False.
+        return_bounds: return a (n, 4) array of cell bounds (xmin, ymin, xmax, ymax) in the projected crs rather than a geodataframe. Defaults to False.
+        grid_spec: existing grid definition - the cell dimensions and crs arguments are then ignored. Defaults to None.
     Returns:
-        gpd.GeoDataFrame: _description_
+        gpd.GeoDataFrame: grid with a stable `cell_id` column (see GridSpec)
     """
 
-    # ^ is xor
-    assert (cell_dim is not None) ^ (height_y_m is not None and width_x_m is not None), \
-        'Fatal error! use either the deired number of cells of set the cell width and height manually '
+    if grid_spec is None:
+        grid_spec = GridSpec.from_shp(shp, height_y_m=height_y_m, width_x_m=width_x_m, cell_dim=cell_dim, crs=crs)
 
-    # Project
-    crs_init = shp.crs
-    crs_used = 3857 if crs is None else crs_init
-    shp_proj = shp.to_crs(crs_used)
+    # Same order as before: x varies slowest
+    cols, rows = np.meshgrid(np.arange(grid_spec.n_cols), np.arange(grid_spec.n_rows), indexing='ij')
 
-    # Get the extent/bounding box
-    xmin, ymin, xmax, ymax = shp_proj.total_bounds
+    tree_shp = None
+    if only_intersecting:
+        tree_shp = shapely.STRtree(np.asarray(shp.geometry.to_crs(grid_spec.crs).values))
 
-    # Get the cell dimensions based on parameters
-    if (height_y_m is not None and width_x_m is not None):
+    shp_grid = _get_grid_cells(grid_spec,
+                               rows.ravel(),
+                               cols.ravel(),
+                               tree_shp=tree_shp,
+                               return_bounds=return_bounds,
+                               crs_init=shp.crs)
 
-        if height_y_m > (xmax - xmin):
-            raise ValueError(
-                'Warning! cannot use such a large heigth, the total extent height is %f' % (xmax - xmin))
+    return shp_grid
 
-        if width_x_m > (ymax - ymin):
-            raise ValueError(
-                'Warning! cannot use such a large width, the total extent width is %f' % (ymax - ymin))
 
-    else:
+def iter_grid_over_shp(shp: gpd.GeoDataFrame,
+                       height_y_m: float = None,
+                       width_x_m: float = None,
+                       cell_dim: tuple = None,
+                       crs=None,
+                       only_intersecting: bool = False,
+                       return_bounds: bool = False,
+                       grid_spec: GridSpec = None,
+                       tile_shape: tuple = (256, None)) -> Iterator[Union[gpd.GeoDataFrame, np.ndarray]]:
+    """Lazily generate the grid over a geodataframe extent by tiles of cells to keep the memory bounded
 
-        assert len(cell_dim) == 2
+    Same cells and cell ids as get_grid_over_shp: concatenating all the tiles gives the same grid (in a different order)
 
-        width_x_m = ceil((xmax - xmin) / cell_dim[0])
-        height_y_m = ceil((ymax - ymin) / cell_dim[1])
+    Args:
+        shp (gpd.GeoDataFrame): _description_
+        height_y_m, width_x_m, cell_dim, crs, only_intersecting, return_bounds, grid_spec: see get_grid_over_shp
+        tile_shape (tuple, optional): number of rows and cols of cells in each tile - None means all of them.
+            Defaults to (256, None): blocks of 256 full rows.
 
-    # Create the list of points (bottom left corner for each cell)
-    cols = list(np.arange(xmin, xmax + width_x_m, width_x_m))
-    rows = list(np.arange(ymin, ymax + height_y_m, height_y_m))
+    Yields:
+        Union[gpd.GeoDataFrame, np.ndarray]: grid tile with a `cell_id` column - tiles with no cells are skipped
+    """
 
-    # Create the polygons
-    polygons = []
-    for x in cols[:-1]:
-        for y in rows[:-1]:
-            polygons.append(
-                Polygon([(x, y), (x+width_x_m, y), (x+width_x_m, y+height_y_m), (x, y+height_y_m)]))
+    if grid_spec is None:
+        grid_spec = GridSpec.from_shp(shp, height_y_m=height_y_m, width_x_m=width_x_m, cell_dim=cell_dim, crs=crs)
 
-    # Convert to geodataframe + reproject
-    shp_grid = gpd.GeoDataFrame({'geometry': polygons}, crs=crs_used).\
-        to_crs(crs_init)
+    n_rows_tile = grid_spec.n_rows if tile_shape[0] is None else tile_shape[0]
+    n_cols_tile = grid_spec.n_cols if tile_shape[1] is None else tile_shape[1]
 
-    return shp_grid
+    tree_shp = None
+    if only_intersecting:
+        tree_shp = shapely.STRtree(np.asarray(shp.geometry.to_crs(grid_spec.crs).values))
+
+    for row_start in range(0, grid_spec.n_rows, n_rows_tile):
+        for col_start in range(0, grid_spec.n_cols, n_cols_tile):
+
+            row_end = min(row_start + n_rows_tile, grid_spec.n_rows)
+            col_end = min(col_start + n_cols_tile, grid_spec.n_cols)
+
+            # Skip the entire tile without building the cells if no geometry intersects it
+            if tree_shp is not None:
+                (tile_xmin, tile_ymin, _, _), = grid_spec.get_cell_bounds([row_start], [col_start])
+                (_, _, tile_xmax, tile_ymax), = grid_spec.get_cell_bounds([row_end - 1], [col_end - 1])
+                if tree_shp.query(shapely.box(tile_xmin, tile_ymin, tile_xmax, tile_ymax), predicate='intersects').size == 0:
+                    continue
+
+            rows, cols = np.meshgrid(np.arange(row_start, row_end), np.arange(col_start, col_end), indexing='ij')
+
+            tile = _get_grid_cells(grid_spec,
+                                   rows.ravel(),
+                                   cols.ravel(),
+                                   tree_shp=tree_shp,
+                                   return_bounds=return_bounds,
+                                   crs_init=shp.crs)
+
+            if tile.shape[0] > 0:
+                yield tile
+
+
+def assign_grid_cell(points: Union[gpd.GeoDataFrame, gpd.GeoSeries],
+                     grid_spec: GridSpec) -> np.ndarray:
+    """Assign each point to its grid cell arithmetically (no spatial join against the grid polygons)
+
+    Cells include their left and bottom edges. Points on the right/top edge of the grid belong to the last cell.
+    Centroids are used for non-point geometries.
+
+    Args:
+        points (Union[gpd.GeoDataFrame, gpd.GeoSeries]): points with a crs
+        grid_spec (GridSpec): grid definition - e.g. GridSpec.from_shp or the one used with get_grid_over_shp
+
+    Returns:
+        np.ndarray: int64 cell id for each point in the same order as points - -1 for points outside the grid
+    """
+
+    coords = get_matrix_point_coordinates(points.to_crs(grid_spec.crs))
+
+    cols = np.floor((coords[:, 0] - grid_spec.xmin) / grid_spec.width_x_m)
+    rows = np.floor((coords[:, 1] - grid_spec.ymin) / grid_spec.height_y_m)
+
+    # Right and top edges of the grid are closed
+    cols = np.where(coords[:, 0] == grid_spec.xmin + grid_spec.n_cols * grid_spec.width_x_m, grid_spec.n_cols - 1, cols)
+    rows = np.where(coords[:, 1] == grid_spec.ymin + grid_spec.n_rows * grid_spec.height_y_m, grid_spec.n_rows - 1, rows)
+
+    is_inside = (cols >= 0) & (cols < grid_spec.n_cols) & (rows >= 0) & (rows < grid_spec.n_rows)
+
+    cell_ids = np.full(coords.shape[0], -1, dtype=np.int64)
+    cell_ids[is_inside] = grid_spec.get_cell_id(rows[is_inside], cols[is_inside])
+
+    return cell_ids
+
+
+def count_by_grid(points: Union[gpd.GeoDataFrame, gpd.GeoSeries],
+                  grid_spec: GridSpec,
+                  weights: Union[str, np.ndarray] = None,
+                  dense: bool = False) -> Union[pd.Series, np.ndarray]:
+    """Count (or sum weights of) the points in each grid cell with np.bincount
+
+    Points outside the grid are ignored.
+
+    Args:
+        points (Union[gpd.GeoDataFrame, gpd.GeoSeries]): points with a crs
+        grid_spec (GridSpec): grid definition
+        weights (Union[str, np.ndarray], optional): column name of points or array of weights to sum instead of counting. Defaults to None.
+        dense (bool, optional): return an array of length grid_spec.n_cells indexed by cell id (including 0s). Defaults to False.
+
+    Returns:
+        Union[pd.Series, np.ndarray]: counts of non empty cells indexed by cell_id or dense array of counts
+    """
+
+    cell_ids = assign_grid_cell(points, grid_spec)
+
+    if isinstance(weights, str):
+        weights = points[weights].values
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        assert weights.shape[0] == cell_ids.shape[0], 'Fatal error in count_by_grid! weights and points have different lengths'
+
+    is_inside = cell_ids >= 0
+    cell_ids = cell_ids[is_inside]
+    weights = None if weights is None else weights[is_inside]
+
+    if dense:
+        return np.bincount(cell_ids, weights=weights, minlength=grid_spec.n_cells)
+
+    # Only bin the cells with points: the grid can be much larger than the number of points
+    cell_ids_unique, idx_inverse = np.unique(cell_ids, return_inverse=True)
+    counts = np.bincount(idx_inverse, weights=weights, minlength=cell_ids_unique.shape[0])
+
+    return pd.Series(counts, index=pd.Index(cell_ids_unique, name='cell_id'), name='count')
 
 
 if __name__ == '__main__':
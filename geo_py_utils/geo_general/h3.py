@@ -1,26 +1,333 @@
 import geopandas as gpd
-import h3
+import numpy as np
+import pandas as pd
+import shapely
+import logging
+import h3.api.numpy_int as h3
+from shapely.geometry import box
 
-from geo_py_utils.geo_general.geo_utils import get_geodataframe_from_list_coord
+from geo_py_utils.geo_general.geo_utils import get_matrix_point_coordinates
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bit layout of the h3 cell index (64 bits): https://h3geo.org/docs/core-library/h3Indexing
+# Resolution on bits 52-55, base cell on bits 45-51 and 15 digits of 3 bits (res 1 is the most significant one)
+H3_MAX_RESOLUTION = 15
+H3_RES_OFFSET = np.uint64(52)
+H3_RES_MASK = np.uint64(0xF) << H3_RES_OFFSET
+H3_BASE_CELL_OFFSET = np.uint64(45)
+H3_PENTAGON_BASE_CELLS = np.array([4, 14, 24, 38, 49, 58, 63, 72, 83, 97, 107, 117], dtype=np.uint64)
+
+
+def get_h3_index(shp: gpd.GeoDataFrame,
+                 resolution: int = 13) -> np.ndarray:
+    """Get the h3 index of the centroid of each feature
+
+    h3 has no vectorized indexing function, so latlng_to_cell is only called once per unique coordinate
+
+    Args:
+        shp (gpd.GeoDataFrame): _description_
+        resolution (int, optional): h3 resolution. Defaults to 13.
+
+    Returns:
+        np.ndarray: uint64 h3 index for each row of shp (same order)
+    """
+
+    assert isinstance(shp, gpd.GeoDataFrame) or isinstance(shp, gpd.geoseries.GeoSeries)
+
+    # Convert to geographic coordinates: x is the lng, y the lat
+    coords = get_matrix_point_coordinates(shp.to_crs(4326))
+
+    # View each (lng, lat) row as a single complex number: much faster than np.unique(..., axis=0)
+    coords_unique, idx_inverse = np.unique(np.ascontiguousarray(coords, dtype=np.float64).view(np.complex128).ravel(),
+                                           return_inverse=True)
+
+    # Watch out latlng_to_cell takes lat, lng - python floats are faster than numpy scalars here
+    h3_indices_unique = np.fromiter((h3.latlng_to_cell(lat, lng, resolution)
+                                     for lng, lat in zip(coords_unique.real.tolist(), coords_unique.imag.tolist())),
+                                    dtype=np.uint64,
+                                    count=coords_unique.shape[0])
+
+    return h3_indices_unique[idx_inverse.ravel()]
+
+
+def get_h3_boundaries(h3_indices: np.ndarray) -> gpd.GeoDataFrame:
+    """Build the hexagon (or pentagon) polygon of each h3 index
+
+    Args:
+        h3_indices (np.ndarray): h3 indices - should be unique since one polygon is built per element
+
+    Returns:
+        gpd.GeoDataFrame: geodataframe in 4326 with the uint64 `h3_index` column
+    """
+
+    h3_indices = np.asarray(h3_indices, dtype=np.uint64)
+
+    # Each boundary is a tuple of (lat, lng) with 5 to 10 vertices
+    list_boundaries = [h3.cell_to_boundary(h) for h in h3_indices]
+    num_vertices = np.fromiter((len(b) for b in list_boundaries), dtype=np.int64, count=len(list_boundaries))
+
+    # Swap to lng, lat and build all the rings in a single call - the rings are closed by shapely
+    if len(list_boundaries) > 0:
+        coords = np.concatenate([np.asarray(b) for b in list_boundaries])[:, ::-1]
+    else:
+        coords = np.empty((0, 2))
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(list_boundaries)), num_vertices))
+
+    shp_h3 = gpd.GeoDataFrame({'h3_index': h3_indices},
+                              geometry=shapely.polygons(rings),
+                              crs=4326)
+
+    return shp_h3
 
 
 def get_h3_hex_from_gpd(shp: gpd.GeoDataFrame,
-                        resolution: int = 13) -> gpd.GeoDataFrame:
+                        resolution: int = 13,
+                        unique: bool = True,
+                        return_counts: bool = False) -> gpd.GeoDataFrame:
+    """Get the h3 hexagons containing the centroids of the features
+
+    Boundaries are built once per unique h3 index
+
+    Args:
+        shp (gpd.GeoDataFrame): _description_
+        resolution (int, optional): h3 resolution. Defaults to 13.
+        unique (bool, optional): return each hexagon once. Otherwise, return one hexagon per row of shp (same order). Defaults to True.
+        return_counts (bool, optional): add a `count` column with the number of features in each hexagon. Defaults to False.
+
+    Returns:
+        gpd.GeoDataFrame: hexagons in 4326 with the uint64 `h3_index` column
+    """
 
     assert isinstance(shp, gpd.GeoDataFrame)
 
-    # Convert to geographic coordinates 
-    shp_geo = shp.to_crs(4326)
+    h3_indices = get_h3_index(shp, resolution=resolution)
+    h3_indices_unique, idx_inverse, counts = np.unique(h3_indices, return_inverse=True, return_counts=True)
 
-    # Get the h3 indices from the lat,lng
-    h3_indices = [h3.geo_to_h3(p.y, p.x, resolution=resolution)
-                  for p in shp_geo.geometry.centroid]
-    list_coords =  [h3.h3_to_geo_boundary(h=hindex, geo_json=True) for hindex in h3_indices]
+    shp_h3 = get_h3_boundaries(h3_indices_unique)
 
-    # Convert to geodataframe 
-    shp_h3 = get_geodataframe_from_list_coord(list_coords, crs=4326) 
+    if return_counts:
+        shp_h3['count'] = counts
 
-    # Add the h3 index
-    shp_h3['h3_index'] = h3_indices
+    # Expand back to the rows of shp
+    if not unique:
+        shp_h3 = shp_h3.iloc[idx_inverse.ravel()].reset_index(drop=True)
 
     return shp_h3
+
+
+def _get_h3_digit_offset(resolution: int) -> np.uint64:
+    """Position of the lowest bit of the digit at a given resolution"""
+    return np.uint64(3 * (H3_MAX_RESOLUTION - resolution))
+
+
+def _get_h3_resolution(h3_indices: np.ndarray) -> np.ndarray:
+    """Vectorized h3.get_resolution"""
+    return ((np.asarray(h3_indices, dtype=np.uint64) & H3_RES_MASK) >> H3_RES_OFFSET).astype(np.int64)
+
+
+def _set_h3_resolution(h3_indices: np.ndarray, resolution: int) -> np.ndarray:
+    return (h3_indices & ~H3_RES_MASK) | (np.uint64(resolution) << H3_RES_OFFSET)
+
+
+def _get_h3_parent(h3_indices: np.ndarray, resolution: int) -> np.ndarray:
+    """Vectorized h3.cell_to_parent - the cells must have a resolution >= resolution
+
+    Sets the resolution and the unused digits to 7
+    """
+
+    h3_indices = np.asarray(h3_indices, dtype=np.uint64)
+    unused_digits = (np.uint64(1) << _get_h3_digit_offset(resolution)) - np.uint64(1)
+
+    return _set_h3_resolution(h3_indices | unused_digits, resolution)
+
+
+def _is_h3_pentagon(h3_indices: np.ndarray) -> np.ndarray:
+    """Vectorized h3.is_pentagon: pentagon base cell and only 0 digits"""
+
+    h3_indices = np.asarray(h3_indices, dtype=np.uint64)
+    resolution = _get_h3_resolution(h3_indices)
+
+    base_cell = (h3_indices >> H3_BASE_CELL_OFFSET) & np.uint64(0x7F)
+    used_digits = (h3_indices & ((np.uint64(1) << H3_BASE_CELL_OFFSET) - np.uint64(1))) >> \
+        (np.uint64(3) * (H3_MAX_RESOLUTION - resolution).astype(np.uint64))
+
+    return np.isin(base_cell, H3_PENTAGON_BASE_CELLS) & (used_digits == 0)
+
+
+def _get_h3_children(h3_indices: np.ndarray) -> np.ndarray:
+    """Vectorized h3.cell_to_children at the next resolution - all cells must have the same resolution
+
+    7 children per hexagon and 6 per pentagon (the digit 1 does not exist)
+    """
+
+    h3_indices = np.asarray(h3_indices, dtype=np.uint64)
+    if h3_indices.shape[0] == 0:
+        return h3_indices
+
+    resolution = _get_h3_resolution(h3_indices[:1])[0]
+    assert np.all(_get_h3_resolution(h3_indices) == resolution)
+
+    offset = _get_h3_digit_offset(resolution + 1)
+    h3_indices_next = _set_h3_resolution(h3_indices, resolution + 1) & ~(np.uint64(7) << offset)
+
+    # n x 7 matrix of children
+    children = h3_indices_next[:, None] | (np.arange(7, dtype=np.uint64)[None, :] << offset)
+    is_valid = np.ones(children.shape, dtype=bool)
+    is_valid[_is_h3_pentagon(h3_indices), 1] = False
+
+    return children[is_valid]
+
+
+def get_h3_polyfill(shp: gpd.GeoDataFrame,
+                    resolution: int,
+                    contain: str = 'center',
+                    compact: bool = False) -> gpd.GeoDataFrame:
+    """Get all h3 cells covering the union of the geometries (polyfill)
+
+    Args:
+        shp (gpd.GeoDataFrame): (multi)polygons
+        resolution (int): h3 resolution
+        contain (str, optional): 'center', 'full', 'overlap' or 'bbox_overlap' - see h3.h3shape_to_cells_experimental. Defaults to 'center'.
+        compact (bool, optional): replace complete sets of children by their parent (mixed resolutions). Defaults to False.
+
+    Returns:
+        gpd.GeoDataFrame: cells in 4326 with the uint64 `h3_index` and `resolution` columns
+    """
+
+    assert contain in ['center', 'full', 'overlap', 'bbox_overlap']
+
+    h3_shape = h3.geo_to_h3shape(shp.to_crs(4326).union_all())
+
+    if contain == 'center':
+        h3_indices = h3.h3shape_to_cells(h3_shape, resolution)
+    else:
+        h3_indices = h3.h3shape_to_cells_experimental(h3_shape, resolution, contain=contain)
+
+    h3_indices = np.asarray(h3_indices, dtype=np.uint64)
+    if compact:
+        h3_indices = np.asarray(h3.compact_cells(h3_indices), dtype=np.uint64)
+
+    shp_h3 = get_h3_boundaries(np.sort(h3_indices))
+    shp_h3['resolution'] = _get_h3_resolution(shp_h3.h3_index.values)
+
+    return shp_h3
+
+
+def _count_by_h3_cells(h3_cells: np.ndarray,
+                       h3_indices_points: np.ndarray,
+                       counts_points: np.ndarray) -> np.ndarray:
+    """Sum the counts of the points that fall in each cell (0 if none) - points in other cells are ignored"""
+
+    idx_sort = np.argsort(h3_cells)
+    h3_cells_sorted = h3_cells[idx_sort]
+
+    pos = np.minimum(np.searchsorted(h3_cells_sorted, h3_indices_points), h3_cells_sorted.shape[0] - 1)
+    is_in_cells = h3_cells_sorted[pos] == h3_indices_points
+
+    counts_sorted = np.bincount(pos[is_in_cells], weights=counts_points[is_in_cells], minlength=h3_cells.shape[0])
+
+    counts = np.empty_like(counts_sorted)
+    counts[idx_sort] = counts_sorted
+
+    return counts
+
+
+def recursively_partition_h3_cells(shp_points: gpd.GeoDataFrame,
+                                   count_column_name: str = None,
+                                   min_num_points: int = 10,
+                                   max_resolution: int = 9):
+    """From a gpd.GeoDataFrame with point geometry, form an h3 grid with flexible resolution - h3 counterpart of recursively_partition_geohash_cells
+
+    The resolution is greater (cells are smaller) in regions with many points
+
+    Points are indexed once at max_resolution: the cells at coarser resolutions are computed with bit operations on the uint64 indices
+    Watch out, h3 children do not exactly tile their parent: points are assigned to cells based on the index hierarchy
+
+    Args:
+        shp_points (gpd.GeoDataFrame) :  gpd.GeoDataFrame with Point geometry
+        count_column_name (str) (optional) : name of the column that indicates the number of elements per lat lng - if None will count each row as 1 element
+        min_num_points (int_): min number of observations in h3 cell required to stop partitioning
+        max_resolution (int): max h3 resolution
+    Returns:
+        shp_partionned[gpd.GeoDataFrame], dict_layers[dict]: final gpd geodf + dict where keys indicate resolution and values are gpd geodf sufficiently precise at that level
+    """
+
+    # QA
+    assert isinstance(shp_points, gpd.GeoDataFrame)
+    assert min_num_points >= 1, \
+        f"Fatal error, cannot use {min_num_points} as " \
+        f"a min threshold: use a value >= 1"
+    assert 0 <= max_resolution <= H3_MAX_RESOLUTION
+
+    assert np.all(shp_points.geom_type == 'Point'), \
+        'Code will work with non Point geometry type, '\
+        'consider taking the centroid or the points in the exterior of ' \
+        'a polygon if this makes sense.'
+
+    if count_column_name is not None:
+        assert count_column_name in shp_points.columns
+        counts_points = shp_points[count_column_name].to_numpy(dtype=float)
+    else:
+        logger.info('No column provided for counts - assuming each row has 1 count')
+        count_column_name = 'counts'
+        counts_points = np.ones(shp_points.shape[0])
+
+    # Single (python) indexing step
+    h3_indices_points = get_h3_index(shp_points, resolution=max_resolution)
+
+    # Highest resolution such that only 1 cell contains all the points
+    init_resolution = max_resolution
+    while init_resolution > 0 and np.unique(_get_h3_parent(h3_indices_points, init_resolution)).shape[0] > 1:
+        init_resolution -= 1
+
+    # Cover the entire extent (including empty cells) + make sure all points are in a cell
+    h3_cells = _get_h3_parent(h3_indices_points, init_resolution)
+    xmin, ymin, xmax, ymax = shp_points.to_crs(4326).total_bounds
+    if xmax > xmin and ymax > ymin:
+        shp_extent = gpd.GeoDataFrame(geometry=[box(xmin, ymin, xmax, ymax)], crs=4326)
+        h3_cells = np.concatenate([h3_cells,
+                                   get_h3_polyfill(shp_extent, init_resolution, contain='overlap').h3_index.values])
+    h3_cells = np.unique(h3_cells)
+
+    list_complete = []
+    dict_layers = {}
+
+    # Progressively break down cells that have more points than the lower bound threshold
+    for r in range(init_resolution, max_resolution + 1):
+
+        counts = _count_by_h3_cells(h3_cells, _get_h3_parent(h3_indices_points, r), counts_points)
+        is_suff_precise = counts <= min_num_points
+
+        # Append final results
+        if np.any(is_suff_precise):
+            shp_suff_precise = get_h3_boundaries(h3_cells[is_suff_precise])
+            shp_suff_precise[count_column_name] = counts[is_suff_precise]
+
+            list_complete.append(shp_suff_precise)
+            dict_layers[r] = shp_suff_precise
+
+        # Check if we reached the max resolution and would still require greater resolution to meet the threshold condition
+        if (r == max_resolution) & np.any(~is_suff_precise):
+            logger.warning('Warning! Reached the maximum number of iterations (given the max resolution) without '
+                           'creating a sufficiently precise h3 grid')
+
+            # Still append the cells even if they are not suff precise
+            shp_not_suff_precise = get_h3_boundaries(h3_cells[~is_suff_precise])
+            shp_not_suff_precise[count_column_name] = counts[~is_suff_precise]
+
+            list_complete.append(shp_not_suff_precise)
+            dict_layers[r] = pd.concat([dict_layers[r], shp_not_suff_precise]) if r in dict_layers.keys() else shp_not_suff_precise
+
+        elif np.any(~is_suff_precise):
+            # Refine these cells at the next resolution
+            h3_cells = _get_h3_children(h3_cells[~is_suff_precise])
+        else:
+            # We are done: all cells are sufficiently precise
+            break
+
+    shp_partionned = pd.concat(list_complete)
+
+    return shp_partionned, dict_layers
@@ -6,7 +6,7 @@ from scipy.spatial import cKDTree as KDTree
 # http://docs.scipy.org/doc/scipy/reference/spatial.html
 import geopandas as gpd
 import pandas as pd
-from insights.utilities.util_geo import get_matrix_point_coordinates
+from geo_py_utils.geo_general.geo_utils import get_matrix_point_coordinates
 
 # ...............................................................................
 
@@ -1,81 +1,137 @@
 
 
+import contourpy
 import numpy as np
-import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
 import scipy.stats as st
+import shapely
 import re
-import matplotlib.pyplot as plt
 
 
-def get_2D_kernel_estimate(shp, cell_size=100j, crs=3857, bw_method='scott', range_factor_bbox=0.5):
+def _get_frequency_bw_method(bw_method, num_obs: float, num_dims: int = 2):
+    """Translate a named bandwidth rule to a scalar factor computed with the total number of observations
+
+    `st.gaussian_kde` treats weights as reliability weights and derives the 'scott' and 'silverman'
+    factors from the effective sample size (sum(w)^2 / sum(w^2)). Counts are frequency weights:
+    the bandwidth should be the same as if each row had been replicated `count` times.
+
+    Args:
+        bw_method (Union[str, float, callable]): bandwidth method passed to `st.gaussian_kde`
+        num_obs (float): total number of observations (sum of the counts)
+        num_dims (int, optional): number of dimensions. Defaults to 2.
+
+    Returns:
+        Union[float, callable]: scalar bandwidth factor if bw_method was a named rule, otherwise bw_method unchanged
+    """
+
+    if bw_method == 'scott':
+        return num_obs ** (-1. / (num_dims + 4))
+    if bw_method == 'silverman':
+        return (num_obs * (num_dims + 2) / 4.) ** (-1. / (num_dims + 4))
+
+    return bw_method
+
+
+def get_2D_kernel_estimate(shp, cell_size=100j, crs=3857, bw_method='scott', range_factor_bbox=0.5, weights=None):
 
     """Create a 2D kernel density estimate 
 
+    Args:
+        weights (np.array, optional): frequency weights (e.g. counts) for each row. Defaults to None.
+
     Returns:
         tuple np.array: _description_
     """
 
-    # Project
-    shp['easting'] = shp.to_crs(crs).apply(lambda x: x['geometry'].x, axis=1)
-    shp['northing'] = shp.to_crs(crs).apply(lambda x: x['geometry'].y, axis=1)
+    # Project once and extract the coordinates as a (n, 2) array - does not modify shp
+    geometries = np.asarray(shp.geometry.to_crs(crs).values)
+    if not np.all(shapely.get_type_id(geometries) == 0):
+        raise ValueError('Fatal error in get_2D_kernel_estimate! geometry needs to be Point')
+
+    coords = shapely.get_coordinates(geometries)
 
     # For the 2D kernel estimate: https://stackoverflow.com/questions/30145957/plotting-2d-kernel-density-estimation-with-python
-    values = shp[["easting", "northing"]].to_numpy().T  # Needs to have 2 rows
+    values = coords.T  # Needs to have 2 rows
 
     # Bounding box - make it slightly larger to avoid edge effects
-    range_x = (shp.easting.max()-shp.easting.min())
-    range_y = (shp.northing.max()-shp.northing.min())
-    xmin, xmax = shp.easting.min() - range_factor_bbox * \
-        range_x, shp.easting.max() + range_factor_bbox * range_x
-    ymin, ymax = shp.northing.min() - range_factor_bbox * \
-        range_y, shp.northing.max() + range_factor_bbox * range_y
+    (easting_min, northing_min), (easting_max, northing_max) = coords.min(axis=0), coords.max(axis=0)
+    range_x = (easting_max - easting_min)
+    range_y = (northing_max - northing_min)
+    xmin, xmax = easting_min - range_factor_bbox * \
+        range_x, easting_max + range_factor_bbox * range_x
+    ymin, ymax = northing_min - range_factor_bbox * \
+        range_y, northing_max + range_factor_bbox * range_y
 
     # 2D grid
     xx, yy = np.mgrid[xmin:xmax:cell_size, ymin:ymax:cell_size]
 
     positions = np.vstack([xx.ravel(), yy.ravel()])
-    kernel = st.gaussian_kde(values, bw_method=bw_method)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        bw_method = _get_frequency_bw_method(bw_method, weights.sum(), num_dims=values.shape[0])
+
+    kernel = st.gaussian_kde(values, bw_method=bw_method, weights=weights)
     kern_dens_2d = np.reshape(kernel(positions).T, xx.shape)
 
     return xx, yy, kern_dens_2d
 
 
-def convert_2D_kernel_polygon(xx, yy, kern_dens_2d) -> gpd.GeoDataFrame:
+def convert_2D_kernel_polygon(xx, yy, kern_dens_2d, levels=8) -> gpd.GeoDataFrame:
     """Create a geodf with polygon geometry representing the 2D KDE
 
     For contour conversion to Polygon + value extracion.
+    Each row is the region where the density is >= a given level: all the rings and holes at that level are kept (MultiPolygon).
+
+    Contours are computed with contourpy directly (the engine behind matplotlib) so no pyplot figure is created:
+    safe to call repeatedly in a long running process.
 
     Reference:
-        https://gis.stackexchange.com/questions/99917/converting-matplotlib-contour-objects-to-shapely-objects
+        https://contourpy.readthedocs.io/en/latest/user_guide/fill_type.html
 
     Args:
-        xx (_type_): _description_
-        yy (_type_): _description_
-        kern_dens_2d (_type_): _description_
+        xx (np.array): 2D grid of x coordinates (e.g. from get_2D_kernel_estimate)
+        yy (np.array): 2D grid of y coordinates
+        kern_dens_2d (np.array): density evaluated over the grid
+        levels (Union[int, list], optional): number of equally spaced levels strictly between the min and max density or explicit levels. Defaults to 8.
 
     Returns:
-        gpd.GeoDataFrame: _description_
+        gpd.GeoDataFrame: one row per non empty level with a `density` column (the level) and MultiPolygon geometry
     """
-    # 
-    cs = plt.contour(xx, yy, kern_dens_2d)
-
-    list_polygons = []
-    list_vals = []
-    for i in range(len(cs.collections)):
-        try:
-            p = cs.collections[i].get_paths()[0]
-            v = p.vertices
-            x = v[:, 0]
-            y = v[:, 1]
-            poly = Polygon([(i[0], i[1]) for i in zip(x, y)])
-            list_polygons.append(poly)
-            list_vals.append(cs.levels[i])
-        except Exception as e:
-            print(f'Error in convert_2D_kernel_polygon with {i} - {e}')
-
-    shp_poly = gpd.GeoDataFrame(list_vals,  geometry=list_polygons)
+
+    if np.ndim(levels) == 0:
+        levels = np.linspace(np.min(kern_dens_2d), np.max(kern_dens_2d), int(levels) + 2)[1:-1]
+    levels = np.asarray(levels, dtype=float)
+
+    contour_generator = contourpy.contour_generator(xx, yy, kern_dens_2d, fill_type=contourpy.FillType.OuterOffset)
+
+    # Collect the rings of each polygon (outer boundary first, then holes) for each level
+    list_points = []
+    list_ring_sizes = []
+    list_num_rings = []
+    list_level_idx = []
+    for k, level in enumerate(levels):
+        points_by_poly, offsets_by_poly = contour_generator.filled(level, np.inf)
+        for points, offsets in zip(points_by_poly, offsets_by_poly):
+            list_points.append(points)
+            list_ring_sizes.append(np.diff(offsets))
+            list_num_rings.append(len(offsets) - 1)
+            list_level_idx.append(k)
+
+    multipolygons = np.full(len(levels), None, dtype=object)
+
+    if len(list_points) > 0:
+        ring_sizes = np.concatenate(list_ring_sizes)
+
+        # Vectorized construction: coordinates -> rings -> polygons -> one multipolygon per level
+        rings = shapely.linearrings(np.concatenate(list_points),
+                                    indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes))
+        polygons = shapely.polygons(rings,
+                                    indices=np.repeat(np.arange(len(list_num_rings)), list_num_rings))
+        shapely.multipolygons(polygons, indices=np.array(list_level_idx), out=multipolygons)
+
+    idx_non_empty = ~shapely.is_missing(multipolygons)
+    shp_poly = gpd.GeoDataFrame({'density': levels[idx_non_empty]},
+                                geometry=multipolygons[idx_non_empty])
 
     return shp_poly
 
@@ -85,6 +141,7 @@ def get_polygon_estimate_2D_kernel_from_shp(shp : gpd.geodataframe.GeoDataFrame,
                                             col_name_for_counts: int =None,
                                             thresh_density_lb = 0,
                                             *args,
+                                            levels = 8,
                                             **kwargs):
     """Main entry point that calls get_2D_kernel_estimate to create the 2D functions + convert_2D_kernel_polygon which gets the contours + convert to Polygon
 
@@ -92,9 +149,10 @@ def get_polygon_estimate_2D_kernel_from_shp(shp : gpd.geodataframe.GeoDataFrame,
     Args:
         shp (_type_): _description_
         cell_size (_type_, optional): _description_. Defaults to 100j.
-        col_name_for_counts (_type_, optional): column name that indicates count/number at that location and should be used to replicate the row lat lng . Defaults to None.
+        col_name_for_counts (_type_, optional): column name that indicates count/number at that location and should be used to weight the row lat lng . Defaults to None.
         bw_method (str, optional): Parampassed to scipt.st_gaussian so can be string, float or callable. Defaults to 'scott'.
         thresh_density_lb (float) : minimum value that the density can take -- will only keep simple features such that  density > thresh_density_lb
+        levels (Union[int, list], optional): keyword only - number of contour levels or explicit levels - see convert_2D_kernel_polygon. Defaults to 8.
     Returns:
         _type_: _description_
     """
@@ -104,32 +162,30 @@ def get_polygon_estimate_2D_kernel_from_shp(shp : gpd.geodataframe.GeoDataFrame,
 
     init_crs = shp.crs
 
-    # Multiply the number of rows r times
+    # Weight each row by its count: same estimate as replicating the row r times
     # Useful fror instance if a given polygon has e.g. 38 observations
     # Not useful if we only want presence density
+    weights = None
     if col_name_for_counts is not None:
 
-        print("Using \'%s\' to multiply each row for 2D KDE estimation"  % col_name_for_counts)
+        print("Using \'%s\' to weight each row for 2D KDE estimation"  % col_name_for_counts)
 
         assert re.match('int', str(
             shp[col_name_for_counts].dtype)), 'Fatal error make sure %s is integer' % col_name_for_counts
 
-        # Replicate rows 
-        shp = gpd.GeoDataFrame(
-            pd.concat(
-                [shp.iloc[np.array(i).repeat(shp[col_name_for_counts].values[i])]
-                 for i in range(shp.shape[0])]
-            )
-        )
+        # Rows with no observations would have been dropped by the replication: dont let them widen the bbox
+        shp = shp.loc[shp[col_name_for_counts] > 0]
+        assert shp.shape[0] > 0, 'Fatal error! %s has no positive counts' % col_name_for_counts
+
+        weights = shp[col_name_for_counts].to_numpy()
 
     xx, yy, kern_dens_2d = get_2D_kernel_estimate(
-        shp, cell_size=cell_size, crs=3857, *args,  **kwargs)
+        shp, cell_size=cell_size, crs=3857, weights=weights, *args,  **kwargs)
 
-    # Housekeeping - renaming + conversion to initial crs
-    shp_poly = convert_2D_kernel_polygon(xx, yy, kern_dens_2d).\
+    # Housekeeping - conversion to initial crs
+    shp_poly = convert_2D_kernel_polygon(xx, yy, kern_dens_2d, levels=levels).\
         set_crs(3857).\
-        to_crs(init_crs).\
-        rename(columns={0: 'density'})
+        to_crs(init_crs)
 
     # Filter out slithers and bugs with density that is excessively small
     shp_poly = shp_poly.loc[shp_poly.density > thresh_density_lb, ]
@@ -1,33 +1,70 @@
-
-from shapely.validation import make_valid # requires shapely-1.8.2 and basically does things like convert polygons to multipolygons
+from multiprocessing import Pool
+import shapely  # make_valid requires shapely >= 2 for the vectorized version and basically does things like convert polygons to multipolygons
 import geopandas as gpd
+import numpy as np
+import logging
+
+
+logger = logging.getLogger(__name__)
 
 
 def make_valid_gpd(shp: gpd.GeoDataFrame,
-                   unsafely_remove_violations=False) -> gpd.GeoDataFrame:
+                   unsafely_remove_violations=False,
+                   n_jobs: int = 1,
+                   chunk_size: int = 10000) -> gpd.GeoDataFrame:
     """Make each geometry valid in a geodf
 
+    Validity is checked once for all geometries and shapely.make_valid is only called on the invalid ones
+    The input geodataframe is not modified
 
     Args:
-        shp (gpd.GeoDataFrame): geodataframe to use 
+        shp (gpd.GeoDataFrame): geodataframe to use
+        unsafely_remove_violations (bool, optional): drop the rows that are still invalid (or missing) after make_valid. Defaults to False.
+        n_jobs (int, optional): number of processes used to repair the invalid geometries - only used with more than chunk_size invalid geometries. Defaults to 1.
+        chunk_size (int, optional): number of invalid geometries sent to each process at a time. Defaults to 10000.
 
     Returns:
-        gpd.GeoDataFrame: geodataframe with POINT geometry
+        gpd.GeoDataFrame: geodataframe with valid geometries
     """
     assert isinstance(shp, gpd.GeoDataFrame)
 
-    # Try to make each geometry valid
-    shp['geometry'] = [make_valid(g) for g in shp['geometry']]
+    geometries = np.asarray(shp.geometry.values)
+
+    # Missing geometries are not invalid, there is simply nothing to fix
+    idx_invalid = np.flatnonzero(~shapely.is_valid(geometries) & ~shapely.is_missing(geometries))
+    logger.info(f'make_valid_gpd: {idx_invalid.shape[0]} invalid geometries out of {geometries.shape[0]}')
+
+    # Work on a shallow copy - the geometry column is replaced, never modified in place
+    shp = shp.copy(deep=False)
+
+    if idx_invalid.shape[0] > 0:
+
+        geometries = geometries.copy()
+
+        # Try to make each invalid geometry valid
+        if n_jobs > 1 and idx_invalid.shape[0] > chunk_size:
+            chunks = np.array_split(geometries[idx_invalid], int(np.ceil(idx_invalid.shape[0] / chunk_size)))
+            with Pool(n_jobs) as p:
+                geometries[idx_invalid] = np.concatenate(p.map(shapely.make_valid, chunks))
+        else:
+            geometries[idx_invalid] = shapely.make_valid(geometries[idx_invalid])
+
+        shp[shp.geometry.name] = gpd.GeoSeries(geometries, index=shp.index, crs=shp.crs)
 
     # Additional step : if we really want
     if unsafely_remove_violations:
         n_before = shp.shape[0]
-        idx_to_drop = ~shp['geometry'].is_valid
-        shp = shp.loc[~idx_to_drop, ]
-        n_after = shp.shape[0]
-        n_removed = n_before - n_after
 
-        if n_removed > 0:  print( 'Removed {n_removed} invalid features that could not be fixed by shapely.validation.make_valid()')
-        if shp.shape[0] == 0:  print('Warning! no more rows in geodf')
+        # Only the repaired geometries can still be invalid
+        is_to_drop = shapely.is_missing(geometries)
+        is_to_drop[idx_invalid] |= ~shapely.is_valid(geometries[idx_invalid])
+        shp = shp.loc[~is_to_drop, ]
+
+        n_removed = n_before - shp.shape[0]
+
+        if n_removed > 0:
+            logger.warning(f'Removed {n_removed} invalid features that could not be fixed by shapely.make_valid()')
+        if shp.shape[0] == 0:
+            logger.warning('Warning! no more rows in geodf')
 
     return shp
@@ -1,22 +1,276 @@
- 
+
 #Created on September 15 2021
 #@author: charles gauvin
 #Callable class used to cache long query results that can be used with the @wrapper syntax
 
- 
+
 
 import pandas as pd
 import geopandas as gpd
+import numpy as np
+import shapely
+import pyarrow.parquet as pq
 import logging
-from os.path import isdir,dirname, isfile, splitext
-from os import makedirs
-from typing import Union 
+import hashlib
+import inspect
+import io
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial, wraps
+from os.path import dirname, isfile, splitext, join
+from os import makedirs, PathLike
+from pyproj import CRS
+from pyproj.exceptions import CRSError
+from typing import Union, Iterable
+
+from geo_py_utils.misc.cache_manager import DEFAULT_CACHE_ROOT, CacheManager, read_metadata, write_metadata, touch_cache_file, is_expired
+
 
- 
 
 # Set logger
 logger = logging.getLogger(__file__)
 
+CacheInfo = namedtuple('CacheInfo', ['memory_hits', 'disk_hits', 'misses', 'memory_entries', 'memory_bytes', 'refreshes'])
+
+
+def _estimate_nbytes(df: Union[pd.DataFrame, gpd.GeoDataFrame]) -> int:
+    """Estimated memory footprint of a (geo)dataframe - geometries are counted as 16 bytes per coordinate"""
+
+    nbytes = int(df.memory_usage(deep=True, index=True).sum())
+    for col in df.columns[df.dtypes == 'geometry']:
+        nbytes += 16 * int(shapely.get_num_coordinates(np.asarray(df[col].values)).sum())
+
+    return nbytes
+
+
+# Seconds for the owner of a new lock file to write its pid in it: empty or corrupted locks older than this are stale
+LOCK_WRITE_GRACE = 10
+
+# Column storing the original row order of geo data written sorted by hilbert distance
+ROW_ORDER_COL = '_cache_row_order'
+
+# Memory hits update the last access time of the parquet file at most this often (seconds) - used by CacheManager.prune
+TOUCH_INTERVAL = 60
+
+
+def _sort_by_hilbert_distance(shp: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Sort the rows along a hilbert curve so that each row group covers a small bbox - the original order is kept in ROW_ORDER_COL
+
+    Missing and empty geometries are put last
+    """
+
+    geometries = np.asarray(shp.geometry.values)
+    is_located = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+
+    hilbert_distance = np.full(geometries.shape[0], np.iinfo(np.int64).max)
+    if is_located.any():
+        hilbert_distance[is_located] = gpd.GeoSeries(geometries[is_located]).hilbert_distance().to_numpy()
+
+    return shp.assign(**{ROW_ORDER_COL: np.arange(shp.shape[0])}).iloc[np.argsort(hilbert_distance, kind='stable')]
+
+
+def _filter_columns_bbox(df: Union[pd.DataFrame, gpd.GeoDataFrame],
+                         columns: list = None,
+                         bbox: tuple = None) -> Union[pd.DataFrame, gpd.GeoDataFrame]:
+    """Same projection as a read with columns and bbox pushdown, but in memory
+
+    Keeps the rows whose geometry bounds intersect the bbox (like the covering bbox filter) and the columns (+ the geometry)
+    """
+
+    if bbox is not None:
+        if isinstance(df, gpd.GeoDataFrame):
+            xmin, ymin, xmax, ymax = bbox
+            bounds = shapely.bounds(np.asarray(df.geometry.values))
+            df = df.loc[(bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)]
+        else:
+            logger.warning('bbox is ignored for non geo data')
+
+    if columns is not None:
+        if isinstance(df, gpd.GeoDataFrame):
+            columns = list(dict.fromkeys([*columns, df.geometry.name]))
+        df = df[columns]
+
+    return df.reset_index(drop=True)
+
+
+def _write_atomically(path: str, data: bytes):
+    """Write to a temp file in the same directory, then rename: the file is either absent, the old one or complete"""
+
+    path_tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(path_tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_tmp, path)
+    finally:
+        if isfile(path_tmp):
+            os.remove(path_tmp)
+
+
+def _is_lock_stale(path_lock: str, stale_after: float) -> bool:
+    """True if the lock is older than stale_after seconds or its owner process (on this host) is dead"""
+
+    try:
+        lock_stat = os.stat(path_lock)
+    except FileNotFoundError:
+        return False
+
+    if time.time() - lock_stat.st_mtime > stale_after:
+        return True
+
+    try:
+        with open(path_lock) as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        # Not written yet by its owner - or never will be if it died right after creating the lock
+        return time.time() - lock_stat.st_mtime > LOCK_WRITE_GRACE
+
+    # os.kill(pid, 0) only checks that the process exists on posix (it terminates the process on windows)
+    if os.name == 'posix' and owner.get('host') == socket.gethostname():
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+
+    return False
+
+
+def _break_stale_lock(path_lock: str):
+    """Remove a stale lock without removing a fresh lock taken by another process in between"""
+
+    lock_stat = os.stat(path_lock)
+    path_stale = f'{path_lock}.{os.getpid()}.{threading.get_ident()}.stale'
+    os.rename(path_lock, path_stale)
+
+    # Another process broke the stale lock and took a new one before our rename: put it back (unless a third one already did)
+    if os.stat(path_stale).st_ino != lock_stat.st_ino:
+        try:
+            os.link(path_stale, path_lock)
+        except OSError:
+            pass
+    os.remove(path_stale)
+
+
+@contextmanager
+def _cache_file_lock(path_cache: str, stale_after: float = 7200, poll_interval: float = 0.2, wait: bool = True):
+    """Inter-process lock on a cached file: <path_cache>.lock created with O_EXCL
+
+    Waits (polling) while another live process holds the lock. Locks of dead processes or older than stale_after seconds are broken
+
+    Args:
+        path_cache (str): path of the cached file
+        stale_after (float, optional): max age of a lock in seconds. Defaults to 7200.
+        poll_interval (float, optional): seconds between attempts. Defaults to 0.2.
+        wait (bool, optional): if False, do not wait for another process and yield False. Defaults to True.
+
+    Yields:
+        bool: True if the lock is acquired
+    """
+
+    path_lock = f'{path_cache}.lock'
+    is_waiting = False
+
+    while True:
+        try:
+            fd = os.open(path_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if _is_lock_stale(path_lock, stale_after):
+                logger.warning(f'Breaking stale lock {path_lock}')
+                try:
+                    _break_stale_lock(path_lock)
+                except FileNotFoundError:
+                    pass
+                continue
+            if not wait:
+                yield False
+                return
+            if not is_waiting:
+                logger.info(f'Waiting for another process to create {path_cache} ...')
+                is_waiting = True
+            time.sleep(poll_interval)
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'created': time.time()}, f)
+        yield True
+    finally:
+        try:
+            os.remove(path_lock)
+        except FileNotFoundError:
+            pass
+
+
+def _normalize_arg(arg):
+    """Convert an argument to a json serializable value that only depends on its content
+
+    Used to build stable cache keys: e.g. CRS objects are replaced by their authority code (or wkt) and arrays/dataframes by a hash of their values
+
+    Args:
+        arg: any argument of the cached function
+
+    Returns:
+        json serializable representation
+    """
+
+    if arg is None or isinstance(arg, (bool, int, float, str)):
+        return arg
+    if isinstance(arg, np.generic):
+        return arg.item()
+    if isinstance(arg, PathLike):
+        return str(arg)
+    if isinstance(arg, CRS):
+        authority = arg.to_authority()
+        return {'crs': ':'.join(authority) if authority is not None else arg.to_wkt()}
+    if isinstance(arg, (list, tuple)):
+        return [_normalize_arg(a) for a in arg]
+    if isinstance(arg, (set, frozenset)):
+        return sorted([_normalize_arg(a) for a in arg], key=repr)
+    if isinstance(arg, dict):
+        return {str(k): _normalize_arg(v) for k, v in sorted(arg.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(arg, np.ndarray):
+        return {'ndarray': hashlib.sha256(np.ascontiguousarray(arg).tobytes()).hexdigest(),
+                'dtype': str(arg.dtype),
+                'shape': list(arg.shape)}
+    if isinstance(arg, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        return {'geo': _normalize_arg(arg.to_wkb() if isinstance(arg, gpd.GeoSeries) else pd.DataFrame(arg.to_wkb())),
+                'crs': _normalize_arg(arg.crs)}
+    if isinstance(arg, (pd.DataFrame, pd.Series)):
+        return {'pandas': hashlib.sha256(pd.util.hash_pandas_object(arg, index=True).values.tobytes()).hexdigest(),
+                'columns': [str(c) for c in arg.columns] if isinstance(arg, pd.DataFrame) else str(arg.name)}
+    if isinstance(arg, partial):
+        return {'partial': _normalize_arg(arg.func),
+                'args': _normalize_arg(arg.args),
+                'keywords': _normalize_arg(arg.keywords)}
+    if inspect.ismethod(arg):
+        # Bound methods of distinct instances are distinct
+        return {'method': _normalize_arg(arg.__func__),
+                'self': _normalize_arg(arg.__self__)}
+    if inspect.isfunction(arg) and (arg.__name__ == '<lambda>' or arg.__closure__):
+        # Same name for all the lambdas of a module / closures depend on their captured variables
+        raise TypeError(f'Cannot build a stable cache key from the lambda or closure {arg.__qualname__} - use a named function or functools.partial')
+    if callable(arg) and hasattr(arg, '__qualname__'):
+        return {'callable': f'{getattr(arg, "__module__", "")}.{arg.__qualname__}'}
+    if hasattr(arg, '__dict__'):
+        # e.g. self for methods: use the attributes
+        return {'class': f'{type(arg).__module__}.{type(arg).__qualname__}',
+                'vars': _normalize_arg(vars(arg))}
+
+    # The default repr contains the memory address: a new key (and file) for each call
+    if type(arg).__repr__ is object.__repr__:
+        raise TypeError(f'Cannot build a stable cache key from {type(arg).__qualname__} arguments - use path_cache or exclude_args')
+
+    return repr(arg)
+
 
 class Cache_wrapper:
 
@@ -29,109 +283,526 @@ class Cache_wrapper:
     def foo():
         pass
     ```
-    
+
+    or without a path: the file name is then derived from the function and its arguments
+
+    ```
+    @Cache_wrapper(cache_root='bla')
+    def foo(year, new_crs=None):
+        pass
+
+    foo(2021) # bla/foo_<hash>.parquet
+    foo.cache_path(2021) # path of the cached file without calling foo
+    ```
+
+    The key is a sha256 hash of the function qualified name, its version (or source code)
+    and its normalized arguments including defaults (see _normalize_arg): distinct arguments never collide.
+    Arguments whose name ends with crs (e.g. new_crs) are parsed as crs so that 3347, 'EPSG:3347' and CRS(3347) share the same file.
+    Arguments without a stable representation (default repr with a memory address) raise a TypeError: exclude them or use path_cache
+
     Tries the following file formats in order and moves to next only in case of failure:
 
     1) .parquet
     2) extension considered in name (e.g. csv or geojson if path_cache = 'bla.csv')
     3) if Geodf, alternative geoformat (either shp or geojson )
 
+    Two tiers: results are also kept in a bounded in memory LRU (per decorated function) in front of the parquet files.
+    Copies are returned so that callers cannot modify the cached frames.
+    foo.cache_info() gives the memory/disk hits and misses and foo.cache_clear() empties the memory tier
+
+    Geo data is written as GeoParquet with a covering bbox column and rows sorted along a hilbert curve (the original order is restored on read).
+    foo(..., cache_columns=[...], cache_bbox=(xmin, ymin, xmax, ymax)) only reads the required columns and row groups (bbox in the crs of the data)
+
+    With max_age, results older than max_age are returned immediately and refreshed in a background thread (foo.wait_for_refresh() to wait for it)
+
+    Each parquet file has a json sidecar with its function, creation time, size and checksum: see cache_manager.CacheManager to list and prune the cache
+
+    Safe with concurrent processes: a lock file makes sure only one process computes a result while the others wait and read it back,
+    files are written to a temp file then renamed and corrupted files (checksum mismatch) are recomputed
+
 
     Attributes:
         path_cache (str), Default[None]
-            Path of destination file with parquet extention 
+            Fixed path of destination file with parquet extention - overrides the argument based key
         pd_save_index (boolean), Default[False]
-            Save pandas index?  
+            Save pandas index?
         force_overwrite (boolean), Default[False]
-            Run the function even the results have been cached 
-
+            Run the function even the results have been cached
+        cache_root (str), Default[DATA_DIR/cache]
+            Directory of the cached files when path_cache is None
+        version (str), Default[None]
+            Version of the function used in the key - if None, the source code is used so that changing the function invalidates the cache
+        cache_root_arg (str), Default[None]
+            Name of an argument of the function that overrides cache_root (e.g. path_cache_root) - not part of the key
+        exclude_args (Iterable[str]), Default[()]
+            Names of arguments that do not change the result (e.g. a download directory) - not part of the key
+        memory_max_entries (int), Default[16]
+            Max number of results kept in memory - 0 disables the memory tier
+        memory_max_bytes (int), Default[1GB]
+            Max estimated size of the results kept in memory
+        ttl (Union[float, timedelta]), Default[None]
+            Time to live in seconds: older results are recomputed - None to keep them forever
+        max_age (Union[float, timedelta]), Default[None]
+            Freshness window in seconds: older results are still returned right away but recomputed in a background thread (stale-while-revalidate)
+        max_cache_bytes (int), Default[None]
+            Size quota of the cache directory: the least recently used files are removed after each new file
+        lock_stale_after (float), Default[7200]
+            Seconds after which the lock of a process computing a result is considered stale (e.g. killed process on another host)
+        lock_poll_interval (float), Default[0.2]
+            Seconds between two checks of the lock while waiting for another process
+        row_group_size (int), Default[10000]
+            Max number of rows per parquet row group: smaller groups make bbox reads more selective
     """
 
-    def __init__(self, 
-                path_cache,
-                pd_save_index=False, 
-                force_overwrite=False):
+    def __init__(self,
+                path_cache=None,
+                pd_save_index=False,
+                force_overwrite=False,
+                cache_root: str = DEFAULT_CACHE_ROOT,
+                version: str = None,
+                cache_root_arg: str = None,
+                exclude_args: Iterable[str] = (),
+                memory_max_entries: int = 16,
+                memory_max_bytes: int = 2**30,
+                ttl: Union[float, timedelta] = None,
+                max_age: Union[float, timedelta] = None,
+                max_cache_bytes: int = None,
+                lock_stale_after: float = 7200,
+                lock_poll_interval: float = 0.2,
+                row_group_size: int = 10000):
 
         self.path_cache = path_cache
         self.pd_save_index = pd_save_index
         self.force_overwrite = force_overwrite
+        self.cache_root = cache_root
+        self.version = version
+        self.cache_root_arg = cache_root_arg
+        self.exclude_args = tuple(exclude_args)
+        self.memory_max_entries = memory_max_entries
+        self.memory_max_bytes = memory_max_bytes
+        self.ttl = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+        self.max_age = max_age.total_seconds() if isinstance(max_age, timedelta) else max_age
+        self.max_cache_bytes = max_cache_bytes
+        self.lock_stale_after = lock_stale_after
+        self.lock_poll_interval = lock_poll_interval
+        self.row_group_size = row_group_size
+
+        # Memory tier: path_cache -> (df, nbytes, metadata) from least to most recently used
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'refreshes': 0}
+        self._refresh_threads = {}
+        self._function_versions = {}
+        self._last_touch = {}
+
+        # Make sure we save as parquet
+        # Not the same interface with and without parquet - using a more general data format is good, but adds to mnay flows to the code
+        if self.path_cache is not None:
+            path_pre, path_ext = splitext(self.path_cache)
+            if path_ext != ".parquet":
+                raise ValueError(f"Fatal error, extension is {path_ext} - should be .parquet ")
+
+
+    def _get_function_version(self, fun) -> str:
+        """Version used in the key: explicit version or hash of the source code"""
+
+        if self.version is not None:
+            return str(self.version)
+
+        # Only read the source once: this is on the path of every memory hit
+        if fun not in self._function_versions:
+            try:
+                self._function_versions[fun] = hashlib.sha256(inspect.getsource(fun).encode()).hexdigest()
+            except (OSError, TypeError):
+                logger.warning(f'Cannot get the source code of {fun.__qualname__} - set a version to invalidate the cache when it changes')
+                self._function_versions[fun] = ''
+
+        return self._function_versions[fun]
+
+
+    def _get_cache_path(self, fun, *kws, **kwargs) -> str:
+        """
+        Get the path of the cached file for fun(*kws, **kwargs)
+
+        Returns:
+            str: path with parquet extension
+        """
+
+        if self.path_cache is not None:
+            return self.path_cache
 
-        # Make sure we save as parquet 
-        # Not the same interface with and without parquet - using a more general data format is good, but adds to mnay flows to the code 
-        path_pre, path_ext = splitext(self.path_cache)
-        if path_ext != ".parquet":
-            raise ValueError(f"Fatal error, extension is {path_ext} - should be .parquet ")
+        # Bind all arguments to their names (including defaults) so that f(1) and f(x=1) share the same key
+        bound_args = inspect.signature(fun).bind(*kws, **kwargs)
+        bound_args.apply_defaults()
+        dict_args = dict(bound_args.arguments)
 
+        cache_root = self.cache_root
+        if self.cache_root_arg is not None:
+            cache_root = dict_args.pop(self.cache_root_arg)
 
-    def _read_existing_file(self) -> Union[pd.DataFrame, gpd.GeoDataFrame]:
+        for arg_name in self.exclude_args:
+            dict_args.pop(arg_name, None)
+
+        # new_crs=3347, new_crs='EPSG:3347' and new_crs=CRS(3347) share the same key
+        for arg_name, arg in dict_args.items():
+            if arg_name.endswith('crs') and isinstance(arg, (int, str)) and not isinstance(arg, bool):
+                try:
+                    dict_args[arg_name] = CRS.from_user_input(arg)
+                except CRSError:
+                    pass
+
+        key = json.dumps({'function': f'{fun.__module__}.{fun.__qualname__}',
+                          'version': self._get_function_version(fun),
+                          'args': _normalize_arg(dict_args)},
+                         sort_keys=True)
+
+        return join(cache_root, f'{fun.__name__}_{hashlib.sha256(key.encode()).hexdigest()[:32]}.parquet')
+
+
+    def _read_existing_file(self,
+                            path_cache: str,
+                            sha256: str = None,
+                            columns: list = None,
+                            bbox: tuple = None) -> Union[pd.DataFrame, gpd.GeoDataFrame]:
         """
         Try to read back an existing file from cache
 
+        Geo data is detected from the 'geo' metadata of the parquet file.
+        With columns or bbox, only the required columns and row groups (from the covering bbox statistics) are read
+
+        Args:
+            path_cache (str): path of the cached file
+            sha256 (str, optional): expected checksum of the file (from the sidecar) - not checked if None or for partial reads. Defaults to None.
+            columns (list, optional): columns to read - the geometry is always read. Defaults to None.
+            bbox (tuple, optional): (xmin, ymin, xmax, ymax) in the crs of the data: only read the rows whose bounds intersect it. Defaults to None.
+
+        Raises:
+            ValueError: if the file is corrupted (checksum mismatch) or cannot be read
+
         Returns:
-            Union[pd.DataFrame, gpd.GeoDataFrame]: _description_
+            Union[pd.DataFrame, gpd.GeoDataFrame]: cached df
         """
-        logger.info(f'Reading back {self.path_cache} ...')
- 
+        logger.info(f'Reading back {path_cache} ...')
+
+        if columns is None and bbox is None:
+            # Read the bytes once: used for both the checksum and the parsing
+            with open(path_cache, 'rb') as f:
+                buffer = f.read()
+
+            if sha256 is not None and hashlib.sha256(buffer).hexdigest() != sha256:
+                raise ValueError(f"Fatal error: checksum of {path_cache} does not match its metadata - truncated or modified file")
+
+            get_source = lambda: io.BytesIO(buffer)
+        else:
+            # Partial read: the checksum would require reading the whole file, only the parquet footer is validated
+            get_source = lambda: path_cache
 
         try:
-            df_result = gpd.read_parquet(self.path_cache)
+            schema = pq.read_schema(get_source())
+            geo_metadata = json.loads(schema.metadata[b'geo']) if schema.metadata is not None and b'geo' in schema.metadata else None
+
+            if geo_metadata is not None:
+                primary_column = geo_metadata['primary_column']
+                has_covering = 'covering' in geo_metadata['columns'][primary_column]
+                if columns is not None:
+                    columns = list(dict.fromkeys([*columns, primary_column, *([ROW_ORDER_COL] if ROW_ORDER_COL in schema.names else [])]))
+                df_result = gpd.read_parquet(get_source(), columns=columns, bbox=bbox if has_covering else None)
+                if bbox is not None and not has_covering:
+                    # Written by an older version
+                    df_result = _filter_columns_bbox(df_result, bbox=bbox)
+            else:
+                if bbox is not None:
+                    logger.warning('bbox is ignored for non geo data')
+                df_result = pd.read_parquet(get_source(), columns=columns)
         except Exception as e:
-            logger.warning(f"Fatal error trying to load back geo data from {self.path_cache} - {str(e)} - trying with pandas")
-            try:
-                df_result = pd.read_parquet(self.path_cache)
-            except Exception as e:
-                raise e(f"Fatal error trying to load back NON geo data from {self.path_cache} - {str(e)}")
-                
+            raise ValueError(f"Fatal error trying to load back data from {path_cache} - {str(e)}") from e
+
+        # Back to the original order
+        if ROW_ORDER_COL in df_result.columns:
+            df_result = df_result.sort_values(ROW_ORDER_COL).drop(columns=ROW_ORDER_COL).reset_index(drop=True)
+
         # Remove useless index if present and if we want to disregard indixes
-        if 'Unnamed: 0' in df_result.columns and not self.pd_save_index:  
+        if 'Unnamed: 0' in df_result.columns and not self.pd_save_index:
             df_result = df_result.drop(columns={'Unnamed: 0'})
-            
+
         return df_result
- 
 
-    
-    def _create_new_file(self, fun, *kws, **kwargs) -> Union[pd.DataFrame, gpd.GeoDataFrame] :
+
+    def _read_valid_file(self, path_cache: str, columns: list = None, bbox: tuple = None) -> Union[tuple, None]:
+        """
+        Read back the cached file if it exists, is not expired and is not corrupted
+
+        Args:
+            path_cache (str): path of the cached file
+            columns (list, optional): see _read_existing_file. Defaults to None.
+            bbox (tuple, optional): see _read_existing_file. Defaults to None.
+
+        Returns:
+            Union[tuple, None]: (df, metadata) or None if the result has to be computed
+        """
+
+        try:
+            metadata = read_metadata(path_cache)
+        except OSError:
+            # No file
+            return None
+
+        if is_expired(metadata):
+            logger.info(f'{path_cache} is older than its ttl - recomputing')
+            return None
+
+        try:
+            df_result = self._read_existing_file(path_cache, metadata.get('sha256'), columns, bbox)
+        except (OSError, ValueError) as e:
+            logger.warning(f'{e} - recomputing')
+            return None
+
+        self._count('disk_hits')
+        self._touch(path_cache, force=True)
+
+        return df_result, metadata
+
+
+    def _create_new_file(self, path_cache: str, fun, *kws, **kwargs) -> tuple :
         """
         Run fun(*kws, **kwargs) and cache the results
 
+        The parquet file is written to a temp file then atomically renamed: readers never see a partial file
+
         Args:
-            fun (_type_): function to run 
+            path_cache (str): path of the cached file
+            fun (_type_): function to run
 
         Returns:
-             Union[pd.DataFrame, gpd.GeoDataFrame] : df created by fun + cached 
+             tuple : df created by fun + cached and its metadata
         """
 
-        logger.info(f'Creating new {self.path_cache} ...')
+        logger.info(f'Creating new {path_cache} ...')
 
         df_result = fun(*kws, **kwargs)
 
+        # GeoParquet with a bbox column (covering) and rows sorted along a hilbert curve: bbox reads only load the matching row groups
+        if isinstance(df_result, gpd.GeoDataFrame):
+            df_to_write = _sort_by_hilbert_distance(df_result)
+            kwargs_parquet = {'write_covering_bbox': True, 'row_group_size': self.row_group_size}
+        else:
+            df_to_write = df_result
+            kwargs_parquet = {'row_group_size': self.row_group_size}
+
+        buffer = io.BytesIO()
         try:
-            # Raw 
-            df_result.to_parquet(self.path_cache, index=False)
+            # Raw
+            df_to_write.to_parquet(buffer, index=False, **kwargs_parquet)
         except Exception:
             # Try converting to string first
             try:
+                buffer = io.BytesIO()
                 df_result.columns = df_result.columns.astype(str)
-                df_result.to_parquet(self.path_cache, engine='pyarrow', index=False)
+                df_to_write.columns = df_to_write.columns.astype(str)
+                df_to_write.to_parquet(buffer, engine='pyarrow', index=False, **kwargs_parquet)
             # Fail: try different paths depending on gpd or pd df
             except Exception as err:
                 logger.error(f'Parquet file creation failed \n{err}')
+                return df_result, self._get_new_metadata(fun)
 
-        return df_result
+        data = buffer.getvalue()
+        _write_atomically(path_cache, data)
+
+        metadata = self._get_new_metadata(fun, size=len(data), sha256=hashlib.sha256(data).hexdigest())
+        write_metadata(path_cache, metadata)
+
+        if self.max_cache_bytes is not None:
+            CacheManager(dirname(path_cache)).prune(max_bytes=self.max_cache_bytes, remove_expired=True)
+
+        return df_result, metadata
+
+
+    def _get_new_metadata(self, fun, size: int = 0, sha256: str = None) -> dict:
+        """Metadata of a new file (see cache_manager.read_metadata)"""
+
+        return {'function': f'{fun.__module__}.{fun.__qualname__}',
+                'created': time.time(),
+                'size': size,
+                'ttl': self.ttl,
+                'sha256': sha256}
+
+
+    def _touch(self, path_cache: str, force: bool = False):
+        """Update the last access time of the parquet file - throttled (TOUCH_INTERVAL) unless force"""
+
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_touch.get(path_cache, 0) < TOUCH_INTERVAL:
+                return
+            self._last_touch[path_cache] = now
+
+        touch_cache_file(path_cache)
+
+
+    def _get_from_memory(self, path_cache: str) -> Union[tuple, None]:
+        """(copy of the result, metadata) in memory (and mark it as most recently used) or None"""
+
+        with self._lock:
+            if path_cache not in self._memory:
+                return None
+            df_result, nbytes, metadata = self._memory[path_cache]
+            if is_expired(metadata):
+                del self._memory[path_cache]
+                self._memory_bytes -= nbytes
+                return None
+            self._stats['memory_hits'] += 1
+            self._memory.move_to_end(path_cache)
+
+        # Otherwise the most used files look unused on disk and are the first ones pruned
+        self._touch(path_cache)
+
+        return df_result.copy(), metadata
 
 
+    def _add_to_memory(self, path_cache: str, df_result: Union[pd.DataFrame, gpd.GeoDataFrame], metadata: dict):
+        """Keep a copy of the result in memory and evict the least recently used results beyond the bounds"""
+
+        if self.memory_max_entries <= 0 or not isinstance(df_result, pd.DataFrame):
+            return
+
+        nbytes = _estimate_nbytes(df_result)
+        if nbytes > self.memory_max_bytes:
+            logger.info(f'Not keeping {path_cache} in memory: {nbytes} bytes is more than {self.memory_max_bytes}')
+            return
+
+        df_copy = df_result.copy()
+
+        with self._lock:
+            if path_cache in self._memory:
+                self._memory_bytes -= self._memory.pop(path_cache)[1]
+
+            self._memory[path_cache] = (df_copy, nbytes, metadata)
+            self._memory_bytes += nbytes
+
+            while len(self._memory) > self.memory_max_entries or self._memory_bytes > self.memory_max_bytes:
+                _, (_, nbytes_evicted, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= nbytes_evicted
+
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+
+    def cache_info(self) -> CacheInfo:
+        """Hits and misses of each tier + current size of the memory tier"""
+
+        with self._lock:
+            return CacheInfo(memory_entries=len(self._memory), memory_bytes=self._memory_bytes, **self._stats)
+
+
+    def cache_clear(self):
+        """Empty the memory tier - the parquet files are left as is"""
+
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+    def _is_stale(self, metadata: dict) -> bool:
+        """True if the result is older than max_age and should be refreshed in the background"""
+        return self.max_age is not None and time.time() - metadata['created'] > self.max_age
+
+
+    def _refresh(self, path_cache: str, fun, kws: tuple, kwargs: dict):
+        """Recompute a stale result - run in a background thread, the stale result is kept if anything fails"""
+
+        try:
+            with _cache_file_lock(path_cache, self.lock_stale_after, self.lock_poll_interval, wait=False) as is_locked:
+                if not is_locked:
+                    logger.info(f'{path_cache} is already being refreshed by another process')
+                    return
+
+                # Refreshed by another process in between: only update the memory tier
+                result = self._read_valid_file(path_cache)
+                if result is None or self._is_stale(result[1]):
+                    self._count('refreshes')
+                    result = self._create_new_file(path_cache, fun, *kws, **kwargs)
+
+                self._add_to_memory(path_cache, *result)
+        except Exception:
+            logger.exception(f'Background refresh of {path_cache} failed - keeping the stale result')
+
+
+    def _refresh_in_background(self, path_cache: str, fun, kws: tuple, kwargs: dict):
+        """Start a daemon thread refreshing path_cache unless one is already running"""
+
+        with self._lock:
+            thread = self._refresh_threads.get(path_cache)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._refresh, args=(path_cache, fun, kws, kwargs), daemon=True)
+            self._refresh_threads[path_cache] = thread
+
+        logger.info(f'{path_cache} is older than {self.max_age} seconds - refreshing in the background')
+        thread.start()
+
+
+    def wait_for_refresh(self, timeout: float = None):
+        """Wait for the background refreshes to finish"""
+
+        with self._lock:
+            list_threads = list(self._refresh_threads.values())
+
+        for thread in list_threads:
+            thread.join(timeout)
+
 
     def __call__(self, fun):
 
-        def inner_wrapper(*kws, **kwargs):
-            if not isdir(dirname(self.path_cache)):
-                makedirs(dirname(self.path_cache))
+        # Call arguments of the wrapper: they would never reach fun
+        list_reserved = [arg for arg in ('cache_columns', 'cache_bbox') if arg in inspect.signature(fun).parameters]
+        if len(list_reserved) > 0:
+            raise ValueError(f'Fatal error! {fun.__qualname__} cannot be cached: {list_reserved} are reserved by Cache_wrapper')
 
-            if isfile(self.path_cache) and not self.force_overwrite:
-                df_result = self._read_existing_file()
-            else:
-                df_result = self._create_new_file(fun, *kws, **kwargs)
+        @wraps(fun)
+        def inner_wrapper(*kws, cache_columns: list = None, cache_bbox: tuple = None, **kwargs):
+            path_cache = self._get_cache_path(fun, *kws, **kwargs)
+            is_partial = cache_columns is not None or cache_bbox is not None
+
+            result = None if self.force_overwrite else self._get_from_memory(path_cache)
+
+            # Only read the required columns and row groups from disk - partial results are not kept in memory
+            if result is None and is_partial and not self.force_overwrite:
+                result = self._read_valid_file(path_cache, cache_columns, cache_bbox)
+                if result is not None:
+                    if self._is_stale(result[1]):
+                        self._refresh_in_background(path_cache, fun, kws, kwargs)
+                    return result[0]
+
+            if result is None:
+                makedirs(dirname(path_cache), exist_ok=True)
+
+                result = None if self.force_overwrite else self._read_valid_file(path_cache)
+
+                if result is None:
+                    # Single flight: only one process computes, the others wait for the lock and read its result
+                    with _cache_file_lock(path_cache, self.lock_stale_after, self.lock_poll_interval):
+                        result = None if self.force_overwrite else self._read_valid_file(path_cache)
+                        if result is None:
+                            self._count('misses')
+                            result = self._create_new_file(path_cache, fun, *kws, **kwargs)
+
+                self._add_to_memory(path_cache, *result)
+
+            df_result, metadata = result
+
+            # Stale while revalidate
+            if self._is_stale(metadata):
+                self._refresh_in_background(path_cache, fun, kws, kwargs)
+
+            return _filter_columns_bbox(df_result, cache_columns, cache_bbox) if is_partial else df_result
 
-            return df_result
+        # Path of the cached file without calling the function
+        inner_wrapper.cache_path = lambda *kws, **kwargs: self._get_cache_path(fun, *kws, **kwargs)
+        inner_wrapper.cache_info = self.cache_info
+        inner_wrapper.cache_clear = self.cache_clear
+        inner_wrapper.wait_for_refresh = self.wait_for_refresh
 
-        return inner_wrapper
\ No newline at end of file
+        return inner_wrapper
@@ -0,0 +1,250 @@
+
+#Metadata, TTL and size quotas of the on-disk cache written by Cache_wrapper
+#
+#Each cached parquet file has a json sidecar (<file>.parquet.json) written once with the source function, creation time, size, ttl and checksum
+#The last access time is the atime of the parquet file, set explicitly on each cache hit
+#Can be used from the command line:
+#
+#   python -m geo_py_utils.misc.cache_manager ls
+#   python -m geo_py_utils.misc.cache_manager prune --max-bytes 1e9 --older-than 30
+
+
+import pandas as pd
+import logging
+import json
+import time
+from glob import glob
+from os import remove, stat, replace, utime, getpid
+from os.path import join
+
+from geo_py_utils.misc.constants import DATA_DIR
+
+
+
+# Set logger
+logger = logging.getLogger(__file__)
+
+DEFAULT_CACHE_ROOT = join(DATA_DIR, "cache")
+
+METADATA_EXT = '.json'
+
+
+def get_metadata_path(path_cache: str) -> str:
+    """Path of the json sidecar of a cached file"""
+    return path_cache + METADATA_EXT
+
+
+def read_metadata(path_cache: str) -> dict:
+    """Read the sidecar of a cached file
+
+    Files without (or with a corrupted) sidecar - e.g. written by older versions - get metadata from the file system
+
+    Args:
+        path_cache (str): path of the cached parquet file
+
+    Returns:
+        dict: function, created, last_access, size, ttl and sha256 (seconds since epoch and bytes)
+    """
+
+    file_stat = stat(path_cache)
+
+    try:
+        with open(get_metadata_path(path_cache)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = {'function': None,
+                    'created': file_stat.st_mtime,
+                    'size': file_stat.st_size,
+                    'ttl': None,
+                    'sha256': None}
+
+    metadata['size'] = file_stat.st_size
+    metadata['last_access'] = max(file_stat.st_atime, metadata['created'])
+
+    return metadata
+
+
+def write_metadata(path_cache: str, metadata: dict):
+    """Write the sidecar of a cached file - through a temp file so that readers never see a partial json"""
+
+    path_metadata = get_metadata_path(path_cache)
+    path_tmp = f'{path_metadata}.{getpid()}.{time.time_ns()}.tmp'
+    with open(path_tmp, 'w') as f:
+        json.dump(metadata, f)
+    replace(path_tmp, path_metadata)
+
+
+def is_expired(metadata: dict, now: float = None) -> bool:
+    """True if the entry is older than its ttl"""
+
+    if metadata.get('ttl') is None:
+        return False
+    return (time.time() if now is None else now) - metadata['created'] > metadata['ttl']
+
+
+def touch_cache_file(path_cache: str):
+    """Update the last access time of a cached file (used for LRU eviction)
+
+    Only the atime of the parquet file changes: the sidecar is never rewritten, so concurrent readers cannot clobber it
+    """
+
+    try:
+        utime(path_cache, (time.time(), stat(path_cache).st_mtime))
+    except OSError as e:
+        logger.warning(f'Could not update the metadata of {path_cache} - {e}')
+
+
+
+class CacheManager:
+
+    """Inspect and prune the parquet files of a cache directory
+
+    ```
+    manager = CacheManager()
+    manager.ls()  # one row per cached file
+    manager.prune(max_bytes=10**9)  # remove expired files, then the least recently used ones until below 1GB
+    ```
+
+    Attributes:
+        cache_root (str), Default[DATA_DIR/cache]
+            Directory of the cached files
+    """
+
+    def __init__(self, cache_root: str = DEFAULT_CACHE_ROOT):
+        self.cache_root = cache_root
+
+
+    def ls(self) -> pd.DataFrame:
+        """List the cached files
+
+        Returns:
+            pd.DataFrame: path, function, created, last_access (timestamps), size (bytes), ttl (seconds) and expired - least recently used first
+        """
+
+        now = time.time()
+        list_entries = []
+        for path_cache in glob(join(self.cache_root, '**', '*.parquet'), recursive=True):
+            try:
+                metadata = read_metadata(path_cache)
+            except OSError:
+                # Removed in between
+                continue
+            list_entries.append({'path': path_cache,
+                                 'function': metadata.get('function'),
+                                 'created': metadata['created'],
+                                 'last_access': metadata['last_access'],
+                                 'size': metadata['size'],
+                                 'ttl': metadata.get('ttl'),
+                                 'expired': is_expired(metadata, now)})
+
+        df_entries = pd.DataFrame(list_entries, columns=['path', 'function', 'created', 'last_access', 'size', 'ttl', 'expired'])
+        for col in ['created', 'last_access']:
+            df_entries[col] = pd.to_datetime(df_entries[col], unit='s')
+
+        return df_entries.sort_values('last_access', ignore_index=True)
+
+
+    def total_size(self) -> int:
+        """Size in bytes of all the cached files"""
+        return int(self.ls()['size'].sum())
+
+
+    def remove(self, path_cache: str):
+        """Remove a cached file and its sidecar"""
+
+        for path in [path_cache, get_metadata_path(path_cache)]:
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+
+
+    def prune(self,
+              max_bytes: int = None,
+              older_than: float = None,
+              function: str = None,
+              remove_expired: bool = True,
+              dry_run: bool = False) -> pd.DataFrame:
+        """Remove cached files
+
+        Args:
+            max_bytes (int, optional): remove the least recently used files until the cache is at most max_bytes. Defaults to None.
+            older_than (float, optional): remove files not accessed for more than older_than days. Defaults to None.
+            function (str, optional): remove all the files of this function (qualified name or function name). Defaults to None.
+            remove_expired (bool, optional): remove the files older than the ttl of their decorator. Defaults to True.
+            dry_run (bool, optional): only list what would be removed. Defaults to False.
+
+        Returns:
+            pd.DataFrame: the removed entries (see ls)
+        """
+
+        df_entries = self.ls()
+
+        to_remove = df_entries['expired'].to_numpy(dtype=bool) & remove_expired
+        if older_than is not None:
+            # ls gives naive UTC timestamps (from epoch seconds): compare with epoch seconds too, not the local time
+            to_remove |= (df_entries['last_access'] < pd.Timestamp(time.time() - older_than * 86400, unit='s')).to_numpy()
+        if function is not None:
+            to_remove |= df_entries['function'].apply(lambda f: f is not None and (f == function or f.split('.')[-1] == function)).to_numpy(dtype=bool)
+        if max_bytes is not None:
+            # Entries are sorted from least to most recently used: keep the most recent ones that fit
+            size_kept = df_entries['size'].where(~to_remove, 0)[::-1].cumsum()[::-1]
+            to_remove |= (size_kept > max_bytes).to_numpy()
+
+        df_removed = df_entries.loc[to_remove].reset_index(drop=True)
+
+        if dry_run:
+            return df_removed
+
+        for path_cache in df_removed['path']:
+            self.remove(path_cache)
+
+        if df_removed.shape[0] > 0:
+            logger.info(f'Removed {df_removed.shape[0]} cached files - {df_removed["size"].sum()} bytes')
+
+        return df_removed
+
+
+    def clear(self) -> pd.DataFrame:
+        """Remove all cached files"""
+        return self.prune(max_bytes=0)
+
+
+
+def main(args=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect and prune the Cache_wrapper cache')
+    parser.add_argument('--cache-root', default=DEFAULT_CACHE_ROOT, help='cache directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('ls', help='list the cached files')
+
+    parser_prune = subparsers.add_parser('prune', help='remove cached files')
+    parser_prune.add_argument('--max-bytes', type=float, default=None, help='remove the least recently used files above this size')
+    parser_prune.add_argument('--older-than', type=float, default=None, help='remove files not accessed for this many days')
+    parser_prune.add_argument('--function', default=None, help='remove all the files of this function')
+    parser_prune.add_argument('--keep-expired', action='store_true', help='do not remove the files older than their ttl')
+    parser_prune.add_argument('--dry-run', action='store_true', help='only list what would be removed')
+
+    args = parser.parse_args(args)
+    manager = CacheManager(args.cache_root)
+
+    if args.command == 'ls':
+        df_entries = manager.ls()
+        print(df_entries.to_string())
+        print(f'\n{df_entries.shape[0]} files - {df_entries["size"].sum()} bytes')
+    else:
+        df_removed = manager.prune(max_bytes=None if args.max_bytes is None else int(args.max_bytes),
+                                   older_than=args.older_than,
+                                   function=args.function,
+                                   remove_expired=not args.keep_expired,
+                                   dry_run=args.dry_run)
+        print(df_removed.to_string())
+        print(f'\n{"Would remove" if args.dry_run else "Removed"} {df_removed.shape[0]} files - {df_removed["size"].sum()} bytes')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
+import hashlib
 import random
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os.path import join, isdir
 from os import mkdir
 from shutil import rmtree
@@ -23,3 +27,94 @@ def create_mock_cache_dir() -> str:
 
     return mocked_data_dir
 
+
+
+class LocalHttpServer:
+
+    """Local http server in a thread to test downloads without network
+
+    Serves the bytes in `files` with ETag and Last-Modified headers, answers 304 to conditional requests
+    and 206 to Range requests (if If-Range matches the ETag)
+
+    ```
+    with LocalHttpServer({'/bla.zip': b'...'}) as server:
+        download_file(server.url('/bla.zip'), ...)
+        server.list_requests  # (path, status) of each request
+    ```
+
+    Attributes:
+        files (dict): path -> content - can be modified while serving
+        n_failures (int): number of next responses cut after fail_after_bytes bytes (connection closed) to test resumes
+        fail_after_bytes (int): see n_failures
+    """
+
+    def __init__(self, files: dict, n_failures: int = 0, fail_after_bytes: int = 0):
+        self.files = files
+        self.n_failures = n_failures
+        self.fail_after_bytes = fail_after_bytes
+        self.list_requests = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path not in server.files:
+                    return self._respond(404)
+
+                content = server.files[self.path]
+                etag = f'"{hashlib.sha256(content).hexdigest()}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self._respond(304, etag=etag)
+
+                range_header = self.headers.get('Range')
+                if range_header is not None and self.headers.get('If-Range', etag) == etag:
+                    start, end = range_header.removeprefix('bytes=').split('-')
+                    start, end = int(start), min(int(end or len(content) - 1), len(content) - 1)
+                    if start >= len(content):
+                        return self._respond(416, headers={'Content-Range': f'bytes */{len(content)}'})
+                    return self._respond(206, content[start:end + 1], etag, {'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+
+                self._respond(200, content, etag)
+
+            def _respond(self, status: int, content: bytes = b'', etag: str = None, headers: dict = None):
+                with server.lock:
+                    server.list_requests.append((self.path, status))
+                    is_failure = server.n_failures > 0 and len(content) > server.fail_after_bytes
+                    server.n_failures -= is_failure
+
+                self.send_response(status)
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', formatdate(usegmt=True))
+                    self.send_header('Accept-Ranges', 'bytes')
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+
+                if is_failure:
+                    # Announced length not reached: the client sees a broken download
+                    self.wfile.write(content[:server.fail_after_bytes])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+
+                self.wfile.write(content)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}{path}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,18 +1,13 @@
 import geopandas as gpd
-from os.path import isdir, join
+from os.path import isdir, dirname
 from os import makedirs
 from shutil import rmtree
 
 from geo_py_utils.misc.utils_test import create_mock_cache_dir
 from geo_py_utils.census_open_data import census
+from geo_py_utils.geo_general.crs import get_crs_str
  
 
-DEFAULT_PARAMS={
-    'use_cartographic': census.USE_CARTOGRAPHIC,
-    'crs_str': "null"
-}
-
-
 class MockCache:
     """Class to manually implement unittest.patch which never actually works
 
@@ -35,13 +30,8 @@ class MockCache:
         assert isinstance(df, gpd.GeoDataFrame)
         
         # Make sure the caching system works 
-        dict_cache_params = kwargs.copy()
-        for k, v in DEFAULT_PARAMS.items():
-            if not k in dict_cache_params.keys():
-                dict_cache_params.update({k: v})
-
-        name_cache = "fsa_{year}_{pr_code}_carto_{use_cartographic}_crs_{crs_str}.parquet".format(**dict_cache_params)
-        path_cache = join(self.mocked_dir, name_cache)
+        path_cache = census.download_fsas.cache_path(path_cache_root = self.mocked_dir, **kwargs)
+        assert dirname(path_cache) == self.mocked_dir
         df_parquet = gpd.read_parquet(path_cache)
 
         assert df_parquet.shape[0] == df.shape[0]
@@ -58,8 +48,8 @@ class MockCache:
 
 def test_crs_string():
 
-    assert census.get_crs_str(4326) != 'null'
-    assert census.get_crs_str(32198) != 'null'
+    assert get_crs_str(4326) != 'null'
+    assert get_crs_str(32198) != 'null'
 
 def test_2021_fsa_qc():
     # Quebec - 2021
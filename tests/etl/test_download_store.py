@@ -0,0 +1,53 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from os.path import basename
+
+from geo_py_utils.etl.download_store import DownloadStore
+from geo_py_utils.misc.utils_test import LocalHttpServer
+
+
+def test_download_store(tmp_path):
+
+    store = DownloadStore(str(tmp_path))
+
+    with LocalHttpServer({'/a.zip': b'v1', '/b.zip': b'v1'}) as server:
+
+        path_a = store.get(server.url('/a.zip'))
+        assert open(path_a, 'rb').read() == b'v1'
+        assert store.get(server.url('/a.zip')) == path_a
+
+        # Same content from another url: stored once
+        assert store.get(server.url('/b.zip')) == path_a
+        assert basename(path_a).endswith('.zip')
+
+        # Revalidated: new version
+        server.files['/a.zip'] = b'v2'
+        path_a_v2 = store.get(server.url('/a.zip'), max_age=0)
+        assert path_a_v2 != path_a and open(path_a_v2, 'rb').read() == b'v2'
+        assert store.get(server.url('/a.zip'), max_age=0) == path_a_v2
+
+    assert [status for _, status in server.list_requests] == [200, 200, 200, 304]
+
+    # Server down: the stored file is used
+    assert store.get(server.url('/a.zip'), max_age=0) == path_a_v2
+    with pytest.raises(requests.exceptions.RequestException):
+        store.get(server.url('/c.zip'))
+
+    # v1 is still referenced by b
+    assert store.gc() == []
+
+
+def test_download_store_concurrent_get(tmp_path):
+
+    content = bytes(range(256)) * 40000
+
+    # Same url from many threads: downloaded once, no interleaved writes to the part file
+    with LocalHttpServer({'/a.zip': content}) as server:
+        with ThreadPoolExecutor(4) as executor:
+            list_paths = list(executor.map(lambda _: DownloadStore(str(tmp_path)).get(server.url('/a.zip')), range(4)))
+
+    assert len(set(list_paths)) == 1
+    assert open(list_paths[0], 'rb').read() == content
+    assert [status for _, status in server.list_requests] == [200]
+
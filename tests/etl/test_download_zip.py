@@ -1,10 +1,70 @@
 
 import geopandas as gpd
+import pytest
+import zipfile
+from shapely.geometry import Point, box
 
 from geo_py_utils.etl.download_zip import download_zip_shp
+from geo_py_utils.misc.utils_test import LocalHttpServer
  
 def test_download_stats_can():
 
     shp = download_zip_shp ('https://www12.statcan.gc.ca/census-recensement/2011/geo/bound-limit/files-fichiers/2016/lfsa000b16a_e.zip')
 
-    assert isinstance(shp, gpd.GeoDataFrame)
\ No newline at end of file
+    assert isinstance(shp, gpd.GeoDataFrame)
+
+def test_download_zip_shp_store(tmp_path):
+
+    # Zip with 2 shp files served by a local server
+    for name, pr_codes in [('lpr', ['24', '35']), ('lcd', ['2401'])]:
+        shp = gpd.GeoDataFrame({'UID': pr_codes}, geometry=[Point(i, i) for i in range(len(pr_codes))], crs=4326)
+        shp.to_file(tmp_path / f'{name}.shp')
+    with zipfile.ZipFile(tmp_path / 'boundaries.zip', 'w') as zip_ref:
+        for path in tmp_path.glob('l*.*'):
+            zip_ref.write(path, f'SHP/{path.name}')
+
+    data_download_path = tmp_path / 'download'
+    data_download_path.mkdir()
+
+    with LocalHttpServer({'/boundaries.zip': (tmp_path / 'boundaries.zip').read_bytes()}) as server:
+        url = server.url('/boundaries.zip')
+
+        with pytest.raises(RuntimeError):
+            download_zip_shp(url, str(data_download_path))
+
+        # Read from the stored zip without extracting it
+        assert download_zip_shp(url, str(data_download_path), member='lpr.shp').UID.tolist() == ['24', '35']
+        assert download_zip_shp(url, str(data_download_path), member='SHP/lcd.shp').UID.tolist() == ['2401']
+
+        # Revalidated: not modified
+        download_zip_shp(url, str(data_download_path), member='lpr.shp', max_age=0)
+
+    # Downloaded once
+    assert [status for _, status in server.list_requests] == [200, 304]
+    assert [p.name for p in data_download_path.iterdir()] == ['download_store']
+
+
+def test_download_zip_shp_filters(tmp_path):
+
+    shp = gpd.GeoDataFrame({'DAUID': ['24010001', '24010002', '35010001'], 'PRUID': ['24', '24', '35'], 'NAME': ['a', 'b', 'c']},
+                           geometry=[Point(i, i) for i in range(3)], crs=3347)
+    shp.to_file(tmp_path / 'lda.shp')
+    with zipfile.ZipFile(tmp_path / 'lda.zip', 'w') as zip_ref:
+        for path in tmp_path.glob('lda.*'):
+            if path.suffix != '.zip': zip_ref.write(path, path.name)
+
+    data_download_path = tmp_path / 'download'
+    data_download_path.mkdir()
+
+    with LocalHttpServer({'/lda.zip': (tmp_path / 'lda.zip').read_bytes()}) as server:
+        url = server.url('/lda.zip')
+
+        # Attribute filters and columns pushed down to the reader
+        shp_qc = download_zip_shp(url, str(data_download_path), where="PRUID = '24'", columns=['DAUID'])
+        assert shp_qc.DAUID.tolist() == ['24010001', '24010002']
+        assert shp_qc.columns.tolist() == ['DAUID', 'geometry']
+        assert download_zip_shp(url, str(data_download_path), where="DAUID LIKE '35%'").NAME.tolist() == ['c']
+
+        # Spatial filters
+        assert download_zip_shp(url, str(data_download_path), bbox=(0.5, 0.5, 2.5, 2.5)).NAME.tolist() == ['b', 'c']
+        assert download_zip_shp(url, str(data_download_path), mask=box(-0.5, -0.5, 0.5, 0.5)).NAME.tolist() == ['a']
@@ -0,0 +1,38 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+from geo_py_utils.etl.geo_io import read_geo_file, write_geo_file, benchmark_geo_io, CAN_READ_ARROW, CAN_WRITE_ARROW, BENCHMARK_DRIVERS
+
+
+@pytest.mark.parametrize('extension', BENCHMARK_DRIVERS.values())
+def test_read_write_geo_file(tmp_path, extension):
+
+    shp = gpd.GeoDataFrame({'PRUID': ['24', '35', '24'], 'value': [1.5, 2.5, 3.5]},
+                           geometry=[Point(i, i) for i in range(3)], crs=3347)
+    path = str(tmp_path / f'bla{extension}')
+
+    # Default engine (arrow if available) and without arrow give the same result
+    write_geo_file(shp, path)
+    for use_arrow in {None, False, CAN_READ_ARROW}:
+        shp_read = read_geo_file(path, use_arrow=use_arrow)
+        assert shp_read.PRUID.tolist() == ['24', '35', '24']
+        assert shp_read.value.tolist() == [1.5, 2.5, 3.5]
+        assert shp_read.crs.to_epsg() == 3347
+
+    # Filters pushed down
+    assert read_geo_file(path, where="PRUID = '24'", columns=['PRUID']).shape == (2, 2)
+    assert read_geo_file(path, bbox=(0.5, 0.5, 2.5, 2.5)).shape[0] == 2
+
+    if not CAN_WRITE_ARROW:
+        with pytest.raises(ImportError):
+            write_geo_file(shp, path, use_arrow=True)
+
+
+def test_benchmark_geo_io():
+
+    df_benchmark = benchmark_geo_io(num_features=100)
+
+    assert set(df_benchmark.driver) == set(BENCHMARK_DRIVERS)
+    assert set(df_benchmark.direction) == {'read', 'write'}
+    assert (df_benchmark.features_per_s > 0).all() and (df_benchmark.mb_per_s > 0).all()
@@ -0,0 +1,110 @@
+import hashlib
+import pytest
+import requests
+from os.path import isfile
+
+from geo_py_utils.etl.http_download import download_file, get_conditional_headers, PART_EXT
+from geo_py_utils.misc.utils_test import LocalHttpServer
+
+
+def test_download_file_conditional(tmp_path):
+
+    path_download = str(tmp_path / 'bla.geojson')
+
+    with LocalHttpServer({'/bla.geojson': b'v1'}) as server:
+        url = server.url('/bla.geojson')
+
+        result = download_file(url, path_download)
+        assert result.is_modified and result.validators['etag'] is not None
+
+        # Unchanged source: 304 and no content
+        assert not download_file(url, path_download, get_conditional_headers(result.validators)).is_modified
+
+        # New version of the source
+        server.files['/bla.geojson'] = b'v2'
+        assert download_file(url, path_download, get_conditional_headers(result.validators)).is_modified
+        with open(path_download, 'rb') as f:
+            assert f.read() == b'v2'
+
+    assert [status for _, status in server.list_requests] == [200, 304, 200]
+
+
+def test_download_file_resume(tmp_path):
+
+    path_download = str(tmp_path / 'bla.zip')
+    content = bytes(range(256)) * 4000
+
+    # First response cut after 100kB: resumed from there with a Range request
+    with LocalHttpServer({'/bla.zip': content}, n_failures=1, fail_after_bytes=100000) as server:
+        result = download_file(server.url('/bla.zip'), path_download, retry_wait=0)
+
+    assert result.is_modified and result.size == len(content)
+    assert result.sha256 == hashlib.sha256(content).hexdigest()
+    with open(path_download, 'rb') as f:
+        assert f.read() == content
+    assert [status for _, status in server.list_requests] == [200, 206]
+    assert not isfile(path_download + PART_EXT)
+
+
+def test_download_file_resume_part_file(tmp_path):
+
+    path_download = str(tmp_path / 'bla.zip')
+    content = bytes(range(256)) * 4000
+
+    # No retry: the part file is left on disk and resumed by the next call
+    with LocalHttpServer({'/bla.zip': content}, n_failures=1, fail_after_bytes=100000) as server:
+        with pytest.raises(requests.exceptions.RequestException):
+            download_file(server.url('/bla.zip'), path_download, max_retries=0)
+        assert isfile(path_download + PART_EXT)
+
+        download_file(server.url('/bla.zip'), path_download)
+        with open(path_download, 'rb') as f:
+            assert f.read() == content
+
+        # Part file of an older version of the resource: If-Range does not match and the server sends everything
+        with pytest.raises(requests.exceptions.RequestException):
+            server.n_failures = 1
+            download_file(server.url('/bla.zip'), path_download, max_retries=0)
+        server.files['/bla.zip'] = content[::-1]
+        download_file(server.url('/bla.zip'), path_download)
+        with open(path_download, 'rb') as f:
+            assert f.read() == content[::-1]
+
+    assert [status for _, status in server.list_requests] == [200, 206, 200, 200]
+
+
+def test_download_file_parallel(tmp_path):
+
+    path_download = str(tmp_path / 'bla.zip')
+    content = bytes(range(256)) * 4000
+
+    # 4 ranges - one of them interrupted and resumed (the first failure hits the initial response whose body is not read)
+    with LocalHttpServer({'/bla.zip': content}, n_failures=2, fail_after_bytes=100000) as server:
+        download_file(server.url('/bla.zip'), path_download, n_connections=4, min_size_parallel=0, retry_wait=0)
+
+    with open(path_download, 'rb') as f:
+        assert f.read() == content
+    assert [status for _, status in server.list_requests].count(206) == 5
+
+
+def test_download_file_parallel_resume_part_files(tmp_path):
+
+    path_download = str(tmp_path / 'bla.zip')
+    content = bytes(range(256)) * 4000
+
+    # No retry: the range part files are left on disk and resumed by the next call without downloading them again
+    with LocalHttpServer({'/bla.zip': content}, n_failures=2, fail_after_bytes=100000) as server:
+        with pytest.raises(requests.exceptions.RequestException):
+            download_file(server.url('/bla.zip'), path_download, n_connections=4, min_size_parallel=0, max_retries=0)
+        assert isfile(path_download + PART_EXT + '.json')
+
+        server.list_requests.clear()
+        download_file(server.url('/bla.zip'), path_download, n_connections=4, min_size_parallel=0)
+
+    with open(path_download, 'rb') as f:
+        assert f.read() == content
+    assert not isfile(path_download + PART_EXT + '0')
+
+    # Only the interrupted range is requested again
+    assert [status for _, status in server.list_requests] == [206]
+
@@ -0,0 +1,65 @@
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import Point, Polygon
+
+from geo_py_utils.geo_general.centroid import add_centroid, get_centroid_gpd
+
+
+def test_add_centroid_preserves_index():
+
+    shp = gpd.GeoDataFrame(
+        {'id': [0, 1]},
+        geometry=[Polygon(((0, 0), (2, 0), (2, 2), (0, 2))), Point(5, 6)],
+        index=[10, 20]
+    )
+    shp_centroid = add_centroid(shp)
+
+    assert shp_centroid.index.equals(shp.index)
+    assert np.allclose(shp_centroid[['lng', 'lat']].to_numpy(), [[1, 1], [5, 6]])
+    assert 'lng' not in shp.columns # copy by default
+
+
+def test_add_centroid_inplace():
+
+    shp = gpd.GeoDataFrame(
+        {'id': [0, 1]},
+        geometry=[Polygon(((0, 0), (2, 0), (2, 2), (0, 2))), Point(5, 6)],
+        index=[10, 20]
+    )
+    shp_centroid = add_centroid(shp, col_names=['x', 'y'], inplace=True)
+
+    assert shp_centroid is shp
+    assert np.isin(['x', 'y'], shp.columns).all()
+
+
+def test_get_centroid_gpd():
+
+    shp = gpd.GeoDataFrame(
+        {'id': [0, 1]},
+        geometry=[Polygon(((0, 0), (2, 0), (2, 2), (0, 2))), Point(5, 6)],
+        index=[10, 20]
+    )
+    shp_centroid = get_centroid_gpd(shp)
+
+    assert (shp_centroid.geom_type == 'Point').all()
+    assert shp_centroid.index.tolist() == [10, 20]
+
+
+def test_add_centroid_projected():
+
+    # Large L shaped polygon: centroid in degrees is off
+    shp = gpd.GeoDataFrame(
+        {'id': [0]},
+        geometry=[Polygon(((-80, 45), (-60, 45), (-60, 47), (-78, 47), (-78, 60), (-80, 60)))],
+        crs=4326
+    )
+
+    shp_centroid = add_centroid(shp, centroid_crs=32198)
+    centroid_ref = shp.to_crs(32198).centroid.to_crs(4326)
+
+    assert shp_centroid.crs == shp.crs
+    assert np.allclose(shp_centroid[['lng', 'lat']].to_numpy(), [[centroid_ref.x[0], centroid_ref.y[0]]])
+
+    # Centroid of the L is outside the polygon, not the representative point
+    shp_repr = add_centroid(shp, method='representative_point')
+    assert shp.geometry[0].contains(Point(shp_repr.lng[0], shp_repr.lat[0]))
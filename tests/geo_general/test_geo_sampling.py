@@ -0,0 +1,92 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString, MultiPolygon, Point, box
+
+from geo_py_utils.geo_general.geo_sampling import generate_random_points_over_extent, generate_random_points_per_feature
+
+
+@pytest.mark.parametrize('method', ['grid', 'sobol'])
+def test_sampling_extent(method):
+
+    shp = gpd.GeoDataFrame({'id': [0, 1]},
+                           geometry=[Point(-71.3, 46.8).buffer(0.1), Point(-71.0, 46.9).buffer(0.05)],
+                           crs=4326)
+    shp_points = generate_random_points_over_extent(shp, 1000, method=method, seed=0)
+
+    assert shp_points.shape[0] == 1000
+    assert shp_points.crs == shp.crs
+    assert shp_points.within(shp.union_all().envelope).all()
+
+    # Same seed, same points
+    shp_points_2 = generate_random_points_over_extent(shp, 1000, method=method, seed=0)
+    assert np.array_equal(shp_points.get_coordinates().values, shp_points_2.get_coordinates().values)
+
+
+def test_grid_sampling_is_grid():
+
+    shp = gpd.GeoDataFrame({'id': [0, 1]},
+                           geometry=[Point(-71.3, 46.8).buffer(0.1), Point(-71.0, 46.9).buffer(0.05)],
+                           crs=4326)
+    shp_points = generate_random_points_over_extent(shp, 1000, method='grid', seed=0)
+
+    # Cross product of about sqrt(1000) eastings and northings - not 1000 northings for a few eastings
+    assert shp_points.x.nunique() * shp_points.y.nunique() < 1100
+    assert shp_points.x.nunique() > 10 and shp_points.y.nunique() > 10
+
+
+@pytest.mark.parametrize('line', [LineString([(0, 0), (1000, 0)]), LineString([(0, 0), (0, 1000)])])
+def test_grid_sampling_degenerate_extent(line):
+
+    shp = gpd.GeoDataFrame(geometry=[line], crs=3857)
+    shp_points = generate_random_points_over_extent(shp, 100, method='grid', seed=0)
+
+    # All the points on the line
+    assert shp_points.shape[0] == 100
+    assert shp_points.get_coordinates().drop_duplicates().shape[0] == 100
+    assert shp_points.intersects(line).all()
+
+
+@pytest.mark.parametrize('method', ['grid', 'sobol'])
+def test_sampling_within_geometry(method):
+
+    shp = gpd.GeoDataFrame({'id': [0, 1]},
+                           geometry=[Point(-71.3, 46.8).buffer(0.1), Point(-71.0, 46.9).buffer(0.05)],
+                           crs=4326)
+    shp_points = generate_random_points_over_extent(shp, 5000, method=method, seed=1, within_geometry=True, batch_size=1000)
+
+    assert shp_points.shape[0] == 5000
+    assert shp_points.to_crs(3857).within(shp.to_crs(3857).union_all()).all()
+
+
+def test_sampling_per_feature():
+
+    shp = gpd.GeoDataFrame({'num_points': [300, 0, 200]},
+                           geometry=[Point(-71.3, 46.8).buffer(0.1).difference(Point(-71.3, 46.8).buffer(0.05)),
+                                     box(-71, 46, -70.9, 46.1),
+                                     MultiPolygon([box(-72, 46, -71.9, 46.1), box(-71.8, 46, -71.7, 46.2)])],
+                           index=['ring', 'empty', 'multi'],
+                           crs=4326)
+
+    shp_points = generate_random_points_per_feature(shp, 'num_points', seed=0)
+
+    assert shp_points.crs == shp.crs
+    assert shp_points.index.value_counts().to_dict() == {'ring': 300, 'multi': 200}
+
+    shp_proj = shp.to_crs(3857)
+    shp_points_proj = shp_points.to_crs(3857)
+    for idx in ['ring', 'multi']:
+        assert shp_points_proj.loc[idx].buffer(1e-6).intersects(shp_proj.geometry[idx]).all()
+
+
+def test_sampling_per_feature_reproducible():
+
+    shp = gpd.GeoDataFrame(geometry=[Point(-71.3 + k / 100, 46.8).buffer(0.001) for k in range(50)], crs=4326)
+
+    shp_points = generate_random_points_per_feature(shp, 5, seed=1, chunk_size=7)
+    shp_points_2 = generate_random_points_per_feature(shp, 5, seed=1, chunk_size=7, n_jobs=2)
+    shp_points_3 = generate_random_points_per_feature(shp, 5, seed=2, chunk_size=7)
+
+    assert shp_points.shape[0] == 250
+    assert np.array_equal(shp_points[['x', 'y']].values, shp_points_2[['x', 'y']].values)
+    assert not np.array_equal(shp_points[['x', 'y']].values, shp_points_3[['x', 'y']].values)
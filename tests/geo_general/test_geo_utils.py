@@ -0,0 +1,52 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import MultiPolygon, Point, Polygon
+
+from geo_py_utils.geo_general.geo_utils import (
+    get_matrix_point_coordinates,
+    get_matrix_point_polygon,
+    get_num_points_in_geoseries
+)
+
+
+def test_matrix_point_coordinates_non_range_index():
+
+    shp = gpd.GeoDataFrame(
+        {'id': [0, 1]},
+        geometry=[Point(1, 2), Polygon(((0, 0), (2, 0), (2, 2), (0, 2)))],
+        index=[10, 20]
+    )
+
+    coords_gdf = get_matrix_point_coordinates(shp)
+    coords_geoseries = get_matrix_point_coordinates(shp.geometry)
+
+    assert np.allclose(coords_gdf, [[1, 2], [1, 1]])
+    assert np.allclose(coords_gdf, coords_geoseries)
+
+
+def test_matrix_point_coordinates_empty():
+
+    shp = gpd.GeoDataFrame({'id': [0, 1]}, geometry=[Point(1, 2), Point()])
+
+    with pytest.raises(ValueError):
+        get_matrix_point_coordinates(shp)
+
+
+def test_matrix_point_polygon_multipolygon():
+
+    square = Polygon(((0, 0), (1, 0), (1, 1), (0, 1)))
+    triangle = Polygon(((5, 5), (6, 5), (6, 6)))
+    shp = gpd.GeoDataFrame(
+        {'id': [0, 1]},
+        geometry=[square, MultiPolygon([square, triangle])],
+        index=['a', 'b']
+    )
+
+    df_coords = get_matrix_point_polygon(shp)
+
+    # Closed rings: 5 coords for the square, 4 for the triangle
+    assert df_coords.shape == (5 + 5 + 4, 3)
+    assert df_coords.poly_id.value_counts().to_dict() == {'a': 5, 'b': 9}
+    assert df_coords.loc[df_coords.poly_id == 'b'].index.tolist() == list(range(9))
+    assert np.array_equal(get_num_points_in_geoseries(shp.geometry), [5, 9])
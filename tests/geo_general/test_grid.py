@@ -0,0 +1,89 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+
+from geo_py_utils.geo_general.grid import GridSpec, assign_grid_cell, count_by_grid, get_grid_over_shp, iter_grid_over_shp
+
+
+def test_grid_over_shp():
+
+    shp = gpd.GeoDataFrame({'id': [0]}, geometry=[Point(-71.3, 46.8).buffer(0.1)], crs=4326)
+    shp_grid = get_grid_over_shp(shp, cell_dim=(10, 10))
+    bounds = get_grid_over_shp(shp, cell_dim=(10, 10), return_bounds=True)
+
+    assert shp_grid.crs == shp.crs
+    assert shp_grid.shape[0] == bounds.shape[0]
+    assert np.all(bounds[:, 2] > bounds[:, 0]) and np.all(bounds[:, 3] > bounds[:, 1])
+
+    # The grid covers the entire extent
+    assert shp.within(shp_grid.union_all().buffer(1e-9)).all()
+
+
+def test_grid_only_intersecting():
+
+    shp = gpd.GeoDataFrame({'id': [0]}, geometry=[Point(-71.3, 46.8).buffer(0.1)], crs=4326)
+    shp_grid = get_grid_over_shp(shp, cell_dim=(10, 10))
+    shp_grid_inter = get_grid_over_shp(shp, cell_dim=(10, 10), only_intersecting=True)
+
+    # Corner cells of the bbox do not intersect the disk
+    assert shp_grid_inter.shape[0] < shp_grid.shape[0]
+    assert shp_grid_inter.to_crs(3857).intersects(shp.to_crs(3857).geometry[0]).all()
+
+
+def test_iter_grid_same_cells():
+
+    shp = gpd.GeoDataFrame({'id': [0]}, geometry=[Point(-71.3, 46.8).buffer(0.1)], crs=4326)
+    grid_spec = GridSpec.from_shp(shp, cell_dim=(30, 20))
+    shp_grid = get_grid_over_shp(shp, grid_spec=grid_spec).set_index('cell_id').sort_index()
+
+    tiles = list(iter_grid_over_shp(shp, grid_spec=grid_spec, tile_shape=(7, 9)))
+    shp_tiles = pd.concat(tiles).set_index('cell_id').sort_index()
+
+    assert len(tiles) > 1
+    assert all(t.shape[0] <= 7 * 9 for t in tiles)
+    assert shp_tiles.index.equals(shp_grid.index)
+    assert shp_tiles.geometry.geom_equals(shp_grid.geometry).all()
+
+    # Ids map back to the cells
+    rows, cols = grid_spec.get_row_col(shp_grid.index.values)
+    assert np.array_equal(grid_spec.get_cell_id(rows, cols), shp_grid.index.values)
+
+
+def test_iter_grid_only_intersecting():
+
+    shp = gpd.GeoDataFrame({'id': [0]}, geometry=[Point(-71.3, 46.8).buffer(0.1)], crs=4326)
+    shp_grid = get_grid_over_shp(shp, cell_dim=(30, 20), only_intersecting=True)
+    tiles = list(iter_grid_over_shp(shp, cell_dim=(30, 20), only_intersecting=True, tile_shape=(4, 4)))
+
+    assert set(pd.concat(tiles).cell_id) == set(shp_grid.cell_id)
+
+
+def test_assign_grid_cell_matches_sjoin():
+
+    shp = gpd.GeoDataFrame({'id': [0]}, geometry=[Point(-71.3, 46.8).buffer(0.1)], crs=4326)
+    grid_spec = GridSpec.from_shp(shp, cell_dim=(20, 15))
+    shp_grid = get_grid_over_shp(shp, grid_spec=grid_spec)
+
+    rng = np.random.default_rng(1)
+    xmin, ymin, xmax, ymax = shp.total_bounds
+    shp_points = gpd.GeoDataFrame({'weight': rng.random(1000)},
+                                  geometry=gpd.points_from_xy(rng.uniform(xmin - 0.05, xmax + 0.05, 1000),
+                                                              rng.uniform(ymin - 0.05, ymax + 0.05, 1000)),
+                                  crs=4326)
+
+    cell_ids = assign_grid_cell(shp_points, grid_spec)
+    shp_joined = gpd.sjoin(shp_points, shp_grid, how='left', predicate='within')
+    cell_ids_sjoin = shp_joined.groupby(level=0).cell_id.first().fillna(-1).astype('int64').values
+
+    assert cell_ids.dtype == np.int64
+    assert np.any(cell_ids == -1)
+    assert np.array_equal(cell_ids, cell_ids_sjoin)
+
+    counts = count_by_grid(shp_points, grid_spec, weights='weight')
+    counts_sjoin = shp_joined.groupby('cell_id').weight.sum()
+    assert np.allclose(counts.values, counts_sjoin.loc[counts.index].values)
+
+    counts_dense = count_by_grid(shp_points, grid_spec, dense=True)
+    assert counts_dense.shape[0] == grid_spec.n_cells
+    assert counts_dense.sum() == np.sum(cell_ids >= 0)
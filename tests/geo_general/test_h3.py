@@ -0,0 +1,101 @@
+import geopandas as gpd
+import numpy as np
+import h3.api.numpy_int as h3
+
+from geo_py_utils.geo_general.h3 import (
+    get_h3_hex_from_gpd,
+    get_h3_index,
+    get_h3_polyfill,
+    recursively_partition_h3_cells,
+    _get_h3_children,
+    _get_h3_parent
+)
+
+
+def test_h3_index():
+
+    rng = np.random.default_rng(0)
+    shp = gpd.GeoDataFrame({'id': np.arange(500)},
+                           geometry=gpd.points_from_xy(rng.uniform(-71.35, -71.25, 500), rng.uniform(46.75, 46.85, 500)),
+                           crs=4326)
+    h3_indices = get_h3_index(shp.to_crs(3857), resolution=8)
+
+    assert h3_indices.dtype == np.uint64
+    assert np.array_equal(h3_indices, [h3.latlng_to_cell(p.y, p.x, 8) for p in shp.geometry])
+
+
+def test_h3_hex_unique_counts():
+
+    rng = np.random.default_rng(0)
+    shp = gpd.GeoDataFrame({'id': np.arange(500)},
+                           geometry=gpd.points_from_xy(rng.uniform(-71.35, -71.25, 500), rng.uniform(46.75, 46.85, 500)),
+                           crs=4326)
+    shp_h3 = get_h3_hex_from_gpd(shp, resolution=8, return_counts=True)
+
+    assert shp_h3.crs == 4326
+    assert shp_h3.h3_index.is_unique
+    assert shp_h3['count'].sum() == shp.shape[0]
+    assert shp_h3.is_valid.all()
+
+    # Each point falls in its hexagon
+    shp_h3_rows = get_h3_hex_from_gpd(shp, resolution=8, unique=False)
+    assert shp_h3_rows.shape[0] == shp.shape[0]
+    assert shp_h3_rows.covers(shp.geometry).all()
+
+
+def test_h3_parent_children_bits():
+
+    rng = np.random.default_rng(0)
+    shp = gpd.GeoDataFrame({'id': np.arange(500)},
+                           geometry=gpd.points_from_xy(rng.uniform(-71.35, -71.25, 500), rng.uniform(46.75, 46.85, 500)),
+                           crs=4326)
+    h3_indices = get_h3_index(shp, resolution=10)
+    pentagons = np.asarray(h3.get_pentagons(4), dtype=np.uint64)
+
+    for r in [0, 3, 7]:
+        assert np.array_equal(_get_h3_parent(h3_indices, r), [h3.cell_to_parent(h, r) for h in h3_indices])
+
+    # Pentagons only have 6 children
+    cells = np.concatenate([np.unique(_get_h3_parent(h3_indices, 4)), pentagons])
+    children = _get_h3_children(cells)
+    assert np.array_equal(np.sort(children), np.sort(np.concatenate([h3.cell_to_children(h, 5) for h in cells])))
+
+
+def test_h3_polyfill_compact():
+
+    rng = np.random.default_rng(0)
+    shp = gpd.GeoDataFrame({'id': np.arange(500)},
+                           geometry=gpd.points_from_xy(rng.uniform(-71.35, -71.25, 500), rng.uniform(46.75, 46.85, 500)),
+                           crs=4326)
+    shp = gpd.GeoDataFrame(geometry=[shp.union_all().convex_hull], crs=4326)
+
+    shp_h3 = get_h3_polyfill(shp, resolution=8)
+    shp_h3_compact = get_h3_polyfill(shp, resolution=8, compact=True)
+
+    assert (shp_h3.resolution == 8).all()
+    assert shp_h3_compact.shape[0] < shp_h3.shape[0]
+    assert np.array_equal(np.sort(h3.uncompact_cells(shp_h3_compact.h3_index.values, 8)), shp_h3.h3_index.values)
+
+
+def test_recursive_h3_partition():
+
+    rng = np.random.default_rng(0)
+    shp = gpd.GeoDataFrame({'id': np.arange(2000)},
+                           geometry=gpd.points_from_xy(rng.uniform(-71.35, -71.25, 2000), rng.uniform(46.75, 46.85, 2000)),
+                           crs=4326)
+    min_num_points = 50
+    max_resolution = 9
+
+    shp_part, dict_layers = recursively_partition_h3_cells(shp, min_num_points=min_num_points, max_resolution=max_resolution)
+
+    assert shp_part.h3_index.is_unique
+    assert shp_part['counts'].sum() == shp.shape[0]
+    assert max(dict_layers.keys()) <= max_resolution
+    for k in dict_layers.keys():
+        if k < max_resolution:
+            assert dict_layers[k]['counts'].max() <= min_num_points
+
+    # Each point belongs to exactly 1 cell of the partition
+    h3_indices = get_h3_index(shp, resolution=max_resolution)
+    num_cells = sum(np.isin(_get_h3_parent(h3_indices, r), shp_part.h3_index.values) for r in range(max_resolution + 1))
+    assert np.all(num_cells == 1)
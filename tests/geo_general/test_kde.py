@@ -0,0 +1,68 @@
+import geopandas as gpd
+import numpy as np
+
+from geo_py_utils.geo_general.kde import (
+    get_2D_kernel_estimate,
+    convert_2D_kernel_polygon,
+    get_polygon_estimate_2D_kernel_from_shp
+)
+
+
+def test_kde_weights_same_as_replication():
+
+    rng = np.random.default_rng(1)
+    shp = gpd.GeoDataFrame({'counts': rng.integers(0, 5, 200)},
+                           geometry=gpd.points_from_xy(-71.2 + rng.normal(0, .05, 200), 46.8 + rng.normal(0, .05, 200)),
+                           crs=4326)
+    shp_replicated = shp.loc[shp.index.repeat(shp.counts)]
+    shp_positive = shp.loc[shp.counts > 0]
+
+    _, _, kde_replicated = get_2D_kernel_estimate(shp_replicated, cell_size=30j)
+    _, _, kde_weighted = get_2D_kernel_estimate(shp_positive, cell_size=30j, weights=shp_positive.counts)
+
+    # Only the bias correction of the covariance differs
+    assert np.max(np.abs(kde_replicated - kde_weighted)) / np.max(kde_replicated) < 0.01
+
+
+def test_kde_does_not_modify_input():
+
+    shp = gpd.GeoDataFrame({'counts': [1, 2, 3, 1]},
+                           geometry=gpd.points_from_xy([-71.2, -71.25, -71.3, -71.22], [46.8, 46.85, 46.78, 46.9]),
+                           index=['a', 'b', 'c', 'd'],
+                           crs=4326)
+    shp_init = shp.copy()
+
+    # Projected once internally: no easting/northing columns added and the crs is unchanged
+    get_2D_kernel_estimate(shp, cell_size=30j)
+
+    assert shp.equals(shp_init)
+    assert shp.crs == shp_init.crs
+
+
+def test_kde_contour_holes():
+
+    # Density is highest on a circle: the upper levels should have holes
+    x, y = np.mgrid[-2:2:100j, -2:2:100j]
+    density = np.exp(-(np.sqrt(x**2 + y**2) - 1)**2 / 0.1)
+
+    shp_poly = convert_2D_kernel_polygon(x, y, density, levels=[0.5])
+
+    assert shp_poly.shape[0] == 1
+    assert shp_poly.is_valid.all()
+    assert sum(len(p.interiors) for p in shp_poly.geometry.iloc[0].geoms) == 1
+
+
+def test_kde_polygon_from_shp():
+
+    rng = np.random.default_rng(1)
+    shp = gpd.GeoDataFrame({'counts': rng.integers(0, 5, 200)},
+                           geometry=gpd.points_from_xy(-71.2 + rng.normal(0, .05, 200), 46.8 + rng.normal(0, .05, 200)),
+                           crs=4326)
+    shp_poly = get_polygon_estimate_2D_kernel_from_shp(shp, cell_size=30j, col_name_for_counts='counts')
+
+    assert shp_poly.shape[0] > 0
+    assert shp_poly.crs == shp.crs
+    assert (shp_poly.density > 0).all()
+
+    # levels is keyword only: extra positional arguments still go to get_2D_kernel_estimate
+    assert get_polygon_estimate_2D_kernel_from_shp(shp, 30j, 'counts', 0, levels=3).shape[0] == 3
@@ -0,0 +1,41 @@
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from geo_py_utils.geo_general.valid_geom import make_valid_gpd
+
+
+def test_make_valid_gpd():
+
+    shp = gpd.GeoDataFrame({'id': [0, 1, 2]},
+                           geometry=[box(0, 0, 1, 1),
+                                     Polygon([(0, 0), (1, 1), (1, 0), (0, 1)]),
+                                     None],
+                           index=[10, 20, 30],
+                           crs=3857)
+    geometries_init = shp.geometry.copy()
+
+    shp_valid = make_valid_gpd(shp)
+
+    # The input is not modified
+    assert shp.geometry.geom_equals_exact(geometries_init, 0).sum() == 2
+    assert not shp.geometry.iloc[1].is_valid
+
+    assert shp_valid.index.equals(shp.index)
+    assert shp_valid.geometry.iloc[:2].is_valid.all()
+    assert shp_valid.geometry.iloc[0].equals(box(0, 0, 1, 1))
+    assert shp_valid.geometry.iloc[2] is None
+    assert np.isclose(shp_valid.geometry.iloc[1].area, 0.5)
+
+
+def test_make_valid_gpd_remove_violations():
+
+    shp = gpd.GeoDataFrame({'id': [0, 1, 2]},
+                           geometry=[box(0, 0, 1, 1),
+                                     Polygon([(0, 0), (1, 1), (1, 0), (0, 1)]),
+                                     None],
+                           index=[10, 20, 30],
+                           crs=3857)
+    shp_valid = make_valid_gpd(shp, unsafely_remove_violations=True)
+
+    assert shp_valid.index.tolist() == [10, 20]
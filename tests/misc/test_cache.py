@@ -0,0 +1,228 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import time
+from functools import partial
+from os.path import dirname, isfile
+from pyproj import CRS
+from shapely.geometry import Point
+
+from geo_py_utils.misc.cache import Cache_wrapper, ROW_ORDER_COL
+
+
+def test_cache_key_depends_on_args(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path))
+    def get_df(year, pr_code='24', new_crs=None):
+        list_calls.append(year)
+        return pd.DataFrame({'year': [year], 'pr_code': [pr_code]})
+
+    df_2016 = get_df(2016)
+    df_2021 = get_df(2021)
+
+    # Distinct arguments never collide
+    assert get_df.cache_path(2016) != get_df.cache_path(2021)
+    assert df_2016.year[0] == 2016 and df_2021.year[0] == 2021
+
+    # Defaults and keywords are bound: same key
+    assert get_df.cache_path(2016) == get_df.cache_path(year=2016, pr_code='24')
+    assert get_df.cache_path(2016, new_crs=CRS.from_epsg(4326)) == get_df.cache_path(2016, new_crs=CRS.from_user_input('EPSG:4326'))
+    assert get_df.cache_path(2016, new_crs=CRS.from_epsg(4326)) != get_df.cache_path(2016, new_crs=CRS.from_epsg(3857))
+    assert get_df.cache_path(2016, new_crs=3347) == get_df.cache_path(2016, new_crs='EPSG:3347') == get_df.cache_path(2016, new_crs=CRS(3347))
+
+    # No stable key for objects with the default repr (memory address)
+    class Slots:
+        __slots__ = ['x']
+    with pytest.raises(TypeError):
+        get_df.cache_path(2016, pr_code=Slots())
+
+    # Read back from disk
+    df_2016_cached = get_df(2016)
+    assert list_calls == [2016, 2021]
+    assert df_2016_cached.equals(df_2016)
+    assert get_df.__name__ == 'get_df'
+
+
+def _add(x, y=0):
+    return x + y
+
+
+class _Adder:
+
+    def __init__(self, y):
+        self.y = y
+
+    def add(self, x):
+        return x + self.y
+
+
+def test_cache_key_callable_args(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path))
+    def get_df(fun):
+        return pd.DataFrame({'x': [fun(1)]})
+
+    # Partials: function, args and keywords
+    assert get_df.cache_path(partial(_add, y=1)) != get_df.cache_path(partial(_add, y=2))
+    assert get_df.cache_path(partial(_add, y=1)) == get_df.cache_path(partial(_add, y=1))
+    assert get_df(partial(_add, y=1)).x[0] == 2 and get_df(partial(_add, y=2)).x[0] == 3
+
+    # Bound methods: instance and function
+    assert get_df.cache_path(_Adder(1).add) != get_df.cache_path(_Adder(2).add)
+    assert get_df.cache_path(_Adder(1).add) == get_df.cache_path(_Adder(1).add)
+
+    # Lambdas and closures: no stable key
+    y = 1
+    def add_y(x):
+        return x + y
+    for fun in [lambda x: x, add_y]:
+        with pytest.raises(TypeError):
+            get_df.cache_path(fun)
+
+
+def test_cache_root_arg_and_excluded_args(tmp_path):
+
+    @Cache_wrapper(cache_root_arg='path_cache_root', exclude_args=('data_download_path',))
+    def get_shp(pr_code, path_cache_root, data_download_path='bla'):
+        return gpd.GeoDataFrame({'pr_code': [pr_code]}, geometry=[Point(0, 0)], crs=4326)
+
+    path_cache = get_shp.cache_path('24', path_cache_root=str(tmp_path))
+    assert dirname(path_cache) == str(tmp_path)
+    assert path_cache == get_shp.cache_path('24', path_cache_root=str(tmp_path), data_download_path='blo')
+
+    shp = get_shp('24', path_cache_root=str(tmp_path))
+    assert isfile(path_cache)
+    assert gpd.read_parquet(path_cache).drop(columns=ROW_ORDER_COL).equals(shp)
+
+
+def test_cache_fixed_path(tmp_path):
+
+    path_cache = str(tmp_path / 'fixed.parquet')
+
+    @Cache_wrapper(path_cache=path_cache)
+    def get_df(x):
+        return pd.DataFrame({'x': [x]})
+
+    assert get_df.cache_path(1) == get_df.cache_path(2) == path_cache
+    get_df(1)
+    assert get_df(2).x[0] == 1
+
+
+
+def test_cache_memory_tier(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=2)
+    def get_df(x):
+        list_calls.append(x)
+        return pd.DataFrame({'x': [x]})
+
+    get_df(1)
+    df_1 = get_df(1)
+    assert get_df.cache_info()[:3] == (1, 0, 1)
+
+    # Defensive copies: modifying the result does not change the cache
+    df_1.loc[0, 'x'] = 100
+    assert get_df(1).x[0] == 1
+
+    # LRU eviction: 1 is the least recently used and is read back from disk
+    get_df(2)
+    get_df(3)
+    info = get_df.cache_info()
+    assert info.memory_entries == 2 and info.memory_bytes > 0
+    get_df(1)
+    assert get_df.cache_info().disk_hits == 1
+    assert list_calls == [1, 2, 3]
+
+    get_df.cache_clear()
+    assert get_df.cache_info().memory_entries == 0
+    get_df(2)
+    assert get_df.cache_info().disk_hits == 2
+
+
+def test_cache_memory_tier_max_bytes(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_bytes=1000)
+    def get_shp(n):
+        return gpd.GeoDataFrame({'i': range(n)}, geometry=[Point(i, i) for i in range(n)], crs=4326)
+
+    get_shp(1)
+    get_shp(1000)
+    info = get_shp.cache_info()
+    assert info.memory_entries == 1 and info.memory_bytes <= 1000
+
+
+def test_cache_stale_while_revalidate(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path), max_age=0.2)
+    def get_df(x):
+        list_calls.append(x)
+        return pd.DataFrame({'x': [x], 'version': [len(list_calls)]})
+
+    assert get_df(1).version[0] == 1
+    assert get_df(1).version[0] == 1
+    assert get_df.cache_info().refreshes == 0
+
+    # Stale: the old result is returned right away and refreshed in the background
+    time.sleep(0.3)
+    assert get_df(1).version[0] == 1
+    get_df.wait_for_refresh()
+    assert get_df.cache_info().refreshes == 1
+    assert get_df(1).version[0] == 2
+
+    # Also refreshed on disk
+    get_df.cache_clear()
+    assert get_df(1).version[0] == 2
+    assert list_calls == [1, 1]
+
+
+
+def test_cache_columns_bbox(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path), row_group_size=100)
+    def get_points(n):
+        rng = np.random.default_rng(0)
+        return gpd.GeoDataFrame({'i': np.arange(n), 'j': np.arange(n) * 2},
+                                geometry=gpd.points_from_xy(rng.uniform(0, 100, n), rng.uniform(0, 100, n)),
+                                crs=32198)
+
+    shp = get_points(10000)
+    bbox = (10, 20, 30, 25)
+    shp_expected = shp.cx[10:30, 20:25].reset_index(drop=True)
+
+    # Filtered in memory
+    shp_bbox = get_points(10000, cache_bbox=bbox, cache_columns=['i'])
+    assert shp_bbox.equals(shp_expected[['i', 'geometry']])
+
+    # Read from disk with pushdown: same rows in the same order
+    get_points.cache_clear()
+    shp_bbox_disk = get_points(10000, cache_bbox=bbox, cache_columns=['i'])
+    assert get_points.cache_info()[:3] == (1, 1, 1)
+    assert shp_bbox_disk.equals(shp_bbox)
+    assert get_points(10000).equals(shp)
+
+    # Rows sorted along a hilbert curve: only a few row groups intersect the bbox
+    parquet_file = pq.ParquetFile(get_points.cache_path(10000))
+    num_row_groups_read = 0
+    for k in range(parquet_file.num_row_groups):
+        stats = {parquet_file.schema.column(c).path: parquet_file.metadata.row_group(k).column(c).statistics
+                 for c in range(parquet_file.metadata.num_columns)}
+        if stats['bbox.xmin'].min <= bbox[2] and stats['bbox.xmax'].max >= bbox[0] and stats['bbox.ymin'].min <= bbox[3] and stats['bbox.ymax'].max >= bbox[1]:
+            num_row_groups_read += 1
+    assert num_row_groups_read < parquet_file.num_row_groups / 5
+
+
+def test_cache_reserved_args():
+
+    # cache_columns is an argument of the wrapper: it would never reach the function
+    with pytest.raises(ValueError):
+        @Cache_wrapper()
+        def get_df(x, cache_columns=None):
+            return pd.DataFrame({'x': [x]})
@@ -0,0 +1,198 @@
+import pandas as pd
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import utime
+from os.path import isfile, basename, getsize
+
+from geo_py_utils.misc.cache import Cache_wrapper
+from geo_py_utils.misc.cache_manager import CacheManager, get_metadata_path, read_metadata, write_metadata, main
+
+
+def test_cache_metadata_and_ttl(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path), ttl=0.2, memory_max_entries=0)
+    def get_df(x):
+        list_calls.append(x)
+        return pd.DataFrame({'x': [x]})
+
+    get_df(1)
+    path_cache = get_df.cache_path(1)
+    metadata = read_metadata(path_cache)
+    assert isfile(get_metadata_path(path_cache))
+    assert metadata['function'].endswith('get_df') and metadata['size'] > 0 and metadata['ttl'] == 0.2
+
+    get_df(1)
+    assert read_metadata(path_cache)['last_access'] >= metadata['last_access']
+    assert list_calls == [1]
+
+    # Expired: recomputed
+    time.sleep(0.3)
+    assert CacheManager(str(tmp_path)).ls()['expired'].all()
+    get_df(1)
+    assert list_calls == [1, 1]
+    assert get_df.cache_info().misses == 2
+
+
+def test_cache_manager_prune(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0)
+    def get_df(x):
+        return pd.DataFrame({'x': range(x)})
+
+    for x in [10, 20, 30]:
+        get_df(x)
+        time.sleep(0.01)
+    get_df(10)  # 10 is now the most recently used
+
+    manager = CacheManager(str(tmp_path))
+    df_entries = manager.ls()
+    assert df_entries.shape[0] == 3
+    assert df_entries['path'].iloc[-1] == get_df.cache_path(10)
+
+    # Quota: only the most recently used fits
+    max_bytes = int(df_entries['size'].iloc[-1])
+    df_removed = manager.prune(max_bytes=max_bytes, dry_run=True)
+    assert df_removed['path'].tolist() == [get_df.cache_path(20), get_df.cache_path(30)]
+    assert manager.ls().shape[0] == 3
+
+    manager.prune(max_bytes=max_bytes)
+    assert manager.ls()['path'].tolist() == [get_df.cache_path(10)]
+    assert not isfile(get_metadata_path(get_df.cache_path(20)))
+
+    # CLI
+    main(['--cache-root', str(tmp_path), 'prune', '--function', 'get_df'])
+    assert manager.ls().shape[0] == 0
+
+
+def test_cache_memory_hits_update_last_access(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path))
+    def get_df(x):
+        return pd.DataFrame({'x': range(x)})
+
+    get_df(10)
+    get_df(20)
+    for k, x in enumerate([10, 20]):
+        utime(get_df.cache_path(x), (time.time() - 100 + k, time.time() - 100 + k))
+
+    # Memory hit: 10 is the most recently used on disk too and survives the quota
+    get_df(10)
+    assert get_df.cache_info().memory_hits == 1
+
+    manager = CacheManager(str(tmp_path))
+    manager.prune(max_bytes=int(manager.ls()['size'].max()))
+    assert manager.ls()['path'].tolist() == [get_df.cache_path(10)]
+
+
+def test_cache_manager_prune_older_than_local_time(tmp_path, monkeypatch):
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0)
+    def get_df(x):
+        return pd.DataFrame({'x': range(x)})
+
+    # Created and last accessed 5 hours ago
+    get_df(10)
+    path_cache = get_df.cache_path(10)
+    five_hours_ago = time.time() - 5 * 3600
+    metadata = read_metadata(path_cache)
+    write_metadata(path_cache, {**metadata, 'created': five_hours_ago})
+    utime(path_cache, (five_hours_ago, five_hours_ago))
+
+    # Far from UTC: the local time must not shift the threshold
+    monkeypatch.setenv('TZ', 'Asia/Tokyo')
+    time.tzset()
+    try:
+        manager = CacheManager(str(tmp_path))
+        assert manager.prune(older_than=6 / 24).shape[0] == 0
+        assert manager.prune(older_than=4 / 24)['path'].tolist() == [path_cache]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_cache_max_cache_bytes(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path), max_cache_bytes=1, memory_max_entries=0)
+    def get_df(x):
+        return pd.DataFrame({'x': [x]})
+
+    get_df(1)
+    get_df(2)
+    # Quota smaller than one file: nothing is kept
+    assert CacheManager(str(tmp_path)).ls().shape[0] == 0
+
+
+def test_cache_single_flight(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0, lock_poll_interval=0.01)
+    def get_df(x):
+        list_calls.append(x)
+        time.sleep(0.3)
+        return pd.DataFrame({'x': [x]})
+
+    with ThreadPoolExecutor(4) as executor:
+        list_df = list(executor.map(get_df, [1] * 4))
+
+    # Computed once, the others waited and read the file
+    assert list_calls == [1]
+    assert all(df.equals(list_df[0]) for df in list_df)
+    assert get_df.cache_info().disk_hits == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([basename(get_df.cache_path(1)), basename(get_metadata_path(get_df.cache_path(1)))])
+
+
+def test_cache_corrupted_file(tmp_path):
+
+    list_calls = []
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0)
+    def get_df(x):
+        list_calls.append(x)
+        return pd.DataFrame({'x': range(x)})
+
+    get_df(100)
+    path_cache = get_df.cache_path(100)
+
+    # Truncated file: checksum mismatch -> recomputed
+    with open(path_cache, 'r+b') as f:
+        f.truncate(getsize(path_cache) // 2)
+    assert get_df(100).shape[0] == 100
+    assert list_calls == [100, 100]
+    assert get_df(100).shape[0] == 100
+    assert list_calls == [100, 100]
+
+
+def test_cache_stale_lock(tmp_path):
+
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0, lock_stale_after=1)
+    def get_df(x):
+        return pd.DataFrame({'x': [x]})
+
+    # Lock left by a killed process
+    path_lock = get_df.cache_path(1) + '.lock'
+    with open(path_lock, 'w') as f:
+        f.write('{}')
+    utime(path_lock, (time.time() - 10, time.time() - 10))
+
+    assert get_df(1).x[0] == 1
+    assert not isfile(path_lock)
+
+
+def test_cache_empty_lock(tmp_path):
+
+    # Default lock_stale_after (2 hours)
+    @Cache_wrapper(cache_root=str(tmp_path), memory_max_entries=0)
+    def get_df(x):
+        return pd.DataFrame({'x': [x]})
+
+    # Process killed between creating the lock and writing its pid: broken after a few seconds
+    path_lock = get_df.cache_path(1) + '.lock'
+    open(path_lock, 'w').close()
+    utime(path_lock, (time.time() - 60, time.time() - 60))
+
+    start = time.time()
+    assert get_df(1).x[0] == 1
+    assert time.time() - start < 5 and not isfile(path_lock)